@@ -1,31 +1,76 @@
 from __future__ import annotations
 
+import json
+import os
 import tempfile
-from typing import TYPE_CHECKING
+import threading
 
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Request, Response, jsonify, render_template, request
+from flask.helpers import get_debug_flag
+from werkzeug.serving import is_running_from_reloader
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from known_to_influxdb import line_protocol, write_to_influxDB
-from unknown_to_known import decode
-from csv_to_rerun import csv_to_rerun
-from raw_to_unknown import deserializer
+from unknown_to_known import dbc_cache
 from constants import *
 from os import urandom
-from .models import ConversionProgress, LimitedDict
-import threading
+from . import conversion_cache, jobs, metrics, pipeline, sessions
+from .models import ChangeFeed, ConversionProgress, LimitedDict, StageStatus
 
 from flask import send_from_directory
 
-if TYPE_CHECKING:
-    from werkzeug.datastructures.file_storage import FileStorage
-
-
 DATA_FILENAME = "{}.data"
 CSV_FILENAME = "{}.csv"
+KNOWN_FILENAME = "{}.parquet"
+WIDE_KNOWN_FILENAME = "{}.wide"
 LINE_FILENAME = "{}.line"
+LOG_FILENAME = "{}.log"
+RERUN_FILENAME = "{}.rrd"
+PYRAMID_FILENAME = "{}.pyramid.parquet"
+SUMMARY_FILENAME = "session.json"
+# Seconds between keep-alive comments of an idle progress stream
+STREAM_HEARTBEAT = 15
+# Milliseconds browsers wait before reconnecting a dropped progress stream
+STREAM_RETRY = 2000
+
+
+class StagedUploadRequest(Request):
+    """
+    Streams uploaded files chunk by chunk into STAGING_DIR, instead of keeping
+    them in memory or in the system temporary directory. Staging files are
+    removed when the request is closed.
+    """
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        STAGING_DIR.mkdir(parents=True, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=STAGING_DIR, suffix=".part")
+
+
+def keep_upload(file, path: Path) -> None:
+    """
+    Keeps an uploaded file at ``path``. Staged files are hard linked, so the data
+    is written to disk only once.
+    """
+    staging_path = getattr(file.stream, "name", None)
+    if isinstance(staging_path, str):
+        file.stream.flush()
+        try:
+            os.link(staging_path, path)
+            return
+        except OSError:
+            pass
+    file.save(path)
+
 
 app = Flask(__name__)
-app.config["tasks"] = LimitedDict(max_size=20)
+app.request_class = StagedUploadRequest
+# Progress of recent jobs by job id, running jobs are never dropped
+app.config["progress"] = LimitedDict(
+    max_size=20, keep=lambda progress: not progress.finished
+)
+# Changes of the progress of each task, see /progress/stream
+progress_changes = ChangeFeed()
 
 
 @app.route("/")
@@ -33,33 +78,177 @@ def home():
     return render_template("index.html")
 
 
+def _job_progress(job: jobs.Job) -> dict:
+    # Jobs finished before a restart only have their state in the queue
+    progress: ConversionProgress | None = app.config["progress"].get(job.id)
+    if progress is None:
+        return {
+            "file": job.filename,
+            "state": job.state,
+            "progress": 100 if job.state == jobs.DONE else 0,
+            "exception": job.error,
+            "stages": {},
+        }
+
+    return {
+        "file": job.filename,
+        "state": job.state,
+        "progress": progress.progress,
+        "exception": None if progress.exception is None else str(progress.exception),
+        "stages": {
+            name: {
+                "state": status.state,
+                "cached": status.cached,
+                "exception": (
+                    None if status.exception is None else str(status.exception)
+                ),
+                "progress": round(status.fraction * 100, 1),
+                "done": status.done,
+                "total": status.total,
+                "started": status.started,
+                "ended": status.ended,
+                "seconds": status.seconds,
+                "rows": status.rows,
+                "bytes_in": status.bytes_in,
+                "bytes_out": status.bytes_out,
+                "peak_memory": status.peak_memory,
+                "worker_peak_memory": status.worker_peak_memory,
+            }
+            for name, status in progress.stages.items()
+        },
+    }
+
+
+def _task_progress(task_name: str) -> dict | None:
+    """
+    :returns: Progress of every file of an upload, None for an unknown task
+    """
+    task_jobs = [_job_progress(job) for job in job_queue.jobs(task_name)]
+    if not task_jobs:
+        return None
+
+    exceptions = [job["exception"] for job in task_jobs if job["exception"]]
+
+    return {
+        "progress": sum(job["progress"] for job in task_jobs) / len(task_jobs),
+        "exception": {
+            "present": len(exceptions) > 0,
+            "type": exceptions[0] if exceptions else str(None),
+        },
+        "jobs": task_jobs,
+    }
+
+
 @app.get("/progress")
 def get_progress():
-    thread_name = request.args.get("name")
+    task_name = request.args.get("name")
 
-    if thread_name is None:
+    if task_name is None:
         return jsonify({"message": "No name parameter provided!"}), 400
 
-    progress: ConversionProgress = app.config["tasks"].get(thread_name)
-    if progress is None:
+    task_progress = _task_progress(task_name)
+    if task_progress is None:
         return jsonify({"message": "Unknown task name."}), 404
 
-    exception_present = progress.exception is not None
+    return jsonify(task_progress), 200
 
-    return (
-        jsonify(
-            {
-                "progress": progress.progress,
-                "exception": {
-                    "present": exception_present,
-                    "type": str(progress.exception),
-                },
-            }
-        ),
-        200,
+
+def _event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _progress_events(previous: dict | None, current: dict):
+    """
+    Events for what changed between two progress snapshots of a task, see
+    stream_progress. Everything is new when ``previous`` is None.
+    """
+    previous_jobs = [] if previous is None else previous["jobs"]
+    for i, job in enumerate(current["jobs"]):
+        before = previous_jobs[i] if i < len(previous_jobs) else None
+        for name, status in job["stages"].items():
+            state_before = (
+                before["stages"].get(name, {}).get("state", StageStatus.PENDING)
+                if before is not None
+                else StageStatus.PENDING
+            )
+            if status["state"] != state_before:
+                yield _event("stage", {"file": job["file"], "stage": name, **status})
+
+        if job["exception"] and (before is None or not before["exception"]):
+            yield _event(
+                "failure", {"file": job["file"], "exception": job["exception"]}
+            )
+
+    yield _event("progress", current)
+
+
+@app.get("/progress/stream")
+def stream_progress():
+    """
+    Pushes the progress of a task as Server-Sent Events, as soon as it changes:
+        progress: Same as /progress, whenever any of it changes
+        stage: A stage of a file started, finished, failed or was skipped
+        failure: A file failed, with the first exception of its conversion
+        done: Every file is finished, the stream ends after it
+    A new stream first gets the stages and failures that already happened. Idle
+    streams only get a comment every STREAM_HEARTBEAT seconds.
+    """
+    task_name = request.args.get("name")
+
+    if task_name is None:
+        return jsonify({"message": "No name parameter provided!"}), 400
+
+    # Read before the snapshot, so changes made while taking it are not missed
+    version = progress_changes.version(task_name)
+    task_progress = _task_progress(task_name)
+    if task_progress is None:
+        return jsonify({"message": "Unknown task name."}), 404
+
+    def events(version: int, current: dict):
+        yield f"retry: {STREAM_RETRY}\n\n"
+        previous = None
+        while True:
+            if current != previous:
+                yield from _progress_events(previous, current)
+                previous = current
+
+            if all(job["state"] in (jobs.DONE, jobs.FAILED) for job in current["jobs"]):
+                yield _event(
+                    "done",
+                    {
+                        "progress": current["progress"],
+                        "exception": current["exception"],
+                    },
+                )
+                return
+
+            changed = progress_changes.wait(task_name, version, STREAM_HEARTBEAT)
+            if changed == version:
+                # Also finds out when the client is gone
+                yield ": keep-alive\n\n"
+                continue
+            version = changed
+            current = _task_progress(task_name)
+
+    return Response(
+        events(version, task_progress),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(
+        metrics.render(job_queue.counts()), mimetype="text/plain; version=0.0.4"
     )
 
 
+@app.get("/dbcs")
+def list_dbcs():
+    return jsonify({"default": DEFAULT_DBC, "dbcs": dbc_cache.available_dbcs()})
+
+
 def allowed_file(filename: str) -> bool:
     return filename.lower().endswith(".data")
 
@@ -74,109 +263,273 @@ def upload_data():
     ):
         return jsonify({"error": "Invalid types uploaded."}), 400
 
-    # Read all file contents upfront to avoid closed file errors
-    files_data = [(file.filename, file.read()) for file in request.files.values()]
+    dbc_name = request.form.get("dbc") or None
+    try:
+        dbc_cache.resolve_dbc(dbc_name)
+    except (ValueError, FileNotFoundError) as exec:
+        return jsonify({"error": str(exec)}), 400
 
-    conversion_thread = threading.Thread(
-        target=convert_files,
-        args=(files_data,),
-        daemon=True,
-        name=urandom(8).hex(),
-    )
+    # Refuse early instead of saving files that can't be queued
+    if not job_queue.has_room(len(request.files)):
+        return _queue_full()
 
-    app.config["tasks"][conversion_thread.name] = ConversionProgress(
-        name=conversion_thread.name
-    )
-    conversion_thread.start()
+    task_name = urandom(8).hex()
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i, file in enumerate(request.files.values()):
+        job_id = f"{task_name}-{i}"
+        raw_data_path = UPLOAD_DIR / DATA_FILENAME.format(job_id)
+        keep_upload(file, raw_data_path)
+        files.append((job_id, file.filename, str(raw_data_path)))
 
-    return jsonify({"name": conversion_thread.name})
+    try:
+        job_queue.submit(task_name, files, dbc_name)
+    except jobs.QueueFull:
+        for _, _, raw_data_path in files:
+            Path(raw_data_path).unlink(missing_ok=True)
+        return _queue_full()
 
+    scheduler.notify()
 
-def convert_files(files):
-    for filename, content in files:
-        # Create a temporary FileStorage-like object for conversion
-        from io import BytesIO
-        from werkzeug.datastructures import FileStorage
+    return jsonify({"name": task_name})
 
-        file_like = FileStorage(
-            stream=BytesIO(content), name=filename, filename=filename
-        )
 
-        convert_file(file_like)
+def _queue_full():
+    response = jsonify({"error": "Too many conversions waiting, try again later."})
+    response.headers["Retry-After"] = "30"
+    return response, 503
 
 
-def convert_file(file: FileStorage) -> None:
+def convert_job(job: jobs.Job) -> None:
+    """
+    Converts the file of one queued job, run by the scheduler. Raises the first
+    failure so the job is recorded as failed.
+    """
+    progress = ConversionProgress(
+        name=job.id, on_change=lambda: progress_changes.changed(job.task)
+    )
+    app.config["progress"][job.id] = progress
+    try:
+        convert_file(Path(job.raw_path), job.filename, progress, job.dbc_name)
+    finally:
+        progress.finished = True
+        Path(job.raw_path).unlink(missing_ok=True)
+
+    if progress.exception is not None:
+        raise progress.exception
+
+
+def convert_file(
+    raw_data_path: Path,
+    filename: str,
+    conversion_progress: ConversionProgress,
+    dbc_name: str | None = None,
+) -> None:
     """
     Converts .data following this flow:
-        .data (raw) -> .data (unknown) -> .csv (known) -> .line (known)
+        .data (raw) -> frames (in memory) -> .parquet (known) -> line protocol -> InfluxDB
+                                                               -> .rrd (Rerun)
+                                                               -> .pyramid.parquet -> downsampled InfluxDB
 
-    Saves the intermediate .csv to CSV_PARENT_PATH
+    The InfluxDB, Rerun and pyramid branches run concurrently and fail
+    independently, their status is reported in ConversionProgress.stages.
 
-    :param: file The file to convert."""
-    assert file.name
+    The unknown text .data file and decode log are only written to CSV_DIR when
+    KEEP_UNKNOWN_DATA is set, the known .csv export only when EXPORT_KNOWN_CSV is set
+    and the .line archive only when ARCHIVE_LINE_PROTOCOL is set.
 
-    csv_filename = CSV_FILENAME.format(file.name)
-    raw_data_filename = DATA_FILENAME.format("raw_" + file.name)
-    unknown_data_filename = DATA_FILENAME.format("unknown_" + file.name)
-    line_filename = LINE_FILENAME.format(file.name)
+    Stages are cached by the contents of the file and the DBC, so uploading a file
+    again only runs the stages that did not succeed before. The unknown, csv and
+    .line debug outputs are only written by stages that actually run.
 
-    current_thread_name = threading.current_thread().name
-    conversion_progress: ConversionProgress = app.config["tasks"][current_thread_name]
+    The known file is a .parquet file, or a .wide directory with one table per CAN
+    message when KNOWN_LAYOUT is "wide".
 
-    with tempfile.TemporaryDirectory() as temporary_directory:
-        parent_path = Path(temporary_directory)
-        raw_data_path = parent_path / raw_data_filename
-        unknown_data_path = parent_path / unknown_data_filename
-        csv_path = CSV_DIR / csv_filename
-        line_path = CSV_DIR / line_filename
+    Saves the intermediate known file and the pyramid to CSV_DIR and adds the log to the session index.
 
-        file.save(raw_data_path)
-        conversion_progress.progress = 20
+    :param: raw_data_path The uploaded .data file to convert.
+    :param: filename Name of the uploaded file, used to name the outputs.
+    :param: conversion_progress Progress of this conversion.
+    :param: dbc_name File name of the DBC in DBC_DIR to decode with, defaults to DEFAULT_DBC
+    """
+    csv_path = CSV_DIR / CSV_FILENAME.format(filename)
+    known_filename = WIDE_KNOWN_FILENAME if KNOWN_LAYOUT == "wide" else KNOWN_FILENAME
+    known_path = CSV_DIR / known_filename.format(filename)
+    unknown_data_path = CSV_DIR / DATA_FILENAME.format("unknown_" + filename)
+    line_path = CSV_DIR / LINE_FILENAME.format(filename)
+    log_path = CSV_DIR / LOG_FILENAME.format("unknown_" + filename)
+    rerun_path = RERUN_DIR / RERUN_FILENAME.format(filename)
+    pyramid_path = CSV_DIR / PYRAMID_FILENAME.format(filename)
+
+    # Hashing a large upload takes a while too
+    def report_hashing(done: int, total: int):
+        previous = int(conversion_progress.progress)
+        conversion_progress.progress = 20 * done / total
+        if int(conversion_progress.progress) != previous:
+            conversion_progress.changed()
+
+    try:
+        key = conversion_cache.conversion_key(raw_data_path, dbc_name, report_hashing)
+    except Exception as exec:
+        conversion_progress.exception = exec
+        return
+    conversion_progress.progress = 20
+
+    with conversion_cache_store.entry(key) as entry:
+        cached_known_path = entry / known_filename.format("known")
+        cached_rerun_path = entry / RERUN_FILENAME.format("known")
+        cached_pyramid_path = entry / PYRAMID_FILENAME.format("known")
+        summary_path = entry / SUMMARY_FILENAME
+
+        # InfluxDB, Rerun and the pyramid only need the known file and run side by side
+        pipeline.run_stages(
+            [
+                pipeline.Stage(
+                    "decode",
+                    pipeline.decode_stage,
+                    args=(
+                        str(raw_data_path.resolve()),
+                        str(cached_known_path),
+                        dbc_name,
+                        str(unknown_data_path.resolve()) if KEEP_UNKNOWN_DATA else None,
+                        str(csv_path.resolve()) if EXPORT_KNOWN_CSV else None,
+                        str(log_path.resolve()) if KEEP_UNKNOWN_DATA else None,
+                        str(summary_path),
+                    ),
+                    in_process=True,
+                    weight=20,
+                    marker=conversion_cache.marker(entry, "decode"),
+                ),
+                pipeline.Stage(
+                    "influxdb",
+                    pipeline.influxdb_stage,
+                    args=(
+                        str(cached_known_path),
+                        str(summary_path),
+                        str(line_path.resolve()) if ARCHIVE_LINE_PROTOCOL else None,
+                    ),
+                    depends_on=("decode",),
+                    in_process=True,
+                    weight=25,
+                    marker=conversion_cache.marker(entry, "influxdb"),
+                ),
+                pipeline.Stage(
+                    "rerun",
+                    pipeline.rerun_stage,
+                    args=(str(cached_known_path), str(entry), filename),
+                    depends_on=("decode",),
+                    in_process=True,
+                    weight=20,
+                    marker=conversion_cache.marker(entry, "rerun"),
+                ),
+                pipeline.Stage(
+                    "downsample",
+                    pipeline.downsample_stage,
+                    args=(str(cached_known_path), str(cached_pyramid_path)),
+                    depends_on=("decode",),
+                    in_process=True,
+                    weight=10,
+                    marker=conversion_cache.marker(entry, "downsample"),
+                ),
+                pipeline.Stage(
+                    "downsampled_influxdb",
+                    pipeline.downsampled_influxdb_stage,
+                    args=(str(cached_pyramid_path), str(summary_path)),
+                    depends_on=("downsample",),
+                    in_process=True,
+                    weight=5,
+                    marker=conversion_cache.marker(entry, "downsampled_influxdb"),
+                ),
+            ],
+            conversion_progress,
+        )
 
         try:
-            deserializer.deserialize(
-                str(raw_data_path.resolve()), str(unknown_data_path.resolve())
-            )
+            if conversion_progress.stages["decode"].state == StageStatus.DONE:
+                conversion_cache.publish(cached_known_path, known_path)
+                with open(summary_path) as file:
+                    session_index.add(key, filename, json.load(file))
+            if conversion_progress.stages["rerun"].state == StageStatus.DONE:
+                conversion_cache.publish(cached_rerun_path, rerun_path)
+            if conversion_progress.stages["downsample"].state == StageStatus.DONE:
+                conversion_cache.publish(cached_pyramid_path, pyramid_path)
         except Exception as exec:
-            conversion_progress.exception = exec
-            return
-        else:
-            conversion_progress.progress = 20
+            if conversion_progress.exception is None:
+                conversion_progress.exception = exec
 
-        try:
-            decode.make_known(str(unknown_data_path.resolve()), str(csv_path.resolve()))
-        except Exception as exec:
-            conversion_progress.exception = exec
-            return
-        else:
-            conversion_progress.progress = 40
 
-        try:
-            line_protocol.convert_to_lineprotocol(
-                str(csv_path.resolve()),
-                str(line_path.resolve()),
-            )
-        except Exception as exec:
-            conversion_progress.exception = exec
-            return
-        else:
-            conversion_progress.progress = 60
+def _parse_datetime(value: str) -> datetime:
+    """
+    :param value: ISO 8601 date/time, UTC unless it has an offset, like session times
+    """
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
 
-        try:
-            write_to_influxDB.write_to_influxDB(str(line_path.resolve()))
-        except Exception as exec:
-            conversion_progress.exception = exec
-            return
-        else:
-            conversion_progress.progress = 80
 
-        try:
-            csv_to_rerun.convert(csv_path.resolve(), RERUN_DIR)
-        except Exception as exec:
-            conversion_progress.exception = exec
-            return
-        else:
-            conversion_progress.progress = 100
+def _parse_time(value: str) -> float:
+    """
+    :param value: Unix time in seconds or an ISO 8601 date/time, see _parse_datetime
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return _parse_datetime(value).timestamp()
+
+
+@app.get("/sessions")
+def list_sessions():
+    """
+    Converted logs, latest first, filtered by the query parameters:
+        date: Day (YYYY-MM-DD, UTC) the session overlaps
+        start, end: Time range the session overlaps, Unix seconds or ISO 8601 (UTC
+            unless it has an offset)
+        sensor: Sensor with values in the session, can be given several times
+        limit, offset: Page of the results
+    """
+    try:
+        start = end = None
+        if "date" in request.args:
+            day = _parse_datetime(request.args["date"])
+            start, end = day.timestamp(), (day + timedelta(days=1)).timestamp()
+        if "start" in request.args:
+            start = _parse_time(request.args["start"])
+        if "end" in request.args:
+            end = _parse_time(request.args["end"])
+        limit = int(request.args.get("limit", 50))
+        offset = int(request.args.get("offset", 0))
+    except ValueError as exec:
+        return jsonify({"error": str(exec)}), 400
+
+    total, page = session_index.query(
+        start, end, request.args.getlist("sensor"), limit, offset
+    )
+    for session in page:
+        session["rerun_file"] = RERUN_FILENAME.format(session["filename"])
+    return jsonify(
+        {
+            "total": total,
+            "limit": min(max(limit, 0), sessions.MAX_PAGE_SIZE),
+            "offset": offset,
+            "sessions": page,
+        }
+    )
+
+
+@app.get("/sessions/<session_id>")
+def get_session(session_id):
+    session = session_index.get(session_id)
+    if session is None:
+        return jsonify({"message": "Unknown session."}), 404
+
+    session["rerun_file"] = RERUN_FILENAME.format(session["filename"])
+    return jsonify(session)
+
+
+@app.get("/sensors")
+def list_sensors():
+    return jsonify(session_index.sensors())
 
 
 @app.route("/files")
@@ -193,5 +546,62 @@ def download_file(filename):
     return send_from_directory(RERUN_DIR, filename, as_attachment=True)
 
 
+# === START-UP ===
+# Nothing below runs on import, so other processes importing this module (the
+# benchmark, the reloader's watcher) don't touch the jobs of the running server
+
+conversion_cache_store: conversion_cache.ConversionCache | None = None
+job_queue: jobs.JobQueue | None = None
+session_index: sessions.SessionIndex | None = None
+scheduler: jobs.Scheduler | None = None
+_start_lock = threading.Lock()
+
+
+def open_stores() -> None:
+    """
+    Opens the conversion cache, job queue and session index under DATA_DIR, enough
+    to call convert_file. Does nothing if they are already open.
+    """
+    global conversion_cache_store, job_queue, session_index
+    with _start_lock:
+        if conversion_cache_store is None:
+            conversion_cache_store = conversion_cache.ConversionCache()
+            job_queue = jobs.JobQueue()
+            session_index = sessions.SessionIndex()
+
+
+def create_app() -> Flask:
+    """
+    Starts the server's side of the app, once per process: removes the staging
+    files of uploads interrupted by a restart, queues the jobs that were running
+    again and starts converting queued jobs.
+
+        flask --app "app.app:create_app()" run
+
+    Under ``flask --debug run`` the reloader's first process only watches files and
+    restarts the one serving requests, so nothing is started in it.
+    """
+    global scheduler
+    if get_debug_flag() and not is_running_from_reloader():
+        return app
+
+    open_stores()
+    with _start_lock:
+        if scheduler is None:
+            for staging_path in STAGING_DIR.glob("*.part"):
+                staging_path.unlink(missing_ok=True)
+
+            scheduler = jobs.Scheduler(
+                job_queue,
+                convert_job,
+                on_change=lambda job: progress_changes.changed(job.task),
+            )
+            scheduler.start()
+    return app
+
+
 if __name__ == "__main__":
+    # The reloader runs this again in the process that serves requests
+    if is_running_from_reloader():
+        create_app()
     app.run(debug=True)
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import shutil
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+from constants import *
+from unknown_to_known import dbc_cache
+
+"""
+Outputs of past conversions, stored under CONVERSION_CACHE_DIR by a key made of
+the raw file's sha256, the DBC's sha256 and PIPELINE_VERSION. Uploading the same
+file again finds the stages it already finished (InfluxDB included, so no points
+are written twice), and a job that failed part way resumes after the last stage
+that succeeded.
+
+The least recently used entries are removed once the cache grows past
+CONVERSION_CACHE_MAX_BYTES. Entries used by a running conversion are never removed.
+"""
+
+# Bump when a stage's output changes so old entries are not reused
+PIPELINE_VERSION = 5
+
+DIGEST_CHUNK_SIZE = 8 * 1024 * 1024
+
+LAST_USED_FILENAME = "last_used"
+MARKER_FILENAME = "{}.done"
+
+
+def file_digest(path, report: Callable[[int, int], None] | None = None) -> str:
+    """
+    :param report: Called with the bytes hashed so far and the size of the file
+    """
+    digest = hashlib.sha256()
+    total, done = os.path.getsize(path), 0
+    buffer = bytearray(DIGEST_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while size := file.readinto(buffer):
+            digest.update(view[:size])
+            done += size
+            if report is not None:
+                report(done, total)
+    return digest.hexdigest()
+
+
+def conversion_key(
+    raw_path,
+    dbc_name: str | None = None,
+    report: Callable[[int, int], None] | None = None,
+    layout: str = KNOWN_LAYOUT,
+) -> str:
+    """
+    :param raw_path: Raw .data file
+    :param dbc_name: File name of the DBC in DBC_DIR, defaults to DEFAULT_DBC
+    :param report: Progress of hashing the raw file, see file_digest
+    :param layout: Layout of the known file, "long" or "wide"
+    """
+    raw_digest = file_digest(raw_path, report)
+    key = f"{raw_digest}:{dbc_cache.dbc_digest(dbc_name)}:v{PIPELINE_VERSION}"
+    if layout != "long":
+        # Long layout keys are unchanged from before there was a choice
+        key += f":{layout}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def marker(entry: Path, stage: str) -> Path:
+    return entry / MARKER_FILENAME.format(stage)
+
+
+def publish(source: Path, destination: Path) -> None:
+    """
+    Makes a cached output available at ``destination``, hard linked when possible
+    so it takes no extra space and outlives eviction of the entry. Directories
+    (wide known files) are published file by file.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    temporary = destination.with_name(destination.name + ".tmp")
+    if source.is_dir():
+        shutil.rmtree(temporary, ignore_errors=True)
+        shutil.copytree(source, temporary, copy_function=_link_or_copy)
+        # A directory can't replace another one that is not empty
+        shutil.rmtree(destination, ignore_errors=True)
+        os.replace(temporary, destination)
+        return
+
+    temporary.unlink(missing_ok=True)
+    _link_or_copy(source, temporary)
+    os.replace(temporary, destination)
+
+
+def _link_or_copy(source, destination) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _size(entry: Path) -> int:
+    return sum(path.stat().st_size for path in entry.rglob("*") if path.is_file())
+
+
+def _last_used(entry: Path) -> float:
+    try:
+        return (entry / LAST_USED_FILENAME).stat().st_mtime
+    except FileNotFoundError:
+        pass
+    try:
+        return entry.stat().st_mtime
+    except FileNotFoundError:
+        # Removed by hand, nothing to keep
+        return 0.0
+
+
+class ConversionCache:
+    """
+    The size of every entry is read from disk on first use, then only the entry
+    just used is measured again, so the cache is not walked each time an entry is
+    used.
+    """
+
+    def __init__(
+        self,
+        root: Path = CONVERSION_CACHE_DIR,
+        max_bytes: int = CONVERSION_CACHE_MAX_BYTES,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._in_use: Counter[str] = Counter()
+        self._entry_locks: dict[str, threading.Lock] = {}
+        # Bytes of each entry by key, None until read from disk
+        self._sizes: dict[str, int] | None = None
+        self._total = 0
+
+    def _load_sizes(self) -> dict[str, int]:
+        """
+        Must be called with the lock held.
+        """
+        if self._sizes is None:
+            try:
+                entries = [path for path in self.root.iterdir() if path.is_dir()]
+            except FileNotFoundError:
+                entries = []
+            self._sizes = {entry.name: _size(entry) for entry in entries}
+            self._total = sum(self._sizes.values())
+        return self._sizes
+
+    @contextmanager
+    def entry(self, key: str):
+        """
+        Directory of one conversion, held exclusively while in the with block so
+        two uploads of the same file don't write it at the same time.
+        """
+        with self._lock:
+            self._in_use[key] += 1
+            entry_lock = self._entry_locks.setdefault(key, threading.Lock())
+
+        size = None
+        try:
+            with entry_lock:
+                path = self.root / key
+                path.mkdir(parents=True, exist_ok=True)
+                (path / LAST_USED_FILENAME).touch()
+                try:
+                    yield path
+                finally:
+                    size = _size(path)
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if self._in_use[key] == 0:
+                    del self._in_use[key]
+                    del self._entry_locks[key]
+                if size is not None:
+                    sizes = self._load_sizes()
+                    self._total += size - sizes.get(key, 0)
+                    sizes[key] = size
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        with self._lock:
+            sizes = self._load_sizes()
+            if self._total <= self.max_bytes:
+                return
+
+            for key in sorted(sizes, key=lambda key: _last_used(self.root / key)):
+                if self._total <= self.max_bytes:
+                    break
+                if key in self._in_use:
+                    continue
+                shutil.rmtree(self.root / key, ignore_errors=True)
+                self._total -= sizes.pop(key)
+                print(f"EVICTED CONVERSION {key}")
@@ -0,0 +1,269 @@
+import sqlite3
+import threading
+import time
+
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+from constants import *
+
+"""
+Persistent queue of conversion jobs, one job per uploaded file.
+
+Jobs live in a SQLite database under DATA_DIR, so queued uploads survive a
+restart; jobs that were running when the server stopped are queued again. The
+Scheduler claims queued jobs while fewer than ``max_running`` are in progress.
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    task: str
+    filename: str
+    raw_path: str
+    dbc_name: str | None
+    state: str
+    error: str | None
+    created: float
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, FAILED)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    raw_path TEXT NOT NULL,
+    dbc_name TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_task ON jobs (task);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+"""
+
+_COLUMNS = "id, task, filename, raw_path, dbc_name, state, error, created"
+
+
+class JobQueue:
+    def __init__(self, path=JOBS_DB, max_queued: int = MAX_QUEUED_JOBS):
+        """
+        :param path: SQLite database file
+        :param max_queued: Uploads are refused while this many jobs are waiting
+        """
+        self.path = path
+        self.max_queued = max_queued
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def queued_count(self) -> int:
+        with closing(self._connect()) as connection:
+            (count,) = connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)
+            ).fetchone()
+        return count
+
+    def counts(self) -> dict[str, int]:
+        """
+        :returns: Number of jobs in each state
+        """
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            ).fetchall()
+        return {**dict.fromkeys((QUEUED, RUNNING, DONE, FAILED), 0), **dict(rows)}
+
+    def has_room(self, count: int = 1) -> bool:
+        return self.queued_count() + count <= self.max_queued
+
+    def submit(
+        self, task: str, files: list[tuple[str, str, str]], dbc_name: str | None
+    ) -> list[Job]:
+        """
+        Queues one job per file, all or none.
+
+        :param task: Name shared by the jobs of one upload
+        :param files: (job id, file name, path of the raw upload) of every file
+        :param dbc_name: DBC to decode with
+        :raises QueueFull: When the files would exceed max_queued
+        """
+        now = time.time()
+        jobs = [
+            Job(job_id, task, filename, raw_path, dbc_name, QUEUED, None, now)
+            for job_id, filename, raw_path in files
+        ]
+
+        with closing(self._connect()) as connection:
+            # IMMEDIATE takes the write lock before counting, so concurrent
+            # uploads can't both squeeze into the last free slot
+            connection.execute("BEGIN IMMEDIATE")
+            (queued,) = connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)
+            ).fetchone()
+            if queued + len(jobs) > self.max_queued:
+                connection.execute("ROLLBACK")
+                raise QueueFull(f"{queued} conversions are already waiting")
+
+            connection.executemany(
+                f"INSERT INTO jobs ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        job.id,
+                        job.task,
+                        job.filename,
+                        job.raw_path,
+                        job.dbc_name,
+                        job.state,
+                        job.error,
+                        job.created,
+                    )
+                    for job in jobs
+                ],
+            )
+            connection.execute("COMMIT")
+
+        return jobs
+
+    def claim(self) -> Job | None:
+        """
+        Marks the oldest queued job as running and returns it.
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                f"UPDATE jobs SET state = ? WHERE id = ("
+                f"SELECT id FROM jobs WHERE state = ? ORDER BY created, id LIMIT 1"
+                f") RETURNING {_COLUMNS}",
+                (RUNNING, QUEUED),
+            ).fetchone()
+        return None if row is None else Job(*row)
+
+    def finish(self, job_id: str, error: str | None = None) -> None:
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, error = ? WHERE id = ?",
+                (DONE if error is None else FAILED, error, job_id),
+            )
+
+    def requeue_running(self) -> int:
+        """
+        Queues jobs left running by a previous process again.
+        """
+        with closing(self._connect()) as connection:
+            return connection.execute(
+                "UPDATE jobs SET state = ? WHERE state = ?", (QUEUED, RUNNING)
+            ).rowcount
+
+    def jobs(self, task: str) -> list[Job]:
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                f"SELECT {_COLUMNS} FROM jobs WHERE task = ? ORDER BY created, id",
+                (task,),
+            ).fetchall()
+        return [Job(*row) for row in rows]
+
+
+class Scheduler:
+    """
+    Runs queued jobs with at most ``max_running`` at a time.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        run_job: Callable[[Job], None],
+        max_running: int = MAX_RUNNING_JOBS,
+        on_change: Callable[[Job], None] | None = None,
+    ):
+        """
+        :param queue: Jobs to run
+        :param run_job: Converts one job, raising when it fails
+        :param max_running: Number of jobs converted at the same time
+        :param on_change: Called after a job started running and after it finished
+        """
+        self.queue = queue
+        self.run_job = run_job
+        self.on_change = on_change
+        self.max_running = max_running
+        self._slots = threading.BoundedSemaphore(max_running)
+        self._wake = threading.Event()
+        self._executor = ThreadPoolExecutor(max_running, thread_name_prefix="job")
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print(f"RESUMING {requeued} INTERRUPTED JOBS")
+
+        self._thread = threading.Thread(
+            target=self._dispatch, daemon=True, name="scheduler"
+        )
+        self._thread.start()
+
+    def notify(self) -> None:
+        """
+        Wakes the scheduler after jobs were submitted.
+        """
+        self._wake.set()
+
+    def _dispatch(self) -> None:
+        while True:
+            self._slots.acquire()
+            # Cleared before claiming so a submit during the claim still wakes us
+            self._wake.clear()
+            try:
+                job = self.queue.claim()
+            except Exception as e:
+                print(f"Could not claim a job: {e}")
+                job = None
+
+            if job is None:
+                self._slots.release()
+                self._wake.wait(timeout=5)
+                continue
+
+            self._executor.submit(self._run, job)
+
+    def _changed(self, job: Job) -> None:
+        if self.on_change is not None:
+            try:
+                self.on_change(job)
+            except Exception as e:
+                print(f"Could not report the change of job {job.id}: {e}")
+
+    def _run(self, job: Job) -> None:
+        self._changed(job)
+        try:
+            self.run_job(job)
+        except Exception as e:
+            self.queue.finish(job.id, error=str(e) or type(e).__name__)
+        else:
+            self.queue.finish(job.id)
+        finally:
+            self._slots.release()
+            self._wake.set()
+            self._changed(job)
@@ -0,0 +1,163 @@
+import threading
+
+from collections import Counter
+
+from .models import StageStatus
+
+"""
+Conversion metrics in the Prometheus text format, served on /metrics.
+
+They are kept in memory by the web process, so counters start from zero after a
+restart, which Prometheus handles as a counter reset.
+"""
+
+# Upper bounds in seconds of the stage duration histogram buckets
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+        for value in labels.values()
+    )
+    return (
+        "{"
+        + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped))
+        + "}"
+    )
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, **labels) -> list[str]:
+        lines = [
+            f"{name}_bucket{_labels(**labels, le=bound)} {count}"
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {self.count}")
+        lines.append(f"{name}_sum{_labels(**labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(**labels)} {self.count}")
+        return lines
+
+
+class StageMetrics:
+    """
+    Totals of the stages run by pipeline.run_stages, by stage name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations: dict[str, Histogram] = {}
+        # (stage, result) where result is done, failed, skipped or cached
+        self.results: Counter[tuple[str, str]] = Counter()
+        self.rows: Counter[str] = Counter()
+        self.bytes: Counter[tuple[str, str]] = Counter()
+        # Of the last run of each stage
+        self.peak_memory: dict[str, int] = {}
+        self.worker_peak_memory: dict[str, int] = {}
+
+    def observe(self, stage: str, status: StageStatus) -> None:
+        result = "cached" if status.cached else status.state
+        with self._lock:
+            self.results[stage, result] += 1
+            if status.cached or status.seconds is None:
+                return
+
+            self.durations.setdefault(stage, Histogram()).observe(status.seconds)
+            self.rows[stage] += status.rows or 0
+            self.bytes[stage, "in"] += status.bytes_in or 0
+            self.bytes[stage, "out"] += status.bytes_out or 0
+            if status.peak_memory is not None:
+                self.peak_memory[stage] = status.peak_memory
+            if status.worker_peak_memory is not None:
+                self.worker_peak_memory[stage] = status.worker_peak_memory
+
+    def lines(self) -> list[str]:
+        with self._lock:
+            lines = [
+                "# HELP conversion_stage_duration_seconds Time taken by conversion stages that ran.",
+                "# TYPE conversion_stage_duration_seconds histogram",
+            ]
+            for stage, histogram in sorted(self.durations.items()):
+                lines += histogram.lines(
+                    "conversion_stage_duration_seconds", stage=stage
+                )
+
+            lines += [
+                "# HELP conversion_stage_results_total Conversion stages by stage and result (done, failed, skipped, cached).",
+                "# TYPE conversion_stage_results_total counter",
+            ]
+            lines += [
+                f"conversion_stage_results_total{_labels(stage=stage, result=result)} {count}"
+                for (stage, result), count in sorted(self.results.items())
+            ]
+
+            lines += [
+                "# HELP conversion_stage_rows_total Known rows processed by conversion stages.",
+                "# TYPE conversion_stage_rows_total counter",
+            ]
+            lines += [
+                f"conversion_stage_rows_total{_labels(stage=stage)} {count}"
+                for stage, count in sorted(self.rows.items())
+            ]
+
+            lines += [
+                "# HELP conversion_stage_bytes_total Bytes read (in) and written (out) by conversion stages.",
+                "# TYPE conversion_stage_bytes_total counter",
+            ]
+            lines += [
+                f"conversion_stage_bytes_total{_labels(stage=stage, direction=direction)} {count}"
+                for (stage, direction), count in sorted(self.bytes.items())
+            ]
+
+            lines += [
+                "# HELP conversion_stage_peak_memory_bytes Peak resident memory of the last run of each stage.",
+                "# TYPE conversion_stage_peak_memory_bytes gauge",
+            ]
+            lines += [
+                f"conversion_stage_peak_memory_bytes{_labels(stage=stage)} {peak}"
+                for stage, peak in sorted(self.peak_memory.items())
+            ]
+
+            lines += [
+                "# HELP conversion_stage_worker_peak_memory_bytes Peak resident memory of the processes started by the last run of each stage, such as decoding shards.",
+                "# TYPE conversion_stage_worker_peak_memory_bytes gauge",
+            ]
+            lines += [
+                f"conversion_stage_worker_peak_memory_bytes{_labels(stage=stage)} {peak}"
+                for stage, peak in sorted(self.worker_peak_memory.items())
+            ]
+        return lines
+
+
+stages = StageMetrics()
+
+
+def render(job_counts: dict[str, int]) -> str:
+    """
+    :param job_counts: Number of jobs in the queue by state
+    """
+    lines = [
+        "# HELP conversion_jobs Conversion jobs in the queue by state.",
+        "# TYPE conversion_jobs gauge",
+    ]
+    lines += [
+        f"conversion_jobs{_labels(state=state)} {count}"
+        for state, count in sorted(job_counts.items())
+    ]
+    lines += stages.lines()
+    return "\n".join(lines) + "\n"
@@ -1,13 +1,62 @@
-from dataclasses import dataclass
-from typing import Optional
+import threading
+
+from dataclasses import dataclass, field
+from typing import Callable, Optional
 from collections import OrderedDict
 
 
+@dataclass
+class StageStatus:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    state: str = PENDING
+    exception: Optional[Exception] = None
+    # Done by an earlier conversion of the same file
+    cached: bool = False
+    # Part of the stage's input processed so far, from 0 to 1
+    fraction: float = 0
+    # Input processed so far and in total, in the unit the stage reports in:
+    # bytes of the raw file for decode, rows or windows for the others
+    done: Optional[int] = None
+    total: Optional[int] = None
+    # Unix times the stage started and finished running
+    started: Optional[float] = None
+    ended: Optional[float] = None
+    rows: Optional[int] = None
+    bytes_in: Optional[int] = None
+    bytes_out: Optional[int] = None
+    # Peak resident memory of the process running the stage, in bytes
+    peak_memory: Optional[int] = None
+    # Peak resident memory of the processes the stage started itself, in bytes
+    worker_peak_memory: Optional[int] = None
+
+    @property
+    def seconds(self) -> Optional[float]:
+        if self.started is None or self.ended is None:
+            return None
+        return self.ended - self.started
+
+
 @dataclass
 class ConversionProgress:
     name: str
     progress: float = 0
     exception: Optional[Exception] = None
+    stages: dict[str, StageStatus] = field(default_factory=dict)
+    finished: bool = False
+    # Called by changed(), to let watchers of the conversion know
+    on_change: Optional[Callable[[], None]] = field(default=None, repr=False)
+
+    def changed(self) -> None:
+        """
+        To be called after the progress, a stage or the exception changed.
+        """
+        if self.on_change is not None:
+            self.on_change()
 
     def pop_exception(self) -> Exception:
         if self.exception is None:
@@ -20,11 +69,61 @@ class ConversionProgress:
 
 
 class LimitedDict(OrderedDict):
-    def __init__(self, max_size=None, *args, **kwargs):
+    def __init__(self, max_size=None, *args, keep=None, **kwargs):
+        """
+        :param max_size: Oldest items are removed past this size
+        :param keep: Items for which keep(value) is true are never removed
+        """
         super().__init__(*args, **kwargs)
         self.max_size = max_size
+        self.keep = keep
 
     def __setitem__(self, key, value):
         super().__setitem__(key, value)
-        if self.max_size is not None and len(self) > self.max_size:
-            self.popitem(last=False)  # Remove the oldest item
+        if self.max_size is None or len(self) <= self.max_size:
+            return
+
+        # Remove the oldest items that may go, may stay over max_size
+        removable = [
+            key for key, value in self.items() if not (self.keep and self.keep(value))
+        ]
+        for key in removable[: len(self) - self.max_size]:
+            del self[key]
+
+
+class ChangeFeed:
+    """
+    Lets threads wait for something identified by a key to change. Each key has a
+    version, increased by every change, so a watcher that was busy when a change
+    happened still sees it the next time it waits.
+    """
+
+    def __init__(self, max_keys: int = 1000):
+        """
+        :param max_keys: Versions of the oldest keys are forgotten past this, their
+            watchers see one more change
+        """
+        self._condition = threading.Condition()
+        self._versions = LimitedDict(max_keys)
+
+    def version(self, key: str) -> int:
+        with self._condition:
+            return self._versions.get(key, 0)
+
+    def changed(self, key: str) -> None:
+        with self._condition:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._versions.move_to_end(key)
+            self._condition.notify_all()
+
+    def wait(self, key: str, version: int, timeout: float | None = None) -> int:
+        """
+        Waits until ``key`` changes from ``version``, at most ``timeout`` seconds.
+
+        :returns: The current version of the key, ``version`` if it did not change
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._versions.get(key, 0) != version, timeout
+            )
+            return self._versions.get(key, 0)
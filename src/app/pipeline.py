@@ -0,0 +1,411 @@
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from csv_to_rerun import csv_to_rerun
+from known_to_influxdb import line_protocol, write_to_influxDB
+from known_to_pyramid import pyramid
+from raw_to_unknown import deserializer
+from unknown_to_known import decode, known_file
+from unknown_to_known.clock_alignment import ClockMapping
+from constants import *
+from . import metrics, sessions
+from .models import ConversionProgress, StageStatus
+
+"""
+Runs the conversion of one file as a small graph of stages. A stage starts once
+every stage it depends on is done, so independent branches (InfluxDB and Rerun)
+run at the same time, and a failed stage only skips the stages that depend on it.
+
+CPU heavy stages run in a process pool, the others on threads. Stage functions
+only take paths so they can be sent to a worker process. They also take a
+``report`` callback for their progress, which reaches run_stages through a small
+file, and return counts of the rows and bytes they processed.
+"""
+
+STAGE_THREADS = 4
+STAGE_PROCESSES = CONVERSION_WORKERS
+# Seconds between progress updates of a running stage
+PROGRESS_INTERVAL = 0.5
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable
+    args: tuple = ()
+    depends_on: tuple[str, ...] = ()
+    # Run in the process pool instead of on a thread
+    in_process: bool = False
+    # Added to ConversionProgress.progress as the stage progresses
+    weight: float = 0
+    # Written when the stage succeeds, the stage is not run again while it exists
+    marker: Path | None = None
+
+
+_thread_pool = ThreadPoolExecutor(STAGE_THREADS, thread_name_prefix="stage")
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = threading.Lock()
+
+
+def process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Forking a process running flask threads is unsafe, start clean workers
+            _process_pool = ProcessPoolExecutor(
+                STAGE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+# === INSTRUMENTATION ===
+
+
+class ProgressFile:
+    """
+    Progress callback of a stage, usable from a worker process. Writes what was
+    processed and the total to ``path`` at most every ``interval`` seconds.
+    """
+
+    def __init__(self, path: str, interval: float = PROGRESS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._last = 0.0
+
+    def __call__(self, done: int, total: int) -> None:
+        now = time.monotonic()
+        if total <= 0 or (done < total and now - self._last < self.interval):
+            return
+        self._last = now
+
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write(f"{min(done, total)} {total}")
+        os.replace(temporary, self.path)
+
+
+def _read_progress(path: str) -> tuple[int, int] | None:
+    """
+    :returns: What a ProgressFile last wrote, None before it wrote anything
+    """
+    try:
+        with open(path) as file:
+            done, total = map(int, file.read().split())
+        return done, total
+    except (OSError, ValueError):
+        return None
+
+
+def _resident_memory() -> int | None:
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemorySampler:
+    """
+    Peak resident memory of this process while in the with block, sampled every
+    ``interval`` seconds. Falls back to the peak since the process started where
+    /proc is not available.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while True:
+            resident = _resident_memory()
+            if resident is None:
+                return
+            self.peak = max(self.peak, resident)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        if self.peak == 0:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclass
+class StageResult:
+    started: float
+    ended: float
+    peak_memory: int
+    counts: dict
+
+
+def _run_instrumented(
+    function: Callable, args: tuple, progress_path: str
+) -> StageResult:
+    """
+    Runs a stage function where the stage is executed, timing it. Memory is that of
+    the whole process, so it is only the stage's own in a process pool worker.
+    """
+    started = time.time()
+    with MemorySampler() as memory:
+        counts = function(*args, report=ProgressFile(progress_path)) or {}
+    return StageResult(started, time.time(), memory.peak, counts)
+
+
+def run_stages(stages: list[Stage], progress: ConversionProgress) -> bool:
+    """
+    Runs stages in dependency order, recording their status in ``progress``. The
+    first failure is also kept in ``progress.exception``.
+
+    ``progress.progress`` advances by each stage's weight times the fraction of its
+    input processed, and finished stages are recorded in metrics. progress.changed()
+    is called whenever a stage starts, progresses or finishes.
+
+    :returns: Whether every stage succeeded
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = set(stage.depends_on) - by_name.keys()
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown {missing}")
+        progress.stages[stage.name] = StageStatus()
+
+    initial_progress = progress.progress
+
+    def update_progress():
+        progress.progress = initial_progress + sum(
+            stage.weight * progress.stages[stage.name].fraction for stage in stages
+        )
+        progress.changed()
+
+    running = {}
+    with tempfile.TemporaryDirectory(prefix="progress") as progress_dir:
+
+        def progress_path(stage: Stage) -> str:
+            return os.path.join(progress_dir, stage.name)
+
+        # Whether a stage changed since progress was last updated
+        updated = True
+        while True:
+            # Stages finished by a previous run can unblock others right away
+            changed = True
+            while changed:
+                changed = False
+                for stage in stages:
+                    status = progress.stages[stage.name]
+                    if status.state != StageStatus.PENDING:
+                        continue
+
+                    states = {progress.stages[name].state for name in stage.depends_on}
+                    if states & {StageStatus.FAILED, StageStatus.SKIPPED}:
+                        status.state = StageStatus.SKIPPED
+                        metrics.stages.observe(stage.name, status)
+                        changed = updated = True
+                    elif not states <= {StageStatus.DONE}:
+                        continue
+                    elif stage.marker is not None and stage.marker.exists():
+                        status.state = StageStatus.DONE
+                        status.cached = True
+                        status.fraction = 1
+                        metrics.stages.observe(stage.name, status)
+                        changed = updated = True
+                    else:
+                        executor: Executor = (
+                            process_pool() if stage.in_process else _thread_pool
+                        )
+                        future = executor.submit(
+                            _run_instrumented,
+                            stage.function,
+                            stage.args,
+                            progress_path(stage),
+                        )
+                        running[future] = stage
+                        status.state = StageStatus.RUNNING
+                        status.started = time.time()
+                        updated = True
+            if updated:
+                update_progress()
+                updated = False
+
+            if not running:
+                break
+
+            done, _ = wait(
+                running, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                updated = True
+                stage = running.pop(future)
+                status = progress.stages[stage.name]
+                exception = future.exception()
+                if exception is None:
+                    if stage.marker is not None:
+                        stage.marker.touch()
+                    result: StageResult = future.result()
+                    status.state = StageStatus.DONE
+                    status.fraction = 1
+                    if status.total is not None:
+                        status.done = status.total
+                    status.started = result.started
+                    status.ended = result.ended
+                    status.peak_memory = result.peak_memory
+                    status.rows = result.counts.get("rows")
+                    status.bytes_in = result.counts.get("bytes_in")
+                    status.bytes_out = result.counts.get("bytes_out")
+                    status.worker_peak_memory = result.counts.get("worker_peak_memory")
+                else:
+                    status.state = StageStatus.FAILED
+                    status.ended = time.time()
+                    status.exception = exception
+                    if progress.exception is None:
+                        progress.exception = exception
+                metrics.stages.observe(stage.name, status)
+
+            for stage in running.values():
+                status = progress.stages[stage.name]
+                read = _read_progress(progress_path(stage))
+                if read is not None and read != (status.done, status.total):
+                    status.done, status.total = read
+                    status.fraction = status.done / status.total
+                    updated = True
+
+    return all(status.state == StageStatus.DONE for status in progress.stages.values())
+
+
+# === STAGES ===
+
+
+def _size(path: str) -> int | None:
+    try:
+        if os.path.isdir(path):
+            # Wide known files
+            return sum(entry.stat().st_size for entry in os.scandir(path))
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def decode_stage(
+    raw_path: str,
+    known_path: str,
+    dbc_name: str | None,
+    unknown_path: str | None = None,
+    csv_path: str | None = None,
+    log_path: str | None = None,
+    summary_path: str | None = None,
+    report=None,
+) -> dict:
+    if unknown_path is not None:
+        deserializer.deserialize(raw_path, unknown_path)
+
+    # Large logs are split over this job's share of DECODE_WORKERS, see constants
+    stats = decode.make_known_sharded(
+        raw_path,
+        csv_path,
+        log_path,
+        dbc_name=dbc_name,
+        parquet_file_name=known_path,
+        workers=DECODE_WORKERS_PER_JOB,
+        report=report,
+    )
+    if summary_path is not None:
+        with open(summary_path, "w") as file:
+            json.dump(sessions.summarize(stats, dbc_name), file)
+
+    return {
+        "rows": known_file.row_count(known_path),
+        "bytes_in": _size(raw_path),
+        "bytes_out": _size(known_path),
+        "worker_peak_memory": stats.worker_peak_memory,
+    }
+
+
+def _session_clock(summary_path: str) -> ClockMapping:
+    """
+    Mapping to Unix time found by the decode stage, see decode_stage.
+    """
+    with open(summary_path) as file:
+        clock = json.load(file)["clock"]
+    if clock is None:
+        raise ValueError("The log has no usable Date/Time values to get Unix time from")
+    return ClockMapping.from_dict(clock)
+
+
+def influxdb_stage(
+    known_path: str, summary_path: str, line_path: str | None = None, report=None
+) -> dict:
+    # Encoding runs here, the HTTP writes on the writer's threads
+    written = write_to_influxDB.stream_to_influxDB(
+        line_protocol.iter_lineprotocol(
+            known_path, clock=_session_clock(summary_path), report=report
+        ),
+        archive_path=line_path,
+    )
+    return {
+        "rows": known_file.row_count(known_path),
+        "bytes_in": _size(known_path),
+        "bytes_out": written,
+    }
+
+
+def downsample_stage(known_path: str, pyramid_path: str, report=None) -> dict:
+    pyramid.build_pyramid(known_path, pyramid_path, report=report)
+    return {
+        "rows": known_file.row_count(known_path),
+        "bytes_in": _size(known_path),
+        "bytes_out": _size(pyramid_path),
+    }
+
+
+def downsampled_influxdb_stage(
+    pyramid_path: str, summary_path: str, report=None
+) -> dict:
+    written = write_to_influxDB.stream_to_influxDB(
+        pyramid.iter_pyramid_lineprotocol(
+            pyramid_path, _session_clock(summary_path), report=report
+        ),
+        config=write_to_influxDB.downsampled_config(),
+    )
+    return {
+        "rows": known_file.row_count(pyramid_path),
+        "bytes_in": _size(pyramid_path),
+        "bytes_out": written,
+    }
+
+
+def rerun_stage(
+    known_path: str, output_dir: str, recording_name: str, report=None
+) -> dict:
+    csv_to_rerun.convert(
+        Path(known_path),
+        Path(output_dir),
+        recording_name=recording_name,
+        report=report,
+    )
+    return {
+        "rows": known_file.row_count(known_path),
+        "bytes_in": _size(known_path),
+        "bytes_out": _size(str(Path(output_dir) / (Path(known_path).stem + ".rrd"))),
+    }
@@ -0,0 +1,263 @@
+import json
+import sqlite3
+import time
+
+from contextlib import closing
+
+from constants import *
+from unknown_to_known import dbc_cache
+from unknown_to_known.clock_alignment import ClockMapping
+from unknown_to_known.session_stats import SessionStats
+
+"""
+Index of converted logs (sessions) in a SQLite database under DATA_DIR.
+
+The decode stage summarises each log while decoding it (see SessionStats), and
+the summary is added here once the stage is done. Sessions can then be found by
+date, time range or sensor without opening any known or .rrd file.
+
+A session is identified by its conversion key, so converting the same file with
+the same DBC again updates its entry instead of adding one. It keeps the mapping
+of its logger timestamps to Unix time (see clock_alignment), None when the log
+has no usable clock.
+"""
+
+MAX_PAGE_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    converted REAL NOT NULL,
+    dbc_name TEXT,
+    dbc_sha256 TEXT,
+    dbc_version TEXT,
+    frames INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    start_ms INTEGER,
+    end_ms INTEGER,
+    start_time REAL,
+    end_time REAL,
+    can_ids TEXT NOT NULL,
+    clock TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_start_time ON sessions (start_time);
+CREATE TABLE IF NOT EXISTS session_sensors (
+    session_id TEXT NOT NULL,
+    sensor TEXT NOT NULL,
+    unit TEXT,
+    count INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    PRIMARY KEY (session_id, sensor)
+);
+CREATE INDEX IF NOT EXISTS session_sensors_sensor ON session_sensors (sensor);
+"""
+
+_COLUMNS = (
+    "id, filename, converted, dbc_name, dbc_sha256, dbc_version, frames, rows, "
+    "start_ms, end_ms, start_time, end_time, can_ids, clock"
+)
+
+
+def summarize(stats: SessionStats, dbc_name: str | None = None) -> dict:
+    """
+    Summary of a decoded log as stored in the index, JSON serializable.
+
+    :param dbc_name: File name of the DBC the log was decoded with
+    """
+    compiled = dbc_cache.load_dbc(dbc_name)
+    summary = stats.to_dict()
+    summary["dbc"] = {
+        "name": compiled.name,
+        "sha256": compiled.digest,
+        "version": compiled.db.version or None,
+    }
+    return summary
+
+
+def _session(row) -> dict:
+    (
+        session_id,
+        filename,
+        converted,
+        dbc_name,
+        dbc_sha256,
+        dbc_version,
+        frames,
+        rows,
+        start_ms,
+        end_ms,
+        start_time,
+        end_time,
+        can_ids,
+        clock,
+    ) = row
+    return {
+        "id": session_id,
+        "filename": filename,
+        "converted": converted,
+        "dbc": {"name": dbc_name, "sha256": dbc_sha256, "version": dbc_version},
+        "frames": frames,
+        "rows": rows,
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+        "start_time": start_time,
+        "end_time": end_time,
+        "can_ids": json.loads(can_ids),
+        "clock": None if clock is None else json.loads(clock),
+    }
+
+
+class SessionIndex:
+    def __init__(self, path=SESSIONS_DB):
+        """
+        :param path: SQLite database file
+        """
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def add(self, session_id: str, filename: str, summary: dict) -> None:
+        """
+        Adds or replaces a session.
+
+        :param session_id: Conversion key of the log
+        :param filename: Name of the uploaded file
+        :param summary: See summarize
+        """
+        start_time = end_time = None
+        if summary["clock"] is not None and summary["start"] is not None:
+            clock = ClockMapping.from_dict(summary["clock"])
+            start_time, end_time = (
+                clock.to_unix([summary["start"], summary["end"]]) / 1000
+            ).tolist()
+
+        with closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                f"INSERT OR REPLACE INTO sessions ({_COLUMNS}) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session_id,
+                    filename,
+                    time.time(),
+                    summary["dbc"]["name"],
+                    summary["dbc"]["sha256"],
+                    summary["dbc"]["version"],
+                    summary["frames"],
+                    summary["rows"],
+                    summary["start"],
+                    summary["end"],
+                    start_time,
+                    end_time,
+                    json.dumps(summary["can_ids"]),
+                    json.dumps(summary["clock"]),
+                ),
+            )
+            connection.execute(
+                "DELETE FROM session_sensors WHERE session_id = ?", (session_id,)
+            )
+            connection.executemany(
+                "INSERT INTO session_sensors "
+                "(session_id, sensor, unit, count, min, max) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        session_id,
+                        sensor,
+                        stats["unit"],
+                        stats["count"],
+                        stats["min"],
+                        stats["max"],
+                    )
+                    for sensor, stats in summary["sensors"].items()
+                ],
+            )
+            connection.execute("COMMIT")
+
+    def query(
+        self,
+        start: float | None = None,
+        end: float | None = None,
+        sensors: list[str] = (),
+        limit: int = 50,
+        offset: int = 0,
+    ) -> tuple[int, list[dict]]:
+        """
+        Sessions matching every filter given, latest first.
+
+        :param start: Unix time in seconds, sessions ending before it are left out
+        :param end: Unix time in seconds, sessions starting after it are left out
+        :param sensors: Names of sensors that must all have values in the session
+        :param limit: Number of sessions returned, at most MAX_PAGE_SIZE
+        :param offset: Number of matching sessions skipped
+        :returns: Number of matching sessions and the requested page of them
+        """
+        conditions, parameters = [], []
+        if start is not None:
+            conditions.append("end_time >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("start_time <= ?")
+            parameters.append(end)
+        for sensor in sensors:
+            conditions.append(
+                "id IN (SELECT session_id FROM session_sensors "
+                "WHERE sensor = ? AND count > 0)"
+            )
+            parameters.append(sensor)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with closing(self._connect()) as connection:
+            (total,) = connection.execute(
+                f"SELECT COUNT(*) FROM sessions {where}", parameters
+            ).fetchone()
+            rows = connection.execute(
+                f"SELECT {_COLUMNS} FROM sessions {where} "
+                f"ORDER BY COALESCE(start_time, converted) DESC, id LIMIT ? OFFSET ?",
+                [*parameters, min(max(limit, 0), MAX_PAGE_SIZE), max(offset, 0)],
+            ).fetchall()
+        return total, [_session(row) for row in rows]
+
+    def get(self, session_id: str) -> dict | None:
+        """
+        :returns: The session with the stats of each of its sensors
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                f"SELECT {_COLUMNS} FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            sensors = connection.execute(
+                "SELECT sensor, unit, count, min, max FROM session_sensors "
+                "WHERE session_id = ? ORDER BY sensor",
+                (session_id,),
+            ).fetchall()
+
+        session = _session(row)
+        session["sensors"] = {
+            sensor: {"unit": unit, "count": count, "min": low, "max": high}
+            for sensor, unit, count, low, high in sensors
+        }
+        return session
+
+    def sensors(self) -> list[dict]:
+        """
+        :returns: Every sensor with values in some session, with its number of sessions
+        """
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT sensor, MAX(unit), COUNT(*) FROM session_sensors "
+                "WHERE count > 0 GROUP BY sensor ORDER BY sensor"
+            ).fetchall()
+        return [
+            {"sensor": sensor, "unit": unit, "sessions": sessions}
+            for sensor, unit, sessions in rows
+        ]
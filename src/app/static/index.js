@@ -2,7 +2,7 @@ const dropZone = document.getElementById('dropZone');
 const fileInput = document.getElementById('fileInput');
 const alertContainer = document.getElementById('alertContainer');
 
-let pollIntervalId = null;
+let progressSource = null;
 
 dropZone.addEventListener('click', () => fileInput.click());
 
@@ -45,11 +45,8 @@ function handleFiles(files) {
   // Clear previous alerts
   alertContainer.innerHTML = '';
 
-  // Stop any previous polling loop
-  if (pollIntervalId !== null) {
-    clearInterval(pollIntervalId);
-    pollIntervalId = null;
-  }
+  // Stop watching any previous upload
+  stopWatching();
 
   showAlert('Uploading file(s) and starting conversion…', 'info');
 
@@ -69,8 +66,8 @@ function handleFiles(files) {
           throw new Error('Server did not return a task name.');
         }
 
-        // Start polling /progress with this task name
-        startPolling(taskName);
+        // Follow the progress of this task as the server pushes it
+        watchProgress(taskName);
       })
       .catch((error) => {
         console.error(error);
@@ -78,55 +75,68 @@ function handleFiles(files) {
       });
 }
 
-function startPolling(taskName) {
-  if (pollIntervalId !== null) {
-    clearInterval(pollIntervalId);
+function stopWatching() {
+  if (progressSource !== null) {
+    progressSource.close();
+    progressSource = null;
   }
+}
 
-  updateProgressDisplay(0);
+function watchProgress(taskName) {
+  stopWatching();
 
-  pollIntervalId = setInterval(async () => {
-    try {
-      const response =
-          await fetch(`/progress?name=${encodeURIComponent(taskName)}`);
+  updateProgressDisplay(0, []);
 
-      if (!response.ok) {
-        if (response.status === 404) {
-          throw new Error('Task not found on server.');
-        }
-        throw new Error('Failed to get progress from server.');
-      }
+  const source =
+      new EventSource(`/progress/stream?name=${encodeURIComponent(taskName)}`);
+  progressSource = source;
 
-      const data = await response.json();
+  source.addEventListener('progress', (e) => {
+    const data = JSON.parse(e.data);
+    const progress = typeof data.progress === 'number' ? data.progress : 0;
 
-      if (data.exception.present) {
-        clearInterval(pollIntervalId);
-        pollIntervalId = null;
-        return showAlert(`Error: ${data.exception.type}`, 'danger');
+    // Stages running right now, with how far into their input they are
+    const running = [];
+    for (const job of data.jobs) {
+      for (const [name, stage] of Object.entries(job.stages)) {
+        if (stage.state === 'running') {
+          running.push(`${name} ${Math.round(stage.progress)}%`);
+        }
       }
+    }
 
-      const progress = typeof data.progress === 'number' ? data.progress : 0;
+    updateProgressDisplay(progress, running);
+  });
 
-      updateProgressDisplay(progress);
+  source.addEventListener('failure', (e) => {
+    const data = JSON.parse(e.data);
+    stopWatching();
+    showAlert(`Error: ${data.exception}`, 'danger');
+  });
 
-      if (progress >= 100) {
-        clearInterval(pollIntervalId);
-        pollIntervalId = null;
-        showAlert('Upload and processing complete!', 'success');
-        loadFiles();
-      }
-    } catch (err) {
-      console.error(err);
-      clearInterval(pollIntervalId);
-      pollIntervalId = null;
+  source.addEventListener('done', (e) => {
+    const data = JSON.parse(e.data);
+    stopWatching();
+    if (data.exception.present) {
+      return showAlert(`Error: ${data.exception.type}`, 'danger');
+    }
+    showAlert('Upload and processing complete!', 'success');
+    loadFiles();
+  });
+
+  // Dropped connections are retried by the browser, a refused one is closed
+  source.onerror = () => {
+    if (source.readyState === EventSource.CLOSED) {
+      stopWatching();
       showAlert('Error while checking progress.', 'danger');
     }
-  }, 500);
+  };
 }
 
-function updateProgressDisplay(percent) {
-  const clamped = Math.min(Math.max(percent, 0), 100);
-  showAlert(`Processing: ${clamped}%`, 'info');
+function updateProgressDisplay(percent, running) {
+  const clamped = Math.min(Math.max(Math.round(percent), 0), 100);
+  const stages = running.length > 0 ? ` (${running.join(', ')})` : '';
+  showAlert(`Processing: ${clamped}%${stages}`, 'info');
 }
 
 function showAlert(message, type) {
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks.synthetic_log import write_synthetic_log
+from raw_to_unknown import deserializer
+from unknown_to_known import decode
+
+"""
+Measures decoding throughput of make_known_sharded against the number of worker
+processes, on a synthetic log or a real one. Worker process start up is included
+in the times, as it is for a conversion.
+
+    python -m benchmarks.decode_benchmark --frames 5000000 --workers 1,2,4,8
+    python -m benchmarks.decode_benchmark --data /data/session.data
+"""
+
+
+def count_frames(path: str) -> int:
+    return sum(len(frames) for frames in deserializer.iter_frames(path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2_000_000)
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--dbc", default=None, help="DBC in DBC_DIR")
+    parser.add_argument("--data", default=None, help="Raw .data file to decode")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        raw_path = args.data
+        if raw_path is None:
+            raw_path = os.path.join(directory, "synthetic.data")
+            write_synthetic_log(raw_path, args.frames, args.dbc)
+        frame_count = count_frames(raw_path)
+        size = os.path.getsize(raw_path)
+
+        results = []
+        reference = None
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            parquet_path = os.path.join(directory, f"known_{workers}.parquet")
+            start = time.perf_counter()
+            decode.make_known_sharded(
+                raw_path,
+                None,
+                dbc_name=args.dbc,
+                parquet_file_name=parquet_path,
+                workers=workers,
+                # Shard by worker count only, whatever the file size
+                min_shard_size=1,
+            )
+            seconds = time.perf_counter() - start
+
+            known = pd.read_parquet(parquet_path)
+            if reference is None:
+                reference = known
+            results.append(
+                {
+                    "workers": workers,
+                    "seconds": round(seconds, 3),
+                    "frames_per_second": round(frame_count / seconds),
+                    "same_output": known.equals(reference),
+                }
+            )
+            os.remove(parquet_path)
+
+    baseline = results[0]["seconds"]
+    for result in results:
+        result["speedup"] = round(baseline / result["seconds"], 2)
+
+    print(
+        json.dumps(
+            {
+                "frames": frame_count,
+                "bytes": size,
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
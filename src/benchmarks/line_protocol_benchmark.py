@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from known_to_influxdb import convert_unix_time, line_protocol
+from unknown_to_known import known_file
+
+"""
+Times the streaming line protocol conversion against the previous implementation,
+which wrote a _unixtime copy, deduplicated the whole file in memory, rewrote it and
+read it back in chunks. For csv input the legacy path re-parses floats it wrote
+itself, so a few values differ in the last digit and same_output is false.
+
+    python -m benchmarks.line_protocol_benchmark --rows 2000000 --format parquet
+"""
+
+SENSORS = [
+    "Date",
+    "Time",
+    "RPM",
+    "Temp",
+    "Current",
+    "Latitude",
+    "Longitude",
+    "Pressure",
+]
+UNITS = ["", "", "rpm", "degC", "A", "deg", "deg", "kPa"]
+
+
+def make_known_file(path: str, rows: int, duplicate_fraction: float = 0.01) -> None:
+    """
+    Writes a synthetic known file with Date/Time rows and some repeated rows.
+    """
+    rng = np.random.default_rng(0)
+    sensor_codes = np.arange(rows) % len(SENSORS)
+    values = rng.normal(size=rows) * 100
+    values[sensor_codes == 0] = 60525
+    values[sensor_codes == 1] = 123045000
+    df = pd.DataFrame(
+        {
+            "Timestamp": np.arange(rows, dtype=np.int64) // len(SENSORS),
+            "CANID": (100 + sensor_codes // 2).astype(np.int32),
+            "Sensor": pd.Categorical.from_codes(sensor_codes, SENSORS),
+            "Value": values,
+            "Unit": pd.Categorical(np.array(UNITS, dtype=object)[sensor_codes]),
+        }
+    )
+
+    # Repeat some rows right after themselves, like a logger re-sending frames
+    repeats = np.sort(rng.choice(rows, int(rows * duplicate_fraction), replace=False))
+    df = pd.concat([df, df.iloc[repeats]]).sort_index(kind="stable")
+
+    if known_file.is_parquet(path):
+        with known_file.KnownWriter(path) as writer:
+            for start in range(0, len(df), known_file.CHUNK_SIZE):
+                writer.write(df.iloc[start : start + known_file.CHUNK_SIZE])
+    else:
+        df.to_csv(path, index=False)
+
+
+def legacy_convert_to_lineprotocol(FILE_NAME: str, FILE_OUTPUT: str):
+    FILE_NAME_BASE, ending = os.path.splitext(FILE_NAME)
+    FILE_NAME_UNIX = FILE_NAME_BASE + "_unixtime" + ending
+    convert_unix_time.convert_to_unix(FILE_NAME, FILE_NAME_UNIX)
+
+    with open(FILE_OUTPUT, "w", encoding="utf-8", newline="\n") as out:
+        df = known_file.read_known(FILE_NAME_UNIX)
+        df = df.drop_duplicates()
+        if known_file.is_parquet(FILE_NAME_UNIX):
+            with known_file.KnownWriter(FILE_NAME_UNIX) as writer:
+                writer.write(df)
+        else:
+            df.to_csv(FILE_NAME_UNIX, mode="w", index=False)
+        del df
+        for chunk in known_file.iter_known(
+            FILE_NAME_UNIX,
+            columns=["Timestamp", "CANID", "Sensor", "Value"],
+        ):
+            chunk = chunk[chunk["Value"].notna() & (chunk["Sensor"] != "")]
+            lines = (
+                chunk["Sensor"].astype(str).map(line_protocol.esc_measure)
+                + ",tag1="
+                + chunk["CANID"].astype(str).map(line_protocol.esc_tag)
+                + " field1="
+                + chunk["Value"].astype(str)
+                + " "
+                + chunk["Timestamp"].astype(str)
+            )
+            out.write("\n".join(lines) + "\n")
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        known_path = os.path.join(directory, f"known.{args.format}")
+        make_known_file(known_path, args.rows)
+
+        legacy_path = os.path.join(directory, "legacy.line")
+        streaming_path = os.path.join(directory, "streaming.line")
+        legacy = timed(legacy_convert_to_lineprotocol, known_path, legacy_path)
+        # Legacy tag/field keys so the outputs can be compared
+        streaming = timed(
+            lambda: line_protocol.convert_to_lineprotocol(
+                known_path, streaming_path, tag_key="tag1", field_key="field1"
+            )
+        )
+
+        with open(legacy_path) as legacy_file, open(streaming_path) as streaming_file:
+            same_output = legacy_file.read() == streaming_file.read()
+
+    print(
+        json.dumps(
+            {
+                "rows": args.rows,
+                "format": args.format,
+                "legacy_s": round(legacy, 3),
+                "streaming_s": round(streaming, 3),
+                "speedup": round(legacy / streaming, 2),
+                "same_output": same_output,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from benchmarks.synthetic_log import write_synthetic_log
+from constants import DBC_DIR
+from csv_to_rerun import csv_to_rerun
+from known_to_influxdb import line_protocol
+from known_to_pyramid import pyramid
+from raw_to_unknown import deserializer
+from unknown_to_known import decode
+
+"""
+Runs every stage of the pipeline, then the whole of app.convert_file, on a
+synthetic log and prints JSON with wall time, frames/sec, peak RSS and output
+size per stage, for comparing runs before and after a change.
+
+Each stage runs in a fresh process so its peak RSS is its own. The full pipeline
+runs against a scratch DATA_DIR and writes to a local endpoint that accepts and
+discards line protocol, unless --influx-url is given (with INFLUXDB_ORG,
+INFLUXDB_TOKEN and INFLUXDB_BUCKET set).
+
+    python -m benchmarks.pipeline_benchmark --frames 2000000 --strings 0.01 --unknown 0.02
+"""
+
+
+class NullInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _size(*paths) -> int:
+    size = 0
+    for path in paths:
+        if os.path.isdir(path):
+            size += sum(entry.stat().st_size for entry in os.scandir(path))
+        elif os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
+
+
+# === STAGES ===
+# Run in a worker process, each returns its output size
+
+
+def stage_deserialize(raw_path: str, directory: str) -> int:
+    for _ in deserializer.iter_frames(raw_path):
+        pass
+    return 0
+
+
+def stage_decode(raw_path: str, directory: str) -> int:
+    parquet_path = os.path.join(directory, "known.parquet")
+    decode.make_known(
+        deserializer.iter_frames(raw_path), None, parquet_file_name=parquet_path
+    )
+    return _size(parquet_path)
+
+
+def stage_decode_wide(raw_path: str, directory: str) -> int:
+    wide_path = os.path.join(directory, "known.wide")
+    decode.make_known(
+        deserializer.iter_frames(raw_path), None, parquet_file_name=wide_path
+    )
+    return _size(wide_path)
+
+
+def stage_decode_sharded(raw_path: str, directory: str) -> int:
+    parquet_path = os.path.join(directory, "known_sharded.parquet")
+    decode.make_known_sharded(raw_path, None, parquet_file_name=parquet_path)
+    return _size(parquet_path)
+
+
+def stage_line_protocol(raw_path: str, directory: str) -> int:
+    line_path = os.path.join(directory, "known.line")
+    line_protocol.convert_to_lineprotocol(
+        os.path.join(directory, "known.parquet"), line_path
+    )
+    return _size(line_path)
+
+
+def stage_rerun(raw_path: str, directory: str) -> int:
+    csv_to_rerun.convert(
+        Path(directory) / "known.parquet", Path(directory), time_window=None
+    )
+    return _size(os.path.join(directory, "known.rrd"))
+
+
+def stage_downsample(raw_path: str, directory: str) -> int:
+    pyramid_path = os.path.join(directory, "known.pyramid.parquet")
+    pyramid.build_pyramid(os.path.join(directory, "known.parquet"), pyramid_path)
+    return _size(pyramid_path)
+
+
+def stage_convert_file(raw_path: str, directory: str) -> int:
+    # Imported here, DATA_DIR points at the scratch directory in this process only
+    from app import app as web
+    from app import pipeline
+    from app.models import ConversionProgress
+
+    web.open_stores()
+    progress = ConversionProgress(name="benchmark")
+    try:
+        web.convert_file(Path(raw_path), "benchmark.data", progress)
+    finally:
+        pipeline.process_pool().shutdown()
+    if progress.exception is not None:
+        raise progress.exception
+
+    return _size(
+        web.CSV_DIR / web.KNOWN_FILENAME.format("benchmark.data"),
+        web.CSV_DIR / web.WIDE_KNOWN_FILENAME.format("benchmark.data"),
+        web.RERUN_DIR / web.RERUN_FILENAME.format("benchmark.data"),
+        web.CSV_DIR / web.PYRAMID_FILENAME.format("benchmark.data"),
+    )
+
+
+STAGES = {
+    "deserialize": stage_deserialize,
+    "decode": stage_decode,
+    "decode_wide": stage_decode_wide,
+    "decode_sharded": stage_decode_sharded,
+    "line_protocol": stage_line_protocol,
+    "rerun": stage_rerun,
+    "downsample": stage_downsample,
+    "convert_file": stage_convert_file,
+}
+
+
+def _run_stage(name: str, raw_path: str, directory: str) -> dict:
+    start = time.perf_counter()
+    try:
+        output_bytes = STAGES[name](raw_path, directory)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux, children are the stage's own worker processes
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "output_bytes": output_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=1_000_000)
+    parser.add_argument("--dbc", default=None, help="DBC in DBC_DIR")
+    parser.add_argument("--messages", default=None, help="Comma separated names")
+    parser.add_argument("--strings", type=float, default=0.01)
+    parser.add_argument("--unknown", type=float, default=0.02)
+    parser.add_argument("--corrupt", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--influx-url", default=None)
+    parser.add_argument(
+        "--layout", choices=("long", "wide"), default="long", help="For convert_file"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        raw_path = os.path.join(directory, "synthetic.data")
+        log = write_synthetic_log(
+            raw_path,
+            args.frames,
+            dbc_name=args.dbc,
+            seed=args.seed,
+            message_names=args.messages.split(",") if args.messages else None,
+            string_fraction=args.strings,
+            unknown_fraction=args.unknown,
+            corrupt=args.corrupt,
+        )
+
+        # Scratch DATA_DIR for convert_file, sharing the real DBC files
+        data_dir = Path(directory) / "data"
+        data_dir.mkdir()
+        (data_dir / DBC_DIR.name).symlink_to(DBC_DIR.resolve())
+        # Read by constants when the stage processes start
+        environment = {"DATA_DIR": str(data_dir), "KNOWN_LAYOUT": args.layout}
+
+        server = None
+        if args.influx_url is None:
+            server = ThreadingHTTPServer(("127.0.0.1", 0), NullInfluxHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            environment.update(
+                INFLUXDB_URL=f"http://127.0.0.1:{server.server_port}",
+                INFLUXDB_ORG="benchmark",
+                INFLUXDB_TOKEN="benchmark",
+            )
+        else:
+            environment["INFLUXDB_URL"] = args.influx_url
+        os.environ.update(environment)
+
+        stages = {}
+        for name in args.stages.split(","):
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                result = pool.submit(_run_stage, name, raw_path, directory).result()
+            if "seconds" in result:
+                result["frames_per_second"] = round(log["frames"] / result["seconds"])
+            stages[name] = result
+
+        if server is not None:
+            server.shutdown()
+
+    print(
+        json.dumps(
+            {
+                "input": log,
+                "cpu_count": os.cpu_count(),
+                "stages": stages,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import numpy as np
+
+from raw_to_unknown.deserializer import CAN_HEADER_LENGTH, STRING_LENGTH_OFFSET
+from unknown_to_known import dbc_cache
+
+"""
+Writes synthetic raw .data logs from the messages of a DBC, for benchmarks.
+
+CAN records carry random payloads, except that messages with Date or Time signals
+get a plausible GPS clock (DDMMYY and HHMMSSsss) so the Unix time conversion works.
+String records, frames with IDs missing from the DBC and a truncated last record
+can be mixed in.
+"""
+
+# Frames logged per millisecond
+FRAMES_PER_MS = 8
+# 12:00:00 on 18/10/26
+START_DATE = 181026
+START_SECONDS = 12 * 3600
+
+MAX_STRING_LENGTH = 255 - STRING_LENGTH_OFFSET
+UNKNOWN_ID_OFFSET = 0x700
+
+
+def _clock_payloads(message, seconds: np.ndarray) -> np.ndarray:
+    """
+    Encodes one payload per second of the log for a message with Date/Time signals.
+    """
+    payloads = np.zeros((len(seconds), message.length), dtype=np.uint8)
+    for i, second in enumerate(seconds.tolist()):
+        second = START_SECONDS + second
+        clock = (second // 3600 % 24) * 10000 + (second // 60 % 60) * 100 + second % 60
+        values = {signal.name: 0 for signal in message.signals}
+        values.update(
+            {
+                name: value
+                for name, value in (("Date", START_DATE), ("Time", clock * 1000))
+                if name in values
+            }
+        )
+        encoded = message.encode(values, strict=False)
+        payloads[i] = np.frombuffer(encoded, dtype=np.uint8)
+    return payloads
+
+
+def write_synthetic_log(
+    path: str,
+    frame_count: int,
+    dbc_name: str | None = None,
+    seed: int = 0,
+    message_names: list[str] | None = None,
+    string_fraction: float = 0.0,
+    unknown_fraction: float = 0.0,
+    corrupt: bool = False,
+) -> dict:
+    """
+    Writes ``frame_count`` CAN records of messages from the DBC, with increasing
+    timestamps.
+
+    :param path: Raw .data file to write
+    :param dbc_name: File name of the DBC in DBC_DIR, defaults to DEFAULT_DBC
+    :param message_names: Messages to draw frames from, defaults to all of them
+    :param string_fraction: String records added per CAN record
+    :param unknown_fraction: Fraction of CAN records with an ID not in the DBC
+    :param corrupt: End the file with a truncated record
+    :returns: Number of CAN records, string records and bytes written
+    """
+    rng = np.random.default_rng(seed)
+    messages = [
+        message
+        for message in dbc_cache.load_dbc(dbc_name).db.messages
+        if message.length <= 255
+        and (message_names is None or message.name in message_names)
+    ]
+    if not messages:
+        raise ValueError("No messages to generate frames from")
+
+    message_ids = np.array([message.frame_id for message in messages], dtype=np.uint32)
+    message_lengths = np.array([message.length for message in messages], dtype=np.int64)
+
+    # === CAN RECORDS ===
+    choice = rng.integers(0, len(messages), frame_count)
+    can_ids = message_ids[choice]
+    lengths = message_lengths[choice]
+    unknown = rng.random(frame_count) < unknown_fraction
+    can_ids[unknown] = (
+        UNKNOWN_ID_OFFSET + message_ids.max() + rng.integers(0, 16, unknown.sum())
+    )
+    lengths[unknown] = rng.integers(0, 9, unknown.sum())
+    timestamps = np.arange(frame_count) // FRAMES_PER_MS
+
+    # === INTERLEAVED STRING RECORDS ===
+    string_count = int(frame_count * string_fraction)
+    is_string = np.zeros(frame_count + string_count, dtype=bool)
+    is_string[rng.choice(len(is_string), string_count, replace=False)] = True
+    string_lengths = rng.integers(1, MAX_STRING_LENGTH + 1, string_count)
+
+    record_lengths = np.empty(len(is_string), dtype=np.int64)
+    record_lengths[~is_string] = 1 + CAN_HEADER_LENGTH + lengths
+    record_lengths[is_string] = 1 + string_lengths
+    starts = np.concatenate(([0], np.cumsum(record_lengths)[:-1]))
+    can_starts = starts[~is_string]
+    string_starts = starts[is_string]
+
+    # Random payloads everywhere, then headers, clocks and strings on top
+    buffer = rng.integers(0, 256, int(record_lengths.sum()), dtype=np.uint8)
+
+    buffer[can_starts] = lengths
+    header = can_starts[:, None] + np.arange(4)
+    buffer[header + 1] = timestamps.astype(">u4").view(np.uint8).reshape(-1, 4)
+    buffer[header + 5] = can_ids.astype(">u4").view(np.uint8).reshape(-1, 4)
+
+    payload_starts = can_starts + 1 + CAN_HEADER_LENGTH
+    for number, message in enumerate(messages):
+        if not {"Date", "Time"} & {signal.name for signal in message.signals}:
+            continue
+        frames = np.flatnonzero((choice == number) & ~unknown)
+        seconds, second_index = np.unique(
+            timestamps[frames] // 1000, return_inverse=True
+        )
+        payloads = _clock_payloads(message, seconds)
+        buffer[payload_starts[frames, None] + np.arange(message.length)] = payloads[
+            second_index
+        ]
+
+    buffer[string_starts] = STRING_LENGTH_OFFSET + string_lengths
+    string_bytes = np.repeat(string_starts + 1, string_lengths) + (
+        np.arange(string_lengths.sum())
+        - np.repeat(np.cumsum(string_lengths) - string_lengths, string_lengths)
+    )
+    # Printable ascii
+    buffer[string_bytes] = 32 + buffer[string_bytes] % 95
+
+    # A frame cut off by the logger losing power
+    tail = bytes([8]) + bytes(CAN_HEADER_LENGTH) + bytes(3) if corrupt else b""
+    with open(path, "wb") as file:
+        buffer.tofile(file)
+        file.write(tail)
+
+    return {
+        "frames": frame_count,
+        "strings": string_count,
+        "bytes": len(buffer) + len(tail),
+    }
@@ -1,6 +1,63 @@
-from os import environ
+from os import cpu_count, environ
 from pathlib import Path
 
 DATA_DIR = Path(environ.get("DATA_DIR", "/data"))
 CSV_DIR = DATA_DIR / Path("csv")
 RERUN_DIR = DATA_DIR / Path("rerun")
+DBC_DIR = DATA_DIR / Path("DBCFiles")
+DBC_CACHE_DIR = DATA_DIR / Path("dbc_cache")
+UPLOAD_DIR = DATA_DIR / Path("uploads")
+STAGING_DIR = UPLOAD_DIR / Path("staging")
+JOBS_DB = DATA_DIR / Path("jobs.sqlite3")
+SESSIONS_DB = DATA_DIR / Path("sessions.sqlite3")
+CONVERSION_CACHE_DIR = DATA_DIR / Path("conversion_cache")
+
+DEFAULT_DBC = "MF13Beta.dbc"
+
+INFLUXDB_PARAMETERS_DIR = DATA_DIR / Path("influxdb2_parameters")
+INFLUXDB_URL = "http://fsaelinux.mines.edu:8086"
+INFLUXDB_BUCKET = "NEWPIPELINETESTING"
+# Min/max/mean/count/last windows of each sensor, see known_to_pyramid
+INFLUXDB_DOWNSAMPLED_BUCKET = "NEWPIPELINETESTING_downsampled"
+
+# Write the intermediate unknown text file and decode log to CSV_DIR for debugging
+KEEP_UNKNOWN_DATA = environ.get("KEEP_UNKNOWN_DATA", "").lower() in ("1", "true")
+
+# "wide" stores the decoded data as one table per CAN message instead of one row
+# per value, see unknown_to_known/known_file.py
+KNOWN_LAYOUT = environ.get("KNOWN_LAYOUT", "long").lower()
+
+# Also export the decoded data as a long format csv next to the parquet file
+EXPORT_KNOWN_CSV = environ.get("EXPORT_KNOWN_CSV", "").lower() in ("1", "true")
+
+# Keep a .line copy of the line protocol streamed to InfluxDB in CSV_DIR
+ARCHIVE_LINE_PROTOCOL = environ.get("ARCHIVE_LINE_PROTOCOL", "").lower() in (
+    "1",
+    "true",
+)
+
+# How the worker settings add up in the server:
+#   - MAX_RUNNING_JOBS files are converted at the same time.
+#   - Their stages (decode, InfluxDB, Rerun, pyramid) share a pool of
+#     CONVERSION_WORKERS processes.
+#   - The decode stage of a large log splits it into shards decoded by
+#     DECODE_WORKERS_PER_JOB more processes, while its own pool process waits for
+#     them. Running jobs share DECODE_WORKERS between them this way.
+# So the server runs at most DECODE_WORKERS decoding processes plus
+# CONVERSION_WORKERS stage processes. Decoding from the command line
+# (decode.make_known_sharded) uses all DECODE_WORKERS.
+
+# Worker processes shared by all conversions
+CONVERSION_WORKERS = int(environ.get("CONVERSION_WORKERS", cpu_count() or 2))
+# Worker processes decoding large logs, for all running conversions together
+DECODE_WORKERS = int(environ.get("DECODE_WORKERS", cpu_count() or 1))
+# Files converted at the same time, the rest wait in the job queue
+MAX_RUNNING_JOBS = int(environ.get("MAX_RUNNING_JOBS", 2))
+# Worker processes decoding the log of one conversion
+DECODE_WORKERS_PER_JOB = max(1, DECODE_WORKERS // max(MAX_RUNNING_JOBS, 1))
+# Uploads are refused with 503 while this many files are waiting
+MAX_QUEUED_JOBS = int(environ.get("MAX_QUEUED_JOBS", 50))
+# Least recently used conversions are removed from CONVERSION_CACHE_DIR past this size
+CONVERSION_CACHE_MAX_BYTES = int(
+    environ.get("CONVERSION_CACHE_MAX_BYTES", 20 * 1024 * 1024 * 1024)
+)
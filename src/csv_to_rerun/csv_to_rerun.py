@@ -3,56 +3,143 @@ import pandas as pd
 import numpy as np
 import time
 from pathlib import Path
+from typing import Callable
+
+from unknown_to_known import known_file
+
+# Seconds of the session sent to Rerun by default
+DEFAULT_TIME_WINDOW = (90, 1000)
+SEND_BATCH_SIZE = 50000
+
+GPS_SENSORS = ["Latitude", "Longitude"]
+# Milliseconds between a Latitude and a Longitude sample of the same position
+GPS_PAIR_TOLERANCE = 50
+
+
+def log_data(df: pd.DataFrame, batch_size: int = SEND_BATCH_SIZE) -> None:
+    """
+    Sends the values of every sensor as scalar columns.
+
+    Rows are grouped by sensor in one pass (stable sort on the category codes),
+    then each sensor is sent in batches of at most ``batch_size`` rows.
+
+    :param df: Rows with Sensor, time_s and Value
+    """
+    sensors = df["Sensor"].astype("category")
+    codes = sensors.cat.codes.to_numpy()
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    times = df["time_s"].to_numpy()[order]
+    values = df["Value"].to_numpy()[order]
+
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    for start, end in zip(
+        np.concatenate(([0], bounds)), np.concatenate((bounds, [len(codes)]))
+    ):
+        # Code -1 is a missing sensor name
+        if start == end or codes[start] < 0:
+            continue
+
+        send_scalars(
+            str(sensors.cat.categories[codes[start]]),
+            times[start:end],
+            values[start:end],
+            batch_size,
+        )
 
 
-def log_data(df: pd.DataFrame) -> None:
-    sensors = df["Sensor"].dropna().unique()
+def send_scalars(
+    sensor: str,
+    times: np.ndarray,
+    values: np.ndarray,
+    batch_size: int = SEND_BATCH_SIZE,
+) -> None:
+    """
+    Sends the values of one sensor in batches of at most ``batch_size``.
+
+    :param times: Seconds of each value
+    """
+    label = sensor.replace("_", "\\ ")
+    for start in range(0, len(values), batch_size):
+        end = min(start + batch_size, len(values))
+        rr.send_columns(
+            label,
+            indexes=[rr.TimeColumn("time", duration=times[start:end])],
+            columns=rr.Scalars.columns(scalars=values[start:end]),
+        )
 
-    for sensor in sensors:
-        label = str(sensor).replace("_", "\\ ")
-        sensor_df = df[df["Sensor"] == sensor]
 
-        times = sensor_df["time_s"].to_numpy()
-        values = sensor_df["Value"].to_numpy()
+def log_message(chunk: pd.DataFrame, batch_size: int = SEND_BATCH_SIZE) -> None:
+    """
+    Sends every signal column of a message chunk as is, no grouping needed.
 
-        rr.send_columns(
-            label,
-            indexes=[rr.TimeColumn("time", duration=times)],
-            columns=rr.Scalars.columns(scalars=values),
+    :param chunk: Frames of one message from known_file.iter_messages with time_s
+    """
+    times = chunk["time_s"].to_numpy()
+    for sensor in chunk.columns.drop(["Timestamp", "time_s"]):
+        send_scalars(
+            sensor,
+            times,
+            chunk[sensor].to_numpy(dtype=np.float64, na_value=np.nan),
+            batch_size,
         )
 
 
+def gps_track(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pairs every Latitude sample with the nearest Longitude sample. The two can come
+    from different CAN frames, so their timestamps don't have to match.
+
+    :returns: DataFrame with time_s, Latitude and Longitude sorted by time
+    """
+    positions = [
+        df.loc[df["Sensor"] == sensor, ["Timestamp", "time_s", "Value"]]
+        .dropna()
+        .astype({"Timestamp": np.int64})
+        .sort_values("Timestamp", kind="stable")
+        .drop_duplicates("Timestamp", keep="last")
+        .rename(columns={"Value": sensor})
+        for sensor in GPS_SENSORS
+    ]
+    track = pd.merge_asof(
+        positions[0],
+        positions[1].drop(columns="time_s"),
+        on="Timestamp",
+        direction="nearest",
+        tolerance=GPS_PAIR_TOLERANCE,
+    )
+    return track.dropna(subset=GPS_SENSORS).reset_index(drop=True)
+
+
 def log_gps(df: pd.DataFrame) -> None:
-    longitude_df = df[df["Sensor"] == "Longitude"]
-    latitude_df = df[df["Sensor"] == "Latitude"]
-
-    long_vals = longitude_df["Value"].to_numpy()
-    lat_vals = latitude_df["Value"].to_numpy()
-    times = longitude_df["time_s"].to_numpy()
-
-    minimum_length = min(len(long_vals), len(lat_vals))
-
-    long_vals = long_vals[:minimum_length]
-    lat_vals = lat_vals[:minimum_length]
-    times = times[:minimum_length]
-
-    coordinates = np.column_stack((lat_vals, long_vals))
-
-    for i in range(minimum_length):
-        rr.set_time("time", duration=times[i])
-        rr.log(
-            "gps/position",
-            rr.GeoPoints(
-                lat_lon=[coordinates[i]],
-                radii=rr.Radius.ui_points(5),
-                colors=0xFF0000FF,
-            ),
-            rr.GeoLineStrings(
-                lat_lon=[coordinates[: i + 1]],
-                radii=rr.Radius.ui_points(1),
-                colors=0x00FFFFAA,
-            ),
-        )
+    track = gps_track(df)
+    if len(track) == 0:
+        return
+
+    coordinates = track[["Latitude", "Longitude"]].to_numpy(dtype=np.float64)
+
+    # Style is static, positions are sent as one column
+    rr.log(
+        "gps/position",
+        rr.GeoPoints.from_fields(radii=rr.Radius.ui_points(5), colors=0xFF0000FF),
+        static=True,
+    )
+    rr.send_columns(
+        "gps/position",
+        indexes=[rr.TimeColumn("time", duration=track["time_s"].to_numpy())],
+        columns=rr.GeoPoints.columns(positions=coordinates),
+    )
+
+    # The whole trail as one line strip, instead of the trail so far at every sample
+    rr.log(
+        "gps/trail",
+        rr.GeoLineStrings(
+            lat_lon=[coordinates],
+            radii=rr.Radius.ui_points(1),
+            colors=0x00FFFFAA,
+        ),
+        static=True,
+    )
 
 
 def has_gps(df: pd.DataFrame) -> bool:
@@ -60,17 +147,76 @@ def has_gps(df: pd.DataFrame) -> bool:
     return ("Longitude" in sensors) and ("Latitude" in sensors)
 
 
-def convert(input_path: Path, output_dir: Path) -> None:
-    rr.init(input_path.stem)
-
-    df = pd.read_csv(input_path.resolve(), usecols=["Timestamp", "Sensor", "Value"])
-
-    df = df[(df["Timestamp"] >= 90 * 1000) & (df["Timestamp"] <= 1000 * 1000)].copy()
-    df["time_s"] = df["Timestamp"] / 1000.0
-
+def _in_window(chunk: pd.DataFrame, time_window) -> pd.DataFrame:
+    if time_window is None:
+        return chunk
+    start, end = time_window
+    return chunk[
+        (chunk["Timestamp"] >= start * 1000) & (chunk["Timestamp"] <= end * 1000)
+    ]
+
+
+def convert(
+    input_path: Path,
+    output_dir: Path,
+    time_window: tuple[float, float] | None = DEFAULT_TIME_WINDOW,
+    batch_size: int = SEND_BATCH_SIZE,
+    recording_name: str | None = None,
+    report: Callable[[int, int], None] | None = None,
+) -> None:
+    """
+    Converts a known file to a .rrd recording in output_dir, reading it in chunks.
+    The .rrd file is named after the input file.
+
+    :param input_path: .parquet, .wide or .csv known file
+    :param output_dir: Directory of the .rrd file
+    :param time_window: (start, end) in seconds of the rows to keep, None keeps everything
+    :param batch_size: Maximum number of rows per send_columns call
+    :param recording_name: Name of the recording, defaults to the input file name
+    :param report: Progress callback, see known_file.iter_known
+    """
+    rr.init(recording_name or input_path.stem)
     rr.save(output_dir / Path(input_path.stem + ".rrd"))
 
-    log_data(df)
-
-    if has_gps(df):
-        log_gps(df)
+    # GPS rows are few, they are kept to send the whole track at the end
+    gps_chunks = []
+    if known_file.is_wide(input_path):
+        for _, _, chunk in known_file.iter_messages(
+            input_path.resolve(), report=report
+        ):
+            chunk = _in_window(chunk, time_window)
+            if len(chunk) == 0:
+                continue
+
+            chunk = chunk.assign(time_s=chunk["Timestamp"] / 1000.0)
+            log_message(chunk, batch_size)
+            gps_chunks += [
+                pd.DataFrame(
+                    {
+                        "Timestamp": chunk["Timestamp"],
+                        "time_s": chunk["time_s"],
+                        "Sensor": sensor,
+                        "Value": chunk[sensor],
+                    }
+                )
+                for sensor in GPS_SENSORS
+                if sensor in chunk
+            ]
+    else:
+        for chunk in known_file.iter_known(
+            input_path.resolve(),
+            columns=["Timestamp", "Sensor", "Value"],
+            report=report,
+        ):
+            chunk = _in_window(chunk, time_window)
+            if len(chunk) == 0:
+                continue
+
+            chunk = chunk.assign(time_s=chunk["Timestamp"] / 1000.0)
+            log_data(chunk, batch_size)
+            gps_chunks.append(chunk[chunk["Sensor"].isin(GPS_SENSORS)])
+
+    if gps_chunks:
+        gps = pd.concat(gps_chunks, ignore_index=True)
+        if has_gps(gps):
+            log_gps(gps)
@@ -1,60 +1,62 @@
+import numpy as np
 import pandas as pd
-from datetime import datetime
+
+from unknown_to_known import known_file
+from unknown_to_known.clock_alignment import CLOCK_SENSORS, ClockMapping, ClockSamples
 
 """
 @author Will Turchin
-Script to convert formula .csv Timestamp's into unix time using the "Time" sensor value
-However, the "Time" values from the 2024 Comp data were so noisy that they could not be converted correctly into
-usable Unix times, so this code is not currently being used 
-"""
-
-
-def build_time_ref(file) -> float:
-    # Read only needed cols for efficiency
-    df = pd.read_csv(file)
-    DateRow = df[(df["Sensor"] == "Date")]  # DDMMYY
-    TimeRow = df[(df["Sensor"] == "Time")]  # HHMMSS.sss
-
-    Date: str = str(DateRow["Value"].iloc[-1])
-    Time: int = int(TimeRow["Value"].iloc[-1])
+Script to convert formula .csv Timestamp's into unix time using the clock sensors
+("Date" and "Time", or the GPS week and time of week)
 
-    while (
-        len(Date) < 6
-    ):  # Edge case, if given 06/05/25 date value is "60525" convert to -> "060525"
-        Date = "0" + Date
+The conversion pipeline gets the mapping from the decode stage (see
+clock_alignment), this fits it again from a known file for files converted on
+their own.
+"""
 
-    day: int = int(Date[0:2])
-    month: int = int(Date[2:4])
-    year: int = int(Date[4:6]) + 2000
 
-    if (
-        int(str(Time)[0:2]) > 23
-    ):  # Edge case, if given 3113036044 (HHMMSS.sss) we know that the data was read wrong, as big endian instead of little
-        n = int(Time).to_bytes(4, byteorder="little")
-        Time = int.from_bytes(n, byteorder="big")
-        print(
-            f"Exception detected: time was read as big endian, switching to little endian"
+def clock_from_known(file) -> ClockMapping:
+    """
+    Fits the mapping to Unix time from the clock sensor rows of a known file.
+    Parquet files only read those rows.
+    """
+    df = known_file.read_known(
+        file,
+        columns=["Timestamp", "Sensor", "Value"],
+        filters=[("Sensor", "in", list(CLOCK_SENSORS))],
+    )
+    samples = ClockSamples()
+    for sensor in CLOCK_SENSORS:
+        rows = df[df["Sensor"] == sensor]
+        samples.add(
+            sensor,
+            rows["Timestamp"].to_numpy(),
+            rows["Value"].to_numpy(dtype=np.float64),
         )
 
-    hour: int = int(str(Time)[0:2])
-    minute: int = int(str(Time)[2:4])
-    second: int = int(str(Time)[4:6])
-    ms: int = 0  # UNIX time doesn't need ms
-    dt = datetime(year, month, day, hour, minute, second, 0)
-    Unix_ms: float = dt.timestamp() * 1000
-    return Unix_ms
+    clock = samples.fit()
+    if clock is None:
+        raise ValueError(f"{file} has no usable Date/Time values to get Unix time from")
+    return clock
 
 
 def convert_to_unix(FILE_NAME: str, FILE_OUTPUT: str):
     """
-    Takes input csv and converts timestamps into UNIX time format
+    Takes input known file (csv or parquet) and converts timestamps into UNIX time format,
+    writing the same format
 
     :param FILE_NAME: Name of input file
     :param FILE_OUTPUT: Name of output file
     """
 
-    # Build the reference mapping once (optimization to make code run faster)
-    time_ref: float = build_time_ref(FILE_NAME)
+    clock = clock_from_known(FILE_NAME)
+    if known_file.is_parquet(FILE_NAME):
+        with known_file.KnownWriter(FILE_OUTPUT) as writer:
+            for chunk in known_file.iter_known(FILE_NAME):
+                chunk["Timestamp"] = clock.to_unix(chunk["Timestamp"])
+                writer.write(chunk)
+        return
+
     header_written = False
     for chunk in pd.read_csv(
         FILE_NAME,
@@ -68,7 +70,7 @@ def convert_to_unix(FILE_NAME: str, FILE_OUTPUT: str):
         na_filter=False,
         chunksize=200000,
     ):
-        chunk["Timestamp"] += int(time_ref)
+        chunk["Timestamp"] = clock.to_unix(chunk["Timestamp"])
         # write once, then append
         if not header_written:
             chunk.head(0).to_csv(FILE_OUTPUT, index=False)
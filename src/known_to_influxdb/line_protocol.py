@@ -1,6 +1,9 @@
+import numpy as np
 import pandas as pd
-import os
+from typing import Callable
 from known_to_influxdb import convert_unix_time
+from unknown_to_known import known_file
+from unknown_to_known.clock_alignment import ClockMapping
 
 """
 @author Will Turchin
@@ -8,6 +11,10 @@ Script to take formula CSV files and convert them into line protocal files
 to be used in the influx database
 """
 
+DEDUP_WINDOW = 2_000_000
+TAG_KEY = "can_id"
+FIELD_KEY = "value"
+
 
 def esc_measure(s: str) -> str:
     return s.replace(",", r"\,").replace(" ", r"\ ").replace("=", r"\=")
@@ -17,48 +24,250 @@ def esc_tag(s: str) -> str:
     return esc_measure(s)
 
 
-def convert_to_lineprotocol(FILE_NAME: str, FILE_OUTPUT: str):
+class RecentRows:
     """
-    Converts csv to line protocol
+    Remembers hashes of the last ``max_size`` distinct rows to drop duplicates
+    while streaming. Duplicate CAN frames are logged close together, so a bounded
+    window catches them without holding the whole file.
 
-    :param FILE_NAME: Name of Input File
-    :param FILE_OUTPUT: Name of Output File
+    Hashes are kept in blocks of consecutive ones, each with a hash table built
+    once. A block is merged into the one before it once that one is no larger, as
+    in a binary counter, so there are only a few blocks, and blocks past the window
+    are dropped. Checking a chunk costs a few lookups of its rows, however full the
+    window is.
     """
 
-    # convert input CSV to Unix Time
-    FILE_NAME_BASE, ending = os.path.splitext(FILE_NAME)
-    FILE_NAME_UNIX = FILE_NAME_BASE + "_unixtime" + ending
-    convert_unix_time.convert_to_unix(FILE_NAME, FILE_NAME_UNIX)
-
-    with open(FILE_OUTPUT, "w", encoding="utf-8", newline="\n") as out:
-        df = pd.read_csv(FILE_NAME_UNIX)
-        df = df.drop_duplicates()
-        df.to_csv(FILE_NAME_UNIX, mode="w", index=False)
-        for chunk in pd.read_csv(
-            FILE_NAME_UNIX,
-            usecols=["Timestamp", "CANID", "Sensor", "Value"],
-            dtype={
-                "Timestamp": "string",
-                "CANID": "string",
-                "Sensor": "string",
-                "Value": "string",
-            },
-            na_filter=False,
-            chunksize=200000,
+    def __init__(self, max_size: int = DEDUP_WINDOW):
+        self.max_size = max_size
+        # (Number of the first hash, hashes), oldest first
+        self._blocks: list[tuple[int, pd.Index]] = []
+        # Number of hashes remembered so far
+        self._count = 0
+
+    def filter(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+        duplicate = pd.Index(hashes).duplicated()
+
+        candidates = hashes[~duplicate]
+        oldest = self._count - self.max_size
+        seen = np.zeros(len(candidates), dtype=bool)
+        for start, block in self._blocks:
+            found = block.get_indexer(candidates)
+            # The oldest block may hold hashes already out of the window
+            seen |= (found >= 0) & (start + found >= oldest)
+        duplicate[~duplicate] = seen
+
+        self._add(candidates[~seen])
+        return chunk[~duplicate]
+
+    def _add(self, hashes: np.ndarray) -> None:
+        """
+        :param hashes: Distinct hashes not in the window
+        """
+        if len(hashes):
+            self._blocks.append((self._count, pd.Index(hashes)))
+            self._count += len(hashes)
+
+        oldest = self._count - self.max_size
+        self._blocks = [
+            (start, block)
+            for start, block in self._blocks
+            if start + len(block) > oldest
+        ]
+        while len(self._blocks) >= 2 and len(self._blocks[-2][1]) <= len(
+            self._blocks[-1][1]
         ):
-            chunk = chunk[
-                (chunk["Timestamp"] != "")
-                & (chunk["CANID"] != "")
-                & (chunk["Sensor"] != "")
-                & (chunk["Value"] != "")
-            ]
-            lines = (
-                chunk["Sensor"].map(esc_measure)
-                + ",tag1="
-                + chunk["CANID"].map(esc_tag)
-                + " field1="
-                + chunk["Value"]
-                + " "
-                + chunk["Timestamp"]
+            (start, older), (_, newer) = self._blocks[-2:]
+            skipped = max(oldest - start, 0)
+            merged = np.concatenate((older.to_numpy()[skipped:], newer.to_numpy()))
+            self._blocks[-2:] = [(start + skipped, pd.Index(merged))]
+
+
+class LineProtocolEncoder:
+    """
+    Turns known rows into line protocol bytes:
+
+        <Sensor>,<tag_key>=<CANID> <field_key>=<Value>[i] <Timestamp>
+
+    Sensor/CANID pairs are few, so each measurement and tag prefix is escaped once
+    and looked up by code. Values and timestamps repeat a lot as well and are
+    formatted once per distinct value. Signals listed in ``integer_fields`` by
+    (CAN ID, Sensor), or stored as integers in a wide file, get integer fields
+    (``i`` suffix), everything else float fields.
+    """
+
+    def __init__(
+        self,
+        tag_key: str = TAG_KEY,
+        field_key: str = FIELD_KEY,
+        integer_fields=(),
+        clock: ClockMapping = ClockMapping(offset=0),
+    ):
+        self.tag_key = esc_tag(tag_key)
+        self.field_key = esc_tag(field_key)
+        self.integer_fields = set(integer_fields)
+        # Maps the logger timestamps to Unix time
+        self.clock = clock
+        self._prefixes: dict[tuple[str, int], str] = {}
+
+    def _prefix(self, sensor: str, can_id: int) -> str:
+        prefix = self._prefixes.get((sensor, can_id))
+        if prefix is None:
+            prefix = f"{esc_measure(sensor)},{self.tag_key}={esc_tag(str(can_id))} {self.field_key}="
+            self._prefixes[(sensor, can_id)] = prefix
+        return prefix
+
+    def encode(self, chunk: pd.DataFrame) -> bytes:
+        """
+        :param chunk: Rows with Timestamp, CANID, Sensor and a non-null float Value
+        """
+        if len(chunk) == 0:
+            return b""
+
+        # === ONE PREFIX PER SENSOR/CANID PAIR ===
+        sensors = pd.Categorical(chunk["Sensor"])
+        can_ids = chunk["CANID"].to_numpy(dtype=np.int64)
+        pairs = sensors.codes.astype(np.int64) << 32 | can_ids
+        pair_codes, unique_pairs = pd.factorize(pairs)
+        pair_sensors = sensors.categories[unique_pairs >> 32].astype(str)
+        pair_ids = (unique_pairs & 0xFFFFFFFF).tolist()
+        prefixes = np.array(
+            [self._prefix(*pair) for pair in zip(pair_sensors, pair_ids)],
+            dtype=object,
+        )
+        is_integer = np.array(
+            [
+                (can_id, sensor) in self.integer_fields
+                for sensor, can_id in zip(pair_sensors, pair_ids)
+            ],
+            dtype=bool,
+        )[pair_codes]
+
+        # === FIELD VALUES ===
+        values = chunk["Value"].to_numpy(dtype=np.float64)
+        fields = np.empty(len(chunk), dtype=object)
+        if is_integer.any():
+            fields[is_integer] = _format_unique(
+                values[is_integer].astype(np.int64), "{}i".format
             )
-            out.write("\n".join(lines) + "\n")
+        fields[~is_integer] = _format_unique(values[~is_integer], repr)
+
+        timestamps = _format_unique(self.clock.to_unix(chunk["Timestamp"]), str)
+
+        lines = "".join(
+            f"{prefix}{field} {timestamp}\n"
+            for prefix, field, timestamp in zip(
+                prefixes[pair_codes].tolist(), fields.tolist(), timestamps.tolist()
+            )
+        )
+        return lines.encode("utf-8")
+
+    def encode_message(self, can_id: int, chunk: pd.DataFrame) -> bytes:
+        """
+        :param chunk: Frames of one message from known_file.iter_messages with
+            exact_integers, Timestamp and a column per signal, missing where null.
+            Integer columns, as the wide file typed them, get integer fields
+        """
+        timestamps = _format_unique(self.clock.to_unix(chunk["Timestamp"]), str)
+        lines = []
+        for sensor in chunk.columns.drop("Timestamp"):
+            column = chunk[sensor]
+            # Missing multiplexed signals can't be written as fields
+            present = column.notna().to_numpy()
+            if not present.any():
+                continue
+
+            values = column[present]
+            if pd.api.types.is_integer_dtype(values.dtype):
+                fields = _format_unique(
+                    values.to_numpy(dtype=values.dtype.numpy_dtype), "{}i".format
+                )
+            else:
+                fields = _format_unique(values.to_numpy(dtype=np.float64), repr)
+            prefix = self._prefix(sensor, can_id)
+            lines.append(
+                "".join(
+                    f"{prefix}{field} {timestamp}\n"
+                    for field, timestamp in zip(
+                        fields.tolist(), timestamps[present].tolist()
+                    )
+                )
+            )
+        return "".join(lines).encode("utf-8")
+
+
+def _format_unique(values: np.ndarray, formatter) -> np.ndarray:
+    """
+    Applies ``formatter`` once per distinct value.
+    """
+    codes, uniques = pd.factorize(values)
+    return np.array(list(map(formatter, uniques.tolist())), dtype=object)[codes]
+
+
+def iter_lineprotocol(
+    FILE_NAME: str,
+    dedup_window: int = DEDUP_WINDOW,
+    tag_key: str = TAG_KEY,
+    field_key: str = FIELD_KEY,
+    clock: ClockMapping | None = None,
+    report: Callable[[int, int], None] | None = None,
+):
+    """
+    Streams a known file (parquet, wide or csv) as line protocol: shifts timestamps to
+    Unix time, drops duplicate and empty rows, and yields the lines of each chunk
+    as bytes.
+
+    :param FILE_NAME: Name of Input File
+    :param dedup_window: Number of recent distinct rows checked for duplicates
+    :param tag_key: Tag key holding the CAN ID
+    :param field_key: Field key holding the value
+    :param clock: Mapping to Unix time found by the decode stage, fitted from the
+        Date and Time rows of the file when not given
+    :param report: Progress callback, see known_file.iter_known
+    """
+    if clock is None:
+        clock = convert_unix_time.clock_from_known(FILE_NAME)
+    recent_rows = RecentRows(dedup_window)
+    encoder = LineProtocolEncoder(
+        tag_key=tag_key,
+        field_key=field_key,
+        integer_fields=known_file.integer_fields(FILE_NAME),
+        clock=clock,
+    )
+
+    if known_file.is_wide(FILE_NAME):
+        # Messages come one after the other, duplicate frames are whole rows
+        can_id = None
+        for message_id, _, chunk in known_file.iter_messages(
+            FILE_NAME, report=report, exact_integers=True
+        ):
+            if message_id != can_id:
+                can_id, recent_rows = message_id, RecentRows(dedup_window)
+            chunk = recent_rows.filter(chunk)
+            if len(chunk):
+                yield encoder.encode_message(can_id, chunk)
+        return
+
+    for chunk in known_file.iter_known(
+        FILE_NAME,
+        columns=["Timestamp", "CANID", "Sensor", "Value"],
+        report=report,
+    ):
+        # Missing multiplexed signals are NaN and can't be written as fields
+        chunk = chunk[chunk["Value"].notna() & (chunk["Sensor"] != "")]
+        chunk = recent_rows.filter(chunk)
+        if len(chunk):
+            yield encoder.encode(chunk)
+
+
+def convert_to_lineprotocol(FILE_NAME: str, FILE_OUTPUT: str, **kwargs):
+    """
+    Converts a known file (parquet or csv) to a line protocol file in one streaming pass
+
+    :param FILE_NAME: Name of Input File
+    :param FILE_OUTPUT: Name of Output File
+    :param kwargs: Options of iter_lineprotocol
+    """
+    with open(FILE_OUTPUT, "wb") as out:
+        for lines in iter_lineprotocol(FILE_NAME, **kwargs):
+            out.write(lines)
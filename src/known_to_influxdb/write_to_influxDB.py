@@ -1,56 +1,356 @@
-import subprocess
+import gzip
+import http.client
+import math
 import os
+import queue
+import threading
+import time
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from urllib.parse import urlencode, urlsplit
 
-def write_to_influxDB(FILE_INPUT: str):
+from constants import *
+
+"""
+Writes line protocol to InfluxDB through its HTTP API (/api/v2/write).
+
+Batches are gzip compressed and posted over keep-alive connections by a small
+thread pool, so several batches are in flight at once. 429 and 503 responses are
+retried after their Retry-After header, or with backoff without one, anything
+else raises InfluxWriteError.
+"""
+
+BATCH_LINES = 5000
+QUEUE_SIZE = 16
+MAX_IN_FLIGHT = 4
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+TIMEOUT_SECONDS = 30
+
+RETRY_STATUSES = {429, 503}
+
+
+class InfluxWriteError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"InfluxDB write failed ({status}): {message}")
+        self.status = status
+        self.message = message
+
+    def __reduce__(self):
+        # Keeps the error picklable when a stage fails in a worker process
+        return InfluxWriteError, (self.status, self.message)
+
+
+@dataclass(frozen=True)
+class InfluxConfig:
+    url: str
+    org: str
+    token: str
+    bucket: str
+
+
+def _read_parameter(name: str) -> str:
+    with open(INFLUXDB_PARAMETERS_DIR / name) as file:
+        return file.read().strip()
+
+
+@lru_cache(maxsize=1)
+def load_config() -> InfluxConfig:
+    """
+    Reads the connection settings once. Environment variables take precedence over
+    the influxdb2 parameter files.
+    """
+    return InfluxConfig(
+        url=environ.get("INFLUXDB_URL", INFLUXDB_URL),
+        org=environ.get("INFLUXDB_ORG") or _read_parameter("influxdb2-org"),
+        token=environ.get("INFLUXDB_TOKEN") or _read_parameter("influxdb2-admin-token"),
+        bucket=environ.get("INFLUXDB_BUCKET", INFLUXDB_BUCKET),
+    )
+
+
+def downsampled_config() -> InfluxConfig:
+    """
+    Settings of the bucket the sensor pyramid is written to, same server as load_config().
+    """
+    return replace(
+        load_config(),
+        bucket=environ.get("INFLUXDB_DOWNSAMPLED_BUCKET", INFLUXDB_DOWNSAMPLED_BUCKET),
+    )
+
+
+def retry_delay(retry_after: str | None) -> float | None:
+    """
+    :param retry_after: Retry-After header, seconds or an HTTP date
+    :returns: Seconds to wait, None when the header is missing or can't be read
+    """
+    if not retry_after:
+        return None
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            # HTTP dates are always GMT, the asctime form has no zone
+            date = date.replace(tzinfo=timezone.utc)
+        seconds = date.timestamp() - time.time()
+    if not math.isfinite(seconds):
+        return None
+    return max(seconds, 0.0)
+
+
+def batch_lines(lines, batch_size: int = BATCH_LINES):
+    """
+    Groups an iterable of newline terminated lines (bytes) into batches.
+    """
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield b"".join(batch)
+            batch = []
+    if batch:
+        yield b"".join(batch)
+
+
+class InfluxWriter:
+    """
+    Posts batches of line protocol to one bucket.
+
+    Each worker thread keeps its own keep-alive connection. Use as a context
+    manager, or call close() when done.
+    """
+
+    def __init__(
+        self,
+        config: InfluxConfig | None = None,
+        precision: str = "ms",
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+        backoff: float = BACKOFF_SECONDS,
+    ):
+        self.config = config or load_config()
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        url = urlsplit(self.config.url)
+        self._connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._netloc = url.netloc
+        query = urlencode(
+            {
+                "org": self.config.org,
+                "bucket": self.config.bucket,
+                "precision": precision,
+            }
+        )
+        self._path = f"{url.path.rstrip('/')}/api/v2/write?{query}"
+        self._headers = {
+            "Authorization": f"Token {self.config.token}",
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Encoding": "gzip",
+        }
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connection_class(self._netloc, timeout=TIMEOUT_SECONDS)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _post(self, body: bytes) -> tuple[int, bytes, str | None]:
+        connection = self._connection()
+        try:
+            connection.request("POST", self._path, body=body, headers=self._headers)
+            response = connection.getresponse()
+            return response.status, response.read(), response.getheader("Retry-After")
+        except (OSError, http.client.HTTPException):
+            # Drop the broken connection, the next attempt reconnects
+            connection.close()
+            raise
+
+    def write_batch(self, batch: bytes) -> None:
+        """
+        Writes one batch of line protocol, retrying when InfluxDB is busy.
+        """
+        if not batch:
+            return
+
+        body = gzip.compress(batch, compresslevel=5)
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, content, retry_after = self._post(body)
+            except (OSError, http.client.HTTPException):
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2**attempt
+            else:
+                if status < 300:
+                    return
+                if status not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise InfluxWriteError(
+                        status, content.decode("utf-8", errors="replace")
+                    )
+                delay = retry_delay(retry_after)
+                if delay is None:
+                    delay = self.backoff * 2**attempt
+            time.sleep(delay)
+
+    def write_batches(self, batches) -> int:
+        """
+        Writes batches concurrently, keeping at most ``max_in_flight`` of them
+        pending. A new batch is sent as soon as any pending one completes. Raises
+        the first failure.
+
+        :returns: Number of bytes written
+        """
+        written = 0
+        pending = set()
+        with ThreadPoolExecutor(self.max_in_flight) as executor:
+            try:
+                for batch in batches:
+                    if len(pending) >= self.max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(self.write_batch, batch))
+                    written += len(batch)
+
+                for future in pending:
+                    future.result()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return written
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_to_influxDB(
+    FILE_INPUT: str,
+    config: InfluxConfig | None = None,
+    batch_size: int = BATCH_LINES,
+):
     """
-    Reads a .line and writes to the influxDB database through the commandline
+    Reads a .line file and writes it to the influxDB database over HTTP
 
     :param FILE_INPUT: Name of .line File
-    :param BUCKET_NAME: Name of Output File
-    """
-    BUCKET_NAME: str = "NEWPIPELINETESTING"
-    FILE_PATH: str = FILE_INPUT
-    HOST_NAME: str
-    ORG: str
-    TOKEN: str
-
-    with open("/data/influxdb2_parameters/influxdb2-localhost-url") as file:
-        HOST_NAME = file.read()
-    with open("/data/influxdb2_parameters/influxdb2-org") as file:
-        ORG = file.read()
-        ORG = ORG.strip()
-    with open("/data/influxdb2_parameters/influxdb2-admin-token") as file:
-        TOKEN = file.read()
-        TOKEN = TOKEN.strip()  # Should be using a constant of some kind for these
-
-    HOST_NAME = "http://fsaelinux.mines.edu:8086"  # hard code for now :thumbsdown:
-
-    """
-    follows the command structure:
-        influx write --bucket <your-bucket-name> --file /path/to/your/data.csv --org <your-organization> --token <your-token>
-        influx write --precision ms --host http://localhost:8086 --bucket NEWDATATESTING --file app/data/csv/EnduranceDayData.data.line --org docs --token theTokenOfMyDreams!
-    """
-    command = [
-        "influx",
-        "write",
-        "--precision",
-        "ms",
-        "--format",
-        "lp",
-        "--host",
-        HOST_NAME,
-        "--bucket",
-        BUCKET_NAME,
-        "--file",
-        FILE_PATH,
-        "--org",
-        ORG,
-        "--token",
-        TOKEN,
-    ]
-
-    print("Running:", " ".join(command))
-    result = subprocess.run(command, capture_output=True, text=True)
-    print("STDOUT: ", result.stdout)
-    print("STDERR: ", result.stderr)
+    :param config: Connection settings, defaults to load_config()
+    :param batch_size: Number of lines per request
+    """
+    if not os.path.exists(FILE_INPUT):
+        raise FileNotFoundError(f"{FILE_INPUT} does not exist")
+
+    with open(FILE_INPUT, "rb") as file, InfluxWriter(config) as writer:
+        written = writer.write_batches(batch_lines(file, batch_size))
+
+    print(f"WROTE {written} BYTES TO {writer.config.bucket}")
+    return written
+
+
+def _produce(
+    chunks, batches: queue.Queue, stop: threading.Event, archive_path, batch_size
+):
+    """
+    Splits encoded chunks into batches for the writer, archiving them on the way.
+    Puts None when done, or the exception that stopped it.
+    """
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        with ExitStack() as stack:
+            archive = None
+            if archive_path is not None:
+                archive = stack.enter_context(open(archive_path, "wb"))
+            for chunk in chunks:
+                if archive is not None:
+                    archive.write(chunk)
+                for batch in batch_lines(chunk.splitlines(keepends=True), batch_size):
+                    if not put(batch):
+                        return
+    except BaseException as e:
+        put(e)
+    else:
+        put(None)
+
+
+def stream_to_influxDB(
+    chunks,
+    config: InfluxConfig | None = None,
+    batch_size: int = BATCH_LINES,
+    archive_path: str | None = None,
+    queue_size: int = QUEUE_SIZE,
+) -> int:
+    """
+    Writes line protocol to influxDB while it is being produced, without a .line file
+    in between. ``chunks`` is consumed on a producer thread and handed to the writer
+    through a bounded queue, so encoding overlaps the network requests and memory
+    stays bounded.
+
+    :param chunks: Iterable of newline terminated line protocol bytes, e.g. line_protocol.iter_lineprotocol
+    :param config: Connection settings, defaults to load_config()
+    :param batch_size: Number of lines per request
+    :param archive_path: Also write the line protocol to this .line file
+    :param queue_size: Number of batches buffered between the producer and the writer
+    :returns: Number of bytes written
+    """
+    batches: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_produce,
+        args=(chunks, batches, stop, archive_path, batch_size),
+        daemon=True,
+    )
+
+    def consume():
+        while (batch := batches.get()) is not None:
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+
+    producer.start()
+    try:
+        with InfluxWriter(config) as writer:
+            written = writer.write_batches(consume())
+    finally:
+        stop.set()
+        producer.join()
+
+    print(f"WROTE {written} BYTES TO {writer.config.bucket}")
+    return written
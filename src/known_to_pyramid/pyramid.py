@@ -0,0 +1,319 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from typing import Callable
+
+from known_to_influxdb.line_protocol import esc_measure, esc_tag
+from unknown_to_known import known_file
+from unknown_to_known.clock_alignment import ClockMapping
+
+"""
+Multi-resolution pyramid of a known file: count, mean, min, max and last value of
+every sensor (and CAN ID) over fixed windows of 10 ms, 100 ms, 1 s and 10 s, so a
+whole session can be plotted zoomed out without reading every sample.
+
+The known file is read once in chunks. Each chunk is sorted by series and time a
+single time, which orders it by window at every resolution, and windows are then
+reduced with NumPy. Rows of each series are expected in timestamp order, as the
+logger writes them and as wide known files store them: a window is complete once
+a later timestamp of its series has been read, so only the open windows of each
+series are held between chunks.
+
+The pyramid is stored as one parquet file with a Resolution column (window length
+in ms), one row group per resolution and chunk:
+
+    Resolution int32, Timestamp int64 (window start), Sensor, CANID int32,
+    Count int64, Mean, Min, Max, Last float64
+
+and as line protocol for the downsampled InfluxDB bucket:
+
+    <Sensor>,can_id=<CANID>,resolution=<Resolution>ms count=<Count>i,mean=<Mean>,min=<Min>,max=<Max>,last=<Last> <Timestamp>
+"""
+
+RESOLUTIONS = (10, 100, 1000, 10000)
+# Windows encoded to line protocol at a time
+ENCODE_BATCH_ROWS = 100_000
+
+PYRAMID_SCHEMA = pa.schema(
+    [
+        ("Resolution", pa.int32()),
+        ("Timestamp", pa.int64()),
+        ("Sensor", pa.dictionary(pa.int32(), pa.string())),
+        ("CANID", pa.int32()),
+        ("Count", pa.int64()),
+        ("Mean", pa.float64()),
+        ("Min", pa.float64()),
+        ("Max", pa.float64()),
+        ("Last", pa.float64()),
+    ]
+)
+
+# Partial aggregates of windows, keyed by series << 32 | window number
+_PARTIAL_FIELDS = ("key", "count", "sum", "min", "max", "last")
+
+
+def _reduce(partials: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Merges partial aggregates with the same key. Keys must be sorted, and partials
+    of a key in the order their rows were logged.
+    """
+    keys = partials["key"]
+    if len(keys) == 0:
+        return partials
+
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    ends = np.append(starts[1:], len(keys)) - 1
+    return {
+        "key": keys[starts],
+        "count": np.add.reduceat(partials["count"], starts),
+        "sum": np.add.reduceat(partials["sum"], starts),
+        "min": np.minimum.reduceat(partials["min"], starts),
+        "max": np.maximum.reduceat(partials["max"], starts),
+        "last": partials["last"][ends],
+    }
+
+
+def _concat(first: dict[str, np.ndarray], second: dict[str, np.ndarray]):
+    """
+    Partials of both, sorted by key, ``first`` before ``second`` within a key.
+    """
+    merged = {
+        field: np.concatenate((first[field], second[field]))
+        for field in _PARTIAL_FIELDS
+    }
+    order = np.argsort(merged["key"], kind="stable")
+    return {field: values[order] for field, values in merged.items()}
+
+
+def _empty() -> dict[str, np.ndarray]:
+    return {
+        field: np.zeros(0, dtype=np.int64 if field in ("key", "count") else np.float64)
+        for field in _PARTIAL_FIELDS
+    }
+
+
+class PyramidBuilder:
+    def __init__(self, resolutions=RESOLUTIONS):
+        """
+        :param resolutions: Window lengths in ms
+        """
+        self.resolutions = resolutions
+        # (Sensor, CANID) of each series number
+        self.series: list[tuple[str, int]] = []
+        self._series_numbers: dict[tuple[str, int], int] = {}
+        self._open = {resolution: _empty() for resolution in resolutions}
+        # Latest timestamp read of each series
+        self._latest = np.zeros(0, dtype=np.int64)
+
+    def _series_of(self, chunk: pd.DataFrame) -> np.ndarray:
+        sensors = pd.Categorical(chunk["Sensor"])
+        can_ids = chunk["CANID"].to_numpy(dtype=np.int64)
+        pair_codes, pairs = pd.factorize(sensors.codes.astype(np.int64) << 32 | can_ids)
+
+        numbers = np.empty(len(pairs), dtype=np.int64)
+        for i, pair in enumerate(pairs.tolist()):
+            series = (str(sensors.categories[pair >> 32]), pair & 0xFFFFFFFF)
+            number = self._series_numbers.get(series)
+            if number is None:
+                number = self._series_numbers[series] = len(self.series)
+                self.series.append(series)
+            numbers[i] = number
+        return numbers[pair_codes]
+
+    def add(self, chunk: pd.DataFrame) -> dict[int, pd.DataFrame]:
+        """
+        :param chunk: Known rows with Timestamp, CANID, Sensor and Value
+        :returns: Windows completed by this chunk, by resolution
+        """
+        chunk = chunk[chunk["Value"].notna() & (chunk["Sensor"] != "")]
+        if len(chunk) == 0:
+            return {}
+
+        series = self._series_of(chunk)
+        timestamps = chunk["Timestamp"].to_numpy(dtype=np.int64)
+        values = chunk["Value"].to_numpy(dtype=np.float64)
+
+        # Sorted by series then time, windows are in order at every resolution
+        order = np.lexsort((timestamps, series))
+        series, timestamps, values = series[order], timestamps[order], values[order]
+        if len(self._latest) < len(self.series):
+            self._latest = np.concatenate(
+                (
+                    self._latest,
+                    np.full(
+                        len(self.series) - len(self._latest), np.iinfo(np.int64).min
+                    ),
+                )
+            )
+        # Last row of each series in the chunk
+        ends = np.flatnonzero(np.diff(series, append=-1))
+        self._latest[series[ends]] = np.maximum(
+            self._latest[series[ends]], timestamps[ends]
+        )
+
+        completed = {}
+        for resolution in self.resolutions:
+            rows = {
+                "key": series << 32 | timestamps // resolution,
+                "count": np.ones(len(values), dtype=np.int64),
+                "sum": values,
+                "min": values,
+                "max": values,
+                "last": values,
+            }
+            partials = _reduce(_concat(self._open[resolution], _reduce(rows)))
+
+            # Rows to come are later than the latest one read of their series
+            window_ends = ((partials["key"] & 0xFFFFFFFF) + 1) * resolution
+            done = window_ends <= self._latest[partials["key"] >> 32]
+            self._open[resolution] = {
+                field: column[~done] for field, column in partials.items()
+            }
+            completed[resolution] = self._frame(
+                resolution, {field: column[done] for field, column in partials.items()}
+            )
+        return completed
+
+    def finish(self) -> dict[int, pd.DataFrame]:
+        """
+        :returns: The windows still open, by resolution
+        """
+        completed = {
+            resolution: self._frame(resolution, partials)
+            for resolution, partials in self._open.items()
+        }
+        self._open = {resolution: _empty() for resolution in self.resolutions}
+        return completed
+
+    def _frame(self, resolution: int, partials: dict[str, np.ndarray]) -> pd.DataFrame:
+        series = partials["key"] >> 32
+        names = np.array([sensor for sensor, _ in self.series] or [""], dtype=object)
+        can_ids = np.array([can_id for _, can_id in self.series] or [0])
+        return pd.DataFrame(
+            {
+                "Resolution": np.full(len(series), resolution, dtype=np.int32),
+                "Timestamp": (partials["key"] & 0xFFFFFFFF) * resolution,
+                "Sensor": names[series],
+                "CANID": can_ids[series].astype(np.int32),
+                "Count": partials["count"],
+                "Mean": partials["sum"] / np.maximum(partials["count"], 1),
+                "Min": partials["min"],
+                "Max": partials["max"],
+                "Last": partials["last"],
+            }
+        )
+
+
+def build_pyramid(
+    known_path,
+    output_path,
+    resolutions=RESOLUTIONS,
+    report: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Writes the pyramid of a known file to a parquet file.
+
+    :param known_path: .parquet or .csv known file
+    :param output_path: Pyramid parquet file to write
+    :param resolutions: Window lengths in ms
+    :param report: Progress callback, see known_file.iter_known
+    :returns: Number of windows written
+    """
+    builder = PyramidBuilder(resolutions)
+    written = 0
+    with pq.ParquetWriter(output_path, PYRAMID_SCHEMA, compression="zstd") as writer:
+
+        def write(completed: dict[int, pd.DataFrame]) -> None:
+            nonlocal written
+            for frame in completed.values():
+                if len(frame):
+                    writer.write_table(
+                        pa.Table.from_pandas(
+                            frame, schema=PYRAMID_SCHEMA, preserve_index=False
+                        )
+                    )
+                    written += len(frame)
+
+        for chunk in known_file.iter_known(
+            known_path, columns=["Timestamp", "CANID", "Sensor", "Value"], report=report
+        ):
+            write(builder.add(chunk))
+        write(builder.finish())
+    return written
+
+
+def read_pyramid(path, resolution: int, columns: list[str] | None = None):
+    """
+    Windows of one resolution of a pyramid file.
+    """
+    return pd.read_parquet(
+        path, columns=columns, filters=[("Resolution", "==", resolution)]
+    )
+
+
+def _format(values: np.ndarray, formatter) -> np.ndarray:
+    codes, uniques = pd.factorize(values)
+    return np.array(list(map(formatter, uniques.tolist())), dtype=object)[codes]
+
+
+def encode_pyramid(windows: pd.DataFrame, clock: ClockMapping) -> bytes:
+    """
+    :param windows: Rows of a pyramid file
+    :param clock: Maps the window starts to Unix time
+    """
+    if len(windows) == 0:
+        return b""
+
+    sensors = pd.Categorical(windows["Sensor"])
+    measurements = np.array(
+        [esc_measure(str(sensor)) for sensor in sensors.categories], dtype=object
+    )[sensors.codes]
+    tags = _format(windows["CANID"].to_numpy(), lambda can_id: esc_tag(str(can_id)))
+    resolutions = _format(windows["Resolution"].to_numpy(), "{}ms".format)
+    counts = _format(windows["Count"].to_numpy(), "{}i".format)
+    means, lows, highs, lasts = (
+        _format(windows[column].to_numpy(dtype=np.float64), repr)
+        for column in ("Mean", "Min", "Max", "Last")
+    )
+    timestamps = _format(clock.to_unix(windows["Timestamp"]), str)
+
+    lines = "".join(
+        f"{measurement},can_id={tag},resolution={resolution} count={count},"
+        f"mean={mean},min={low},max={high},last={last} {timestamp}\n"
+        for measurement, tag, resolution, count, mean, low, high, last, timestamp in zip(
+            measurements.tolist(),
+            tags.tolist(),
+            resolutions.tolist(),
+            counts.tolist(),
+            means.tolist(),
+            lows.tolist(),
+            highs.tolist(),
+            lasts.tolist(),
+            timestamps.tolist(),
+        )
+    )
+    return lines.encode("utf-8")
+
+
+def iter_pyramid_lineprotocol(
+    pyramid_path,
+    clock: ClockMapping,
+    report: Callable[[int, int], None] | None = None,
+):
+    """
+    Streams a pyramid file as line protocol.
+
+    :param pyramid_path: Pyramid parquet file
+    :param clock: Mapping to Unix time of the log, the same as for its raw points
+    :param report: Progress callback, called with windows read and total
+    """
+    file = pq.ParquetFile(pyramid_path)
+    total = file.metadata.num_rows
+    done = 0
+    for batch in file.iter_batches(batch_size=ENCODE_BATCH_ROWS):
+        yield encode_pyramid(batch.to_pandas(), clock)
+        done += batch.num_rows
+        if report is not None:
+            report(done, total)
@@ -0,0 +1,332 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import stat
+import sys
+import time
+
+from pathlib import Path
+from typing import Callable
+
+import rerun as rr
+
+from csv_to_rerun import csv_to_rerun
+from known_to_influxdb import write_to_influxDB
+from known_to_influxdb.line_protocol import LineProtocolEncoder
+from raw_to_unknown.deserializer import FrameStream
+from unknown_to_known import dbc_cache, decode
+from unknown_to_known.clock_alignment import ClockMapping
+from unknown_to_known.decode_plan import integer_fields
+
+"""
+Live ingest: follows a raw .data file while the logger is writing it, or reads the
+same framing from a pipe or a socket, and pushes newly decoded frames to InfluxDB
+and a live Rerun viewer as they arrive, so data can be watched during testing.
+
+    python -m raw_to_live.live_ingest /mnt/logger/LOG0001.data
+    python -m raw_to_live.live_ingest tcp:192.168.4.1:9000 --rerun-serve
+    nc -l 9000 | python -m raw_to_live.live_ingest - --rerun-url rerun+http://127.0.0.1:9876/proxy
+
+When following a file, the position after the last record pushed is kept in a
+state file next to it (LOG0001.data.live.json), so a restarted ingest picks up
+there without writing points twice. The state also keeps the device and inode of
+the file, and is ignored if the logger replaced the file in the meantime.
+
+Logger timestamps count milliseconds from power on. Points are sent to InfluxDB at
+the server's clock: the newest record of the first read is placed at the time it
+was read. Rerun uses the session time, like the converted .rrd recordings.
+"""
+
+POLL_INTERVAL = 0.2
+READ_SIZE = 1024 * 1024
+# Seconds between attempts while InfluxDB is unreachable
+RETRY_INTERVAL = 5
+STATE_SUFFIX = ".live.json"
+
+
+# === SOURCES ===
+# Yield (position, data), position being the offset of data in the source
+
+
+def _file_id(stat_result: os.stat_result) -> tuple[int, int]:
+    return stat_result.st_dev, stat_result.st_ino
+
+
+def follow_file(
+    path: str,
+    offset: int = 0,
+    poll_interval: float = POLL_INTERVAL,
+    idle_timeout: float | None = None,
+    file_id: tuple[int, int] | None = None,
+    on_open: Callable[[tuple[int, int]], None] | None = None,
+):
+    """
+    Yields what is appended to a file from ``offset`` on, waiting for more at the
+    end. Starts again from the beginning if the file is truncated or replaced.
+
+    :param idle_timeout: Stop after this many seconds without new data, None never stops
+    :param file_id: (device, inode) of the file ``offset`` is a position in, the
+        file is read from the start if ``path`` is another file now
+    :param on_open: Called with the (device, inode) of every file opened, before
+        any of its data is yielded
+    """
+    file = open(path, "rb")
+    position = offset
+    if file_id is not None and _file_id(os.fstat(file.fileno())) != file_id:
+        print(f"{path} WAS REPLACED SINCE THE LAST RUN, READING FROM THE START")
+        position = 0
+    if on_open is not None:
+        on_open(_file_id(os.fstat(file.fileno())))
+    last_data = time.monotonic()
+    try:
+        while True:
+            try:
+                replaced = os.stat(path).st_ino != os.fstat(file.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = False
+            size = os.fstat(file.fileno()).st_size
+            if replaced or size < position:
+                print(f"{path} WAS REPLACED, READING FROM THE START")
+                file.close()
+                file = open(path, "rb")
+                position = 0
+                if on_open is not None:
+                    on_open(_file_id(os.fstat(file.fileno())))
+                continue
+
+            if size > position:
+                file.seek(position)
+                data = file.read(min(READ_SIZE, size - position))
+                yield position, data
+                position += len(data)
+                last_data = time.monotonic()
+                continue
+
+            if idle_timeout is not None and time.monotonic() - last_data > idle_timeout:
+                return
+            time.sleep(poll_interval)
+    finally:
+        file.close()
+
+
+def read_stream(stream):
+    """
+    Yields the contents of a pipe as soon as they are written, until it is closed.
+    """
+    position = 0
+    while data := stream.read1(READ_SIZE):
+        yield position, data
+        position += len(data)
+
+
+def read_socket(address: str):
+    """
+    Connects to ``unix:PATH`` or ``tcp:HOST:PORT`` and yields what is received
+    until the connection is closed.
+    """
+    kind, _, location = address.partition(":")
+    if kind == "unix":
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(location)
+    elif kind == "tcp":
+        host, _, port = location.rpartition(":")
+        connection = socket.create_connection((host, int(port)))
+    else:
+        raise ValueError(f"Unknown socket address: {address}")
+
+    position = 0
+    with connection:
+        while data := connection.recv(READ_SIZE):
+            yield position, data
+            position += len(data)
+
+
+# === INGEST ===
+
+
+def _read_state(path: Path) -> dict:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_state(path: Path, state: dict) -> None:
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "w") as file:
+        json.dump(state, file)
+    os.replace(temporary, path)
+
+
+class LiveIngest:
+    """
+    Decodes raw pieces from a source and pushes the rows to InfluxDB and Rerun.
+    """
+
+    def __init__(
+        self,
+        dbc_name: str | None = None,
+        influx: write_to_influxDB.InfluxWriter | None = None,
+        rerun: bool = False,
+        state_path: Path | None = None,
+    ):
+        """
+        :param dbc_name: File name of the DBC in DBC_DIR, defaults to DEFAULT_DBC
+        :param influx: Writer to push points with, None to skip InfluxDB
+        :param rerun: Log to the current Rerun recording
+        :param state_path: Where the position and time offset are kept, None to not keep them
+        """
+        self.plans = dbc_cache.load_dbc(dbc_name).plans
+        self.influx = influx
+        self.rerun = rerun
+        self.state_path = state_path
+
+        state = {} if state_path is None else _read_state(state_path)
+        self.stream = FrameStream(state.get("offset", 0))
+        self.encoder = LineProtocolEncoder(
+            integer_fields=integer_fields(self.plans),
+            clock=ClockMapping(offset=state.get("time_offset", 0)),
+        )
+        self.anchored = "time_offset" in state
+        # (device, inode) of the file being followed, None for other sources and
+        # states written without it
+        self.file_id = tuple(state["file_id"]) if "file_id" in state else None
+        self.rows = 0
+
+    @property
+    def offset(self) -> int:
+        return self.stream.offset
+
+    def opened(self, file_id: tuple[int, int]) -> None:
+        """
+        Called by follow_file with the file it reads the next pieces from.
+        """
+        if self.file_id is not None and file_id != self.file_id:
+            # New file from the logger, its clock starts again too
+            self.stream = FrameStream(0)
+            self.anchored = False
+        self.file_id = file_id
+
+    def push(self, position: int, data: bytes) -> None:
+        if position != self.stream.position:
+            # New file from the logger, its clock starts again too
+            self.stream = FrameStream(position)
+            self.anchored = False
+
+        frames = self.stream.feed(data)
+        rows = decode.decode_frames(frames, self.plans)
+        # Missing multiplexed signals are NaN and can't be written as fields
+        rows = rows[rows["Value"].notna() & (rows["Sensor"] != "")]
+        if len(rows):
+            if not self.anchored:
+                self.encoder.clock = ClockMapping(
+                    offset=int(time.time() * 1000 - rows["Timestamp"].max())
+                )
+                self.anchored = True
+
+            if self.rerun:
+                csv_to_rerun.log_data(rows.assign(time_s=rows["Timestamp"] / 1000.0))
+            if self.influx is not None:
+                self._write(self.encoder.encode(rows))
+            self.rows += len(rows)
+
+        if self.state_path is not None:
+            _write_state(
+                self.state_path,
+                {
+                    "offset": self.stream.offset,
+                    "time_offset": self.encoder.clock.offset,
+                    "file_id": self.file_id,
+                },
+            )
+
+    def _write(self, batch: bytes) -> None:
+        # Keep trying while InfluxDB is down rather than dropping points, the
+        # source waits meanwhile
+        while True:
+            try:
+                self.influx.write_batch(batch)
+                return
+            except write_to_influxDB.InfluxWriteError as e:
+                # Rejected points won't be accepted later
+                if e.status < 500:
+                    raise
+                print(f"COULD NOT WRITE TO INFLUXDB, RETRYING: {e}")
+            except (OSError, http.client.HTTPException) as e:
+                print(f"COULD NOT WRITE TO INFLUXDB, RETRYING: {e}")
+            time.sleep(RETRY_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live ingest of a raw .data stream")
+    parser.add_argument(
+        "source",
+        help="Raw .data file to follow, - for stdin, unix:PATH or tcp:HOST:PORT",
+    )
+    parser.add_argument("--dbc", default=None, help="DBC in DBC_DIR")
+    parser.add_argument("--no-influx", action="store_true")
+    parser.add_argument("--rerun-url", default=None, help="Viewer to stream to")
+    parser.add_argument(
+        "--rerun-serve", action="store_true", help="Serve a Rerun web viewer"
+    )
+    parser.add_argument(
+        "--from-start", action="store_true", help="Ignore the saved position"
+    )
+    parser.add_argument(
+        "--idle-timeout", type=float, default=None, help="Stop after seconds idle"
+    )
+    args = parser.parse_args()
+
+    source = args.source
+    is_file = (
+        source != "-"
+        and not source.startswith(("unix:", "tcp:"))
+        and not stat.S_ISFIFO(os.stat(source).st_mode)
+    )
+    state_path = Path(source + STATE_SUFFIX) if is_file else None
+    if state_path is not None and args.from_start:
+        state_path.unlink(missing_ok=True)
+
+    rerun = args.rerun_url is not None or args.rerun_serve
+    if rerun:
+        rr.init(f"live {Path(source).name}")
+        if args.rerun_url is not None:
+            rr.connect_grpc(args.rerun_url)
+        else:
+            rr.serve_web_viewer(connect_to=rr.serve_grpc(), open_browser=False)
+
+    influx = None if args.no_influx else write_to_influxDB.InfluxWriter()
+    ingest = LiveIngest(args.dbc, influx, rerun, state_path)
+
+    if is_file:
+        pieces = follow_file(
+            source,
+            ingest.offset,
+            idle_timeout=args.idle_timeout,
+            file_id=ingest.file_id,
+            on_open=ingest.opened,
+        )
+    elif source.startswith(("unix:", "tcp:")):
+        pieces = read_socket(source)
+    elif source == "-":
+        pieces = read_stream(sys.stdin.buffer)
+    else:
+        pieces = read_stream(open(source, "rb"))
+
+    print(f"INGESTING {source} FROM BYTE {ingest.offset}")
+    try:
+        for position, data in pieces:
+            ingest.push(position, data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if influx is not None:
+            influx.close()
+    print(f"INGESTED {ingest.rows} ROWS, STOPPED AT BYTE {ingest.offset}")
+
+
+if __name__ == "__main__":
+    main()
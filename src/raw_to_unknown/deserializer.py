@@ -1,67 +1,337 @@
 # ADAPTED FROM: https://github.com/Mines-Formula/DBCProcesser/blob/main/daq_deserializer.py
 
+import mmap
 import os
+from dataclasses import dataclass
+from typing import Callable
 
+import numpy as np
 
-def deserialize(input_filepath: str, output_filepath: str) -> None:
+# Data file structure
+
+# String structure
+# 1B length + 127
+# xB data
+
+# CAN message structure
+# 1B length
+# 4B time (big endian)
+# 4B message id (big endian)
+# xB data
+
+STRING_LENGTH_OFFSET = 127
+CAN_HEADER_LENGTH = 8
+# Length byte, CAN header and the largest payload the length byte allows
+MAX_RECORD_LENGTH = 1 + CAN_HEADER_LENGTH + 255
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+@dataclass
+class Frames:
+    """
+    Structured view of a raw .data file.
+
+    CAN records are stored column-wise: ``timestamps``, ``can_ids``, and the
+    ``offsets``/``lengths`` of each payload inside ``buffer``. String records
+    keep their offsets/lengths separately so the original text layout can be
+    rebuilt by merging the two on file position.
+    """
+
+    buffer: np.ndarray
+    timestamps: np.ndarray
+    can_ids: np.ndarray
+    offsets: np.ndarray
+    lengths: np.ndarray
+    string_offsets: np.ndarray
+    string_lengths: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def payload(self, index: int) -> bytes:
+        start = self.offsets[index]
+        return self.buffer[start : start + self.lengths[index]].tobytes()
+
+    @classmethod
+    def from_records(cls, records) -> "Frames":
+        """
+        Builds Frames from ``(timestamp, can_id, payload)`` records.
+        """
+        timestamps, can_ids, payloads = zip(*records) if records else ((), (), ())
+        lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=len(payloads))
+        empty = np.zeros(0, dtype=np.int64)
+        return cls(
+            buffer=np.frombuffer(b"".join(payloads), dtype=np.uint8),
+            timestamps=np.array(timestamps, dtype=np.uint32),
+            can_ids=np.array(can_ids, dtype=np.uint32),
+            offsets=np.cumsum(lengths) - lengths,
+            lengths=lengths,
+            string_offsets=empty,
+            string_lengths=empty,
+        )
+
+    def select(self, index) -> "Frames":
+        """
+        Returns the CAN records picked by ``index`` (a slice, mask or index
+        array), sharing this buffer. String records are dropped.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        return Frames(
+            buffer=self.buffer,
+            timestamps=self.timestamps[index],
+            can_ids=self.can_ids[index],
+            offsets=self.offsets[index],
+            lengths=self.lengths[index],
+            string_offsets=empty,
+            string_lengths=empty,
+        )
+
+    def records(self):
+        """
+        Yields ``(timestamp, can_id, payload)`` for every CAN record in order.
+        """
+        buffer = self.buffer.data
+        for time, can_id, start, length in zip(
+            self.timestamps.tolist(),
+            self.can_ids.tolist(),
+            self.offsets.tolist(),
+            self.lengths.tolist(),
+        ):
+            yield time, can_id, bytes(buffer[start : start + length])
+
+    def payload_matrix(self, width: int = None) -> np.ndarray:
+        """
+        Gathers every payload into a zero padded 2-D uint8 array.
+
+        :param width: Number of columns, defaults to the longest payload
+        """
+        if width is None:
+            width = int(self.lengths.max()) if len(self) else 0
+        columns = np.arange(width)
+        mask = columns < self.lengths[:, None]
+        index = np.where(mask, self.offsets[:, None] + columns, 0)
+        return np.where(mask, self.buffer[index], 0).astype(np.uint8)
+
+    def strings(self) -> list[str]:
+        return [
+            self.buffer[start : start + length].tobytes().decode("latin-1")
+            for start, length in zip(self.string_offsets, self.string_lengths)
+        ]
+
+
+def _read_be_u32(buffer: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    words = buffer[offsets[:, None] + np.arange(4)].astype(np.uint32)
+    return (words[:, 0] << 24) | (words[:, 1] << 16) | (words[:, 2] << 8) | words[:, 3]
+
+
+def _scan_frames(input_data: bytes) -> tuple[Frames, int]:
+    """
+    Splits raw .data bytes into records and decodes the CAN headers in bulk.
+
+    The record walk only touches the length byte of each record; times, ids
+    and payload locations are then gathered with NumPy in one pass. Scanning
+    stops before a record that runs past the end of ``input_data``.
+
+    :param input_data: Contents (or a chunk) of a raw .data file
+    :returns: The complete records and the number of bytes they span
+    """
+    buffer = np.frombuffer(input_data, dtype=np.uint8)
+    size = len(input_data)
+
+    record_starts = []
+    append = record_starts.append
+    position = 0
+    while position < size:
+        length = input_data[position]
+        if length > STRING_LENGTH_OFFSET:
+            end = position + 1 + length - STRING_LENGTH_OFFSET
+        else:
+            end = position + 1 + CAN_HEADER_LENGTH + length
+        if end > size:
+            break
+        append(position)
+        position = end
+
+    starts = np.array(record_starts, dtype=np.int64)
+    record_lengths = buffer[starts]
+    is_string = record_lengths > STRING_LENGTH_OFFSET
+
+    can_starts = starts[~is_string]
+    string_starts = starts[is_string]
+
+    frames = Frames(
+        buffer=buffer,
+        timestamps=_read_be_u32(buffer, can_starts + 1),
+        can_ids=_read_be_u32(buffer, can_starts + 5),
+        offsets=can_starts + 1 + CAN_HEADER_LENGTH,
+        lengths=record_lengths[~is_string],
+        string_offsets=string_starts + 1,
+        string_lengths=(
+            record_lengths[is_string].astype(np.int64) - STRING_LENGTH_OFFSET
+        ),
+    )
+    return frames, position
+
+
+def parse_frames(input_data: bytes) -> Frames:
+    """
+    Parses a complete raw .data file.
+
+    :param input_data: Contents of a raw .data file
+    """
+    frames, consumed = _scan_frames(input_data)
+    if consumed != len(input_data):
+        raise Exception("file corruption detected")
+
+    return frames
+
+
+class FrameStream:
+    """
+    Incremental parsing of raw .data bytes that arrive in pieces, from a file that
+    is still being written, a pipe or a socket. The bytes of a record split between
+    pieces are kept until the rest of it arrives.
+    """
+
+    def __init__(self, offset: int = 0):
+        """
+        :param offset: Position in the source of the first byte fed
+        """
+        # Position in the source right after the last complete record
+        self.offset = offset
+        self._pending = b""
+
+    @property
+    def position(self) -> int:
+        """
+        Position in the source of the next byte to feed.
+        """
+        return self.offset + len(self._pending)
+
+    def feed(self, data: bytes) -> Frames:
+        """
+        :returns: The records completed by ``data``
+        """
+        data = self._pending + data
+        frames, consumed = _scan_frames(data)
+        self._pending = data[consumed:]
+        self.offset += consumed
+        return frames
+
+
+def _map_file(input_filepath: str) -> memoryview:
+    """
+    Maps a raw .data file read only, so it is paged in from disk as it is parsed
+    instead of copied into memory. The mapping lives as long as any Frames using it.
+    """
     if not os.path.exists(input_filepath):
         raise FileNotFoundError("input_filepath does not exist")
 
     with open(input_filepath, "rb") as file:
-        input_data = file.read()
-    output_string = ""
-
-    # Data file structure
-
-    # String structure
-    # 1B length + 127
-    # xB data
-
-    # CAN message structure
-    # 1B length
-    # 4B time (big endian)
-    # 4B message id (big endian)
-    # xB data
-
-    data_length = 0
-    cur_data_index = 0
-    string_read_mode = False
-
-    for i, byte in enumerate(input_data):
-
-        # tranisiton to reading next line
-        if cur_data_index == data_length:
-            data_length = byte
-            output_string = output_string[:-1]  # remove previous line's trailing comma
-            output_string += "\n"
-            if byte > 127:
-                data_length -= 127
-                string_read_mode = True
-                cur_data_index = 0  # start directly at the string data
-            else:
-                string_read_mode = False
-                cur_data_index = -8  # start by reading this line's metadata
+        if os.fstat(file.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
 
-        # read data in current line
-        else:
-            if string_read_mode:
-                output_string += chr(byte)
+
+def read_frames(input_filepath: str) -> Frames:
+    return parse_frames(_map_file(input_filepath))
+
+
+def iter_frames(
+    input_filepath: str,
+    chunk_size: int = CHUNK_SIZE,
+    start: int = 0,
+    end=None,
+    report: Callable[[int, int], None] | None = None,
+):
+    """
+    Yields Frames for consecutive chunks of a memory mapped raw .data file, so
+    memory use is bounded by ``chunk_size`` rather than the file size. A chunk
+    ends at the last complete record and the next one starts right after it.
+
+    :param input_filepath: Path of the raw .data file
+    :param chunk_size: Number of bytes scanned at a time
+    :param start: Offset of the first record to read, see shard_offsets
+    :param end: Offset where reading stops, defaults to the end of the file
+    :param report: Called with the bytes read so far and the bytes to read
+    """
+    input_data = _map_file(input_filepath)[start:end]
+    chunk_size = max(chunk_size, MAX_RECORD_LENGTH)
+
+    position = 0
+    while position < len(input_data):
+        frames, consumed = _scan_frames(input_data[position : position + chunk_size])
+        if consumed == 0:
+            # Only an incomplete record is left
+            raise Exception("file corruption detected")
+        position += consumed
+        if report is not None:
+            report(position, len(input_data))
+        yield frames
+
+
+def shard_offsets(input_filepath: str, shard_count: int) -> list[int]:
+    """
+    Splits a raw .data file into at most ``shard_count`` ranges of about the same
+    size that start and end on record boundaries. Records carry no sync marker, so
+    this walks the length bytes from the start of the file.
+
+    :returns: Increasing offsets, starting with 0 and ending with the file size.
+        Shard i is ``offsets[i]:offsets[i + 1]``
+    """
+    input_data = _map_file(input_filepath)
+    size = len(input_data)
+
+    offsets = [0]
+    position = 0
+    for shard in range(1, shard_count):
+        target = size * shard // shard_count
+        while position < target:
+            length = input_data[position]
+            if length > STRING_LENGTH_OFFSET:
+                position += 1 + length - STRING_LENGTH_OFFSET
             else:
-                if (
-                    cur_data_index < 0
-                ):  # read message metadata (time and id, each 4 bytes)
-                    relative_index = (cur_data_index + 1) % 4
-                    if relative_index == 0:
-                        number = int.from_bytes(input_data[i - 3 : i + 1])
-                        output_string += str(number) + ","
-
-                else:
-                    output_string += str(byte) + ","
-            cur_data_index += 1
-
-    if cur_data_index != data_length:
-        raise Exception("file corruption detected")
+                position += 1 + CAN_HEADER_LENGTH + length
+        # Past the end, the last shard reports the corruption
+        if position >= size:
+            break
+        if position > offsets[-1]:
+            offsets.append(position)
+
+    if size > 0:
+        offsets.append(size)
+    return offsets
+
+
+def to_text(frames: Frames) -> str:
+    """
+    Serializes frames into the legacy "unknown" text layout: a blank first
+    line, then one line per record (``time,id,byte,byte,...`` for CAN records
+    and the string contents minus their final character for string records).
+    """
+    lines = [
+        f"{time},{can_id}" + "".join(f",{byte}" for byte in frames.payload(i))
+        for i, (time, can_id) in enumerate(
+            zip(frames.timestamps.tolist(), frames.can_ids.tolist())
+        )
+    ]
+    strings = [text[:-1] for text in frames.strings()]
+    if not lines and not strings:
+        return ""
+
+    # Interleave both record kinds back into file order
+    order = np.argsort(
+        np.concatenate((frames.offsets, frames.string_offsets)), kind="stable"
+    )
+    records = lines + strings
+    return "\n" + "\n".join(records[i] for i in order)
+
+
+def deserialize(input_filepath: str, output_filepath: str) -> None:
+    if not os.path.exists(input_filepath):
+        raise FileNotFoundError("input_filepath does not exist")
 
-    output_string = output_string[:-1]  # remove final trailing comma
     with open(output_filepath, "w") as file:
-        file.write(output_string)
+        for frames in iter_frames(input_filepath):
+            file.write(to_text(frames))
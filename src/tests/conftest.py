@@ -0,0 +1,46 @@
+import pytest
+
+from unknown_to_known import dbc_cache
+
+# GPS clock, plain, scaled, float, value table and multiplexed signals, for logs
+# written with benchmarks.synthetic_log
+DBC = """
+VERSION ""
+
+BU_: ECU
+
+BO_ 100 GPS_Time: 8 ECU
+ SG_ Time : 0|32@1+ (1,0) [0|4294967295] "" ECU
+ SG_ Date : 32|32@1+ (1,0) [0|4294967295] "" ECU
+
+BO_ 200 Motor: 8 ECU
+ SG_ RPM : 0|16@1+ (1,0) [0|65535] "rpm" ECU
+ SG_ Temp : 16|12@1- (0.1,-40) [-244.8|164.7] "degC" ECU
+ SG_ State : 28|4@1+ (1,0) [0|15] "" ECU
+
+BO_ 300 Floaty: 8 ECU
+ SG_ Pressure : 0|32@1- (1,0) [0|0] "kPa" ECU
+ SG_ Small : 39|8@0- (1,0) [-128|127] "" ECU
+
+BO_ 400 Muxed: 4 ECU
+ SG_ Mux M : 0|8@1+ (1,0) [0|255] "" ECU
+ SG_ A m0 : 8|16@1+ (1,0) [0|65535] "" ECU
+ SG_ B m1 : 8|16@1- (0.5,0) [-16384|16383.5] "" ECU
+
+VAL_ 200 State 0 "Off" 1 "On" ;
+SIG_VALTYPE_ 300 Pressure : 1;
+"""
+
+
+@pytest.fixture
+def dbc_name(tmp_path, monkeypatch) -> str:
+    """
+    Puts DBC in a DATA_DIR of its own and returns its file name.
+    """
+    # Spawned decode workers read DATA_DIR again
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(dbc_cache, "DBC_DIR", tmp_path / "DBCFiles")
+    monkeypatch.setattr(dbc_cache, "DBC_CACHE_DIR", tmp_path / "dbc_cache")
+    (tmp_path / "DBCFiles").mkdir()
+    (tmp_path / "DBCFiles" / "test.dbc").write_text(DBC)
+    return "test.dbc"
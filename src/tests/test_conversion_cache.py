@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from app import conversion_cache, pipeline
+from app.conversion_cache import ConversionCache, conversion_key
+from app.models import ConversionProgress
+from unknown_to_known import dbc_cache
+
+
+@pytest.fixture
+def dbc(tmp_path, monkeypatch):
+    monkeypatch.setattr(dbc_cache, "DBC_DIR", tmp_path)
+    path = tmp_path / "test.dbc"
+    path.write_text('VERSION "1"\n')
+    return path
+
+
+def _raw(path, data: bytes = b"\x00" * 9 * 100):
+    path.write_bytes(data)
+    return path
+
+
+def _fill(entry, size: int) -> None:
+    (entry / "known.parquet").write_bytes(b"\x00" * size)
+
+
+def test_identical_upload_reuses_finished_stages(tmp_path, dbc):
+    cache = ConversionCache(tmp_path / "cache", max_bytes=1 << 20)
+    calls = []
+
+    def stage(report=None):
+        calls.append(report)
+
+    def convert(raw_path) -> ConversionProgress:
+        progress = ConversionProgress(name=raw_path.name)
+        with cache.entry(conversion_key(raw_path, dbc.name)) as entry:
+            pipeline.run_stages(
+                [
+                    pipeline.Stage(
+                        "decode", stage, marker=conversion_cache.marker(entry, "decode")
+                    )
+                ],
+                progress,
+            )
+        return progress
+
+    first = convert(_raw(tmp_path / "first.data"))
+    # Same bytes under another name
+    second = convert(_raw(tmp_path / "second.data"))
+
+    assert len(calls) == 1
+    assert not first.stages["decode"].cached
+    assert second.stages["decode"].cached
+    assert second.stages["decode"].state == "done"
+
+
+def test_changed_dbc_or_pipeline_version_misses(tmp_path, dbc, monkeypatch):
+    raw_path = _raw(tmp_path / "log.data")
+    key = conversion_key(raw_path, dbc.name)
+    assert conversion_key(raw_path, dbc.name) == key
+    assert conversion_key(raw_path, dbc.name, layout="wide") != key
+
+    dbc.write_text('VERSION "2"\n')
+    changed_dbc = conversion_key(raw_path, dbc.name)
+    assert changed_dbc != key
+
+    monkeypatch.setattr(
+        conversion_cache, "PIPELINE_VERSION", conversion_cache.PIPELINE_VERSION + 1
+    )
+    assert conversion_key(raw_path, dbc.name) not in (key, changed_dbc)
+
+
+def test_eviction_skips_entries_in_use(tmp_path):
+    cache = ConversionCache(tmp_path, max_bytes=2500)
+    for key in ("running", "old"):
+        with cache.entry(key) as entry:
+            _fill(entry, 1000)
+
+    # Converted again, e.g. resuming the stages that failed
+    with cache.entry("running") as running:
+        # Least recently used of all, but still being converted
+        os.utime(running / conversion_cache.LAST_USED_FILENAME, (0, 0))
+
+        with cache.entry("new") as entry:
+            _fill(entry, 1000)
+
+        assert running.exists()
+        assert not (tmp_path / "old").exists()
+        assert (tmp_path / "new").exists()
+
+
+def test_eviction_waits_for_an_entry_to_be_released(tmp_path):
+    cache = ConversionCache(tmp_path, max_bytes=500)
+    with cache.entry("held") as held:
+        _fill(held, 1000)
+        # Over max_bytes while held, even by another user of the cache
+        cache.evict()
+        assert held.exists()
+
+    # Nothing holds it anymore, and it alone is over max_bytes
+    assert not held.exists()
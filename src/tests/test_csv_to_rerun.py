@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+from csv_to_rerun.csv_to_rerun import gps_track
+
+
+def _rows(sensor: str, timestamps, values) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "Timestamp": timestamps,
+            "time_s": np.array(timestamps) / 1000.0,
+            "Sensor": sensor,
+            "Value": values,
+        }
+    )
+
+
+def test_gps_track_pairs_signals_of_separate_messages():
+    # Latitude and Longitude on two CAN frames logged a few ms apart
+    df = pd.concat(
+        [
+            _rows("Latitude", [100, 200, 300, 900], [39.75, 39.76, 39.77, 39.78]),
+            _rows("Longitude", [104, 197, 306, 600], [-105.2, -105.3, -105.4, -105.5]),
+            _rows("Speed", [100, 200], [10.0, 11.0]),
+        ],
+        ignore_index=True,
+    )
+
+    track = gps_track(df.sample(frac=1, random_state=0))
+
+    assert track["Timestamp"].tolist() == [100, 200, 300]
+    assert track["time_s"].tolist() == [0.1, 0.2, 0.3]
+    assert track["Latitude"].tolist() == [39.75, 39.76, 39.77]
+    assert track["Longitude"].tolist() == [-105.2, -105.3, -105.4]
+
+
+def test_gps_track_keeps_the_last_sample_of_a_timestamp():
+    df = pd.concat(
+        [
+            _rows("Latitude", [100, 100], [39.0, 39.5]),
+            _rows("Longitude", [100], [-105.0]),
+        ],
+        ignore_index=True,
+    )
+
+    track = gps_track(df)
+
+    assert track[["Latitude", "Longitude"]].values.tolist() == [[39.5, -105.0]]
@@ -0,0 +1,86 @@
+import filecmp
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from benchmarks.synthetic_log import write_synthetic_log
+from raw_to_unknown import deserializer
+from unknown_to_known import known_file
+from unknown_to_known.decode import make_known, make_known_sharded
+
+
+@pytest.fixture
+def raw_log(tmp_path, dbc_name):
+    path = tmp_path / "log.data"
+    write_synthetic_log(
+        str(path),
+        20000,
+        dbc_name=dbc_name,
+        string_fraction=0.01,
+        unknown_fraction=0.01,
+    )
+    return path
+
+
+def _assert_same_table(expected, actual) -> None:
+    expected, actual = pq.read_table(expected), pq.read_table(actual)
+    assert actual.schema.equals(expected.schema, check_metadata=True)
+    # Each shard has its own dictionary of sensor names and units
+    pd.testing.assert_frame_equal(
+        actual.to_pandas().astype(str), expected.to_pandas().astype(str)
+    )
+
+
+def _assert_same_known(expected, actual) -> None:
+    if not known_file.is_wide(expected):
+        _assert_same_table(expected, actual)
+        return
+
+    names = sorted(path.name for path in expected.iterdir())
+    assert sorted(path.name for path in actual.iterdir()) == names
+    for name in names:
+        _assert_same_table(expected / name, actual / name)
+
+
+@pytest.mark.parametrize(
+    "known_name", ["known.parquet", "known" + known_file.WIDE_SUFFIX]
+)
+def test_sharded_decode_matches_make_known(tmp_path, raw_log, dbc_name, known_name):
+    outputs = {}
+    for name in ("whole", "sharded"):
+        (tmp_path / name).mkdir()
+        outputs[name] = [
+            tmp_path / name / "known.csv",
+            tmp_path / name / "failed.log",
+            tmp_path / name / known_name,
+        ]
+
+    whole_csv, whole_log, whole_known = outputs["whole"]
+    expected = make_known(
+        deserializer.iter_frames(str(raw_log)),
+        str(whole_csv),
+        str(whole_log),
+        batch_size=1000,
+        dbc_name=dbc_name,
+        parquet_file_name=str(whole_known),
+    )
+
+    sharded_csv, sharded_log, sharded_known = outputs["sharded"]
+    stats = make_known_sharded(
+        str(raw_log),
+        str(sharded_csv),
+        str(sharded_log),
+        batch_size=1000,
+        dbc_name=dbc_name,
+        parquet_file_name=str(sharded_known),
+        workers=2,
+        min_shard_size=4096,
+    )
+
+    # More than one shard was decoded by the workers
+    assert stats.worker_peak_memory is not None
+    assert filecmp.cmp(whole_csv, sharded_csv, shallow=False)
+    assert filecmp.cmp(whole_log, sharded_log, shallow=False)
+    _assert_same_known(whole_known, sharded_known)
+    assert stats.to_dict() == expected.to_dict()
@@ -0,0 +1,102 @@
+import random
+
+import cantools
+import numpy as np
+import pytest
+
+from raw_to_unknown.deserializer import Frames
+from unknown_to_known.decode_plan import build_plans
+
+DBC = """
+VERSION ""
+
+BU_: ECU
+
+BO_ 256 Little: 8 ECU
+ SG_ Counter : 0|4@1+ (1,0) [0|15] "" ECU
+ SG_ Temp : 4|12@1- (0.1,-40) [-244.8|164.7] "degC" ECU
+ SG_ Pressure : 16|32@1- (1,0) [0|0] "kPa" ECU
+ SG_ State : 48|3@1+ (1,0) [0|7] "" ECU
+ SG_ Scaled : 51|13@1+ (2,5) [5|16387] "" ECU
+
+BO_ 257 Big: 8 ECU
+ SG_ Speed : 7|16@0+ (1,0) [0|65535] "rpm" ECU
+ SG_ Torque : 21|11@0- (1,0) [-1024|1023] "Nm" ECU
+ SG_ Angle : 37|20@0+ (0.5,-100) [-100|524187.5] "deg" ECU
+ SG_ Trim : 63|8@0- (1,0) [-128|127] "" ECU
+
+BO_ 258 Odometer: 8 ECU
+ SG_ Distance : 0|64@1+ (1,0) [0|18446744073709551615] "m" ECU
+
+BO_ 259 Precise: 8 ECU
+ SG_ Voltage : 0|64@1- (1,0) [0|0] "V" ECU
+
+BO_ 260 Offset: 8 ECU
+ SG_ Position : 7|64@0- (1,0) [-9223372036854775808|9223372036854775807] "" ECU
+
+BO_ 261 Short: 4 ECU
+ SG_ Level : 0|16@1+ (0.01,0) [0|655.35] "%" ECU
+ SG_ Flags : 24|8@1+ (1,0) [0|255] "" ECU
+
+BO_ 262 Muxed: 8 ECU
+ SG_ Mux M : 0|8@1+ (1,0) [0|255] "" ECU
+ SG_ A m0 : 8|16@1+ (1,0) [0|65535] "" ECU
+ SG_ B m1 : 8|16@1- (0.5,0) [-16384|16383.5] "" ECU
+
+BO_ 263 Long: 12 ECU
+ SG_ Head : 0|32@1+ (1,0) [0|4294967295] "" ECU
+ SG_ Tail : 64|32@1- (1,0) [-2147483648|2147483647] "" ECU
+
+VAL_ 256 State 0 "Off" 1 "On" 2 "Fault" ;
+SIG_VALTYPE_ 256 Pressure : 1;
+SIG_VALTYPE_ 259 Voltage : 2;
+"""
+
+
+@pytest.fixture(scope="module")
+def db():
+    return cantools.database.load_string(DBC, "dbc")
+
+
+def _frames(can_id: int, seed: int) -> Frames:
+    rng = random.Random(seed)
+    payloads = [
+        bytes(rng.randrange(256) for _ in range(rng.randrange(14))) for _ in range(300)
+    ]
+    # Multiplexer values with and without signals
+    payloads += [bytes([mux]) + bytes(7) for mux in range(3)]
+    return Frames.from_records([(i, can_id, data) for i, data in enumerate(payloads)])
+
+
+@pytest.mark.parametrize("can_id", range(256, 264))
+def test_message_plan_matches_cantools(db, can_id):
+    plan = build_plans(db)[can_id]
+    assert plan.vectorized == (can_id not in (262, 263))
+
+    frames = _frames(can_id, seed=can_id)
+    decoded = plan.decode(frames)
+    text = plan.text(decoded)
+    values = plan.values(decoded)
+
+    decoded_index = 0
+    for i, (_, _, data) in enumerate(frames.records()):
+        try:
+            expected = db.decode_message(can_id, data)
+        except Exception:
+            assert not decoded.ok[i]
+            continue
+        assert decoded.ok[i]
+
+        unscaled = db.decode_message(can_id, data, decode_choices=False)
+        for column, value_column, signal in zip(text, values, plan.signals):
+            name = signal.name
+            assert column[decoded_index] == str(expected.get(name))
+            if unscaled.get(name) is None:
+                assert np.isnan(value_column[decoded_index])
+            else:
+                np.testing.assert_equal(
+                    value_column[decoded_index], float(unscaled[name])
+                )
+        decoded_index += 1
+
+    assert decoded_index == decoded.ok.sum()
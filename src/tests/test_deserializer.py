@@ -0,0 +1,124 @@
+import random
+
+import pytest
+
+from raw_to_unknown.deserializer import (
+    FrameStream,
+    deserialize,
+    iter_frames,
+    parse_frames,
+    shard_offsets,
+    to_text,
+)
+
+
+def _can(time: int, can_id: int, payload: bytes) -> bytes:
+    return (
+        bytes([len(payload)])
+        + time.to_bytes(4, "big")
+        + can_id.to_bytes(4, "big")
+        + payload
+    )
+
+
+def _string(text: bytes) -> bytes:
+    return bytes([len(text) + 127]) + text
+
+
+def _random_records(count: int, seed: int = 0) -> list[bytes]:
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        if rng.random() < 0.05:
+            records.append(_string(b"event %d\n" % i))
+        else:
+            payload = bytes(rng.randrange(256) for _ in range(rng.randrange(9)))
+            records.append(_can(i, rng.choice([100, 200, 0x7FF]), payload))
+    return records
+
+
+def _write(path, records: list[bytes]):
+    path.write_bytes(b"".join(records))
+    return path
+
+
+def test_to_text_matches_the_legacy_layout(tmp_path):
+    data = b"".join(
+        [
+            _string(b"MF13 log\n"),
+            _can(1000, 100, b"\x01\x02\xff"),
+            _can(4294967295, 513, b""),
+            _string(b"x\n"),
+            _can(7, 0x12345678, b"\x00"),
+        ]
+    )
+    expected = "\nMF13 log\n1000,100,1,2,255\n4294967295,513\nx\n7,305419896,0"
+    assert to_text(parse_frames(data)) == expected
+
+    output = tmp_path / "unknown.txt"
+    deserialize(str(_write(tmp_path / "log.data", [data])), str(output))
+    assert output.read_text() == expected
+
+
+def test_empty_file_is_empty_text(tmp_path):
+    output = tmp_path / "unknown.txt"
+    deserialize(str(_write(tmp_path / "log.data", [])), str(output))
+    assert output.read_text() == ""
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        # CAN header cut short
+        _can(1, 100, b"\x01\x02")[:6],
+        # Payload cut short
+        _can(1, 100, b"\x01\x02")[:-1],
+        # Length byte of a string longer than what is left
+        _can(1, 100, b"") + bytes([200]) + b"abc",
+    ],
+)
+def test_truncated_record_is_corruption(tmp_path, data):
+    with pytest.raises(Exception, match="file corruption detected"):
+        parse_frames(data)
+    with pytest.raises(Exception, match="file corruption detected"):
+        deserialize(str(_write(tmp_path / "log.data", [data])), str(tmp_path / "out"))
+
+
+def test_frame_stream_joins_records_split_between_pieces():
+    data = b"".join(_random_records(300))
+    whole = parse_frames(data)
+
+    stream = FrameStream()
+    records, strings = [], []
+    for start in range(0, len(data), 7):
+        frames = stream.feed(data[start : start + 7])
+        records += frames.records()
+        strings += frames.strings()
+        assert stream.position == start + len(data[start : start + 7])
+
+    assert records == list(whole.records())
+    assert strings == whole.strings()
+    assert stream.offset == len(data)
+
+
+def test_shard_offsets_fall_on_record_boundaries(tmp_path):
+    records = _random_records(2000, seed=1)
+    path = _write(tmp_path / "log.data", records)
+    boundaries = {0}
+    for record in records:
+        boundaries.add(max(boundaries) + len(record))
+    whole = list(parse_frames(path.read_bytes()).records())
+
+    for shard_count in range(1, 12):
+        offsets = shard_offsets(str(path), shard_count)
+        assert offsets[0] == 0 and offsets[-1] == path.stat().st_size
+        assert offsets == sorted(set(offsets))
+        assert set(offsets) <= boundaries
+
+        shards = [
+            record
+            for start, end in zip(offsets, offsets[1:])
+            for frames in iter_frames(str(path), chunk_size=1, start=start, end=end)
+            for record in frames.records()
+        ]
+        assert shards == whole
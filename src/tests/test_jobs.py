@@ -0,0 +1,106 @@
+import threading
+import time
+
+from app.jobs import DONE, QUEUED, RUNNING, JobQueue, Scheduler
+from app.models import LimitedDict
+
+
+def _submit(queue: JobQueue, count: int, task: str = "task") -> list[str]:
+    ids = [f"{task}-{i}" for i in range(count)]
+    queue.submit(task, [(job_id, f"{job_id}.data", "/raw") for job_id in ids], None)
+    return ids
+
+
+def _wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_job_is_claimed_once(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    ids = _submit(JobQueue(path), 40)
+
+    claimed = []
+    lock = threading.Lock()
+
+    def claim_all():
+        # One queue per thread, like separate connections of separate processes
+        queue = JobQueue(path)
+        while (job := queue.claim()) is not None:
+            with lock:
+                claimed.append(job.id)
+
+    threads = [threading.Thread(target=claim_all) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(ids)
+
+
+def test_running_jobs_are_queued_again_after_a_restart(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    queue = JobQueue(path)
+    first, second = _submit(queue, 2)
+    assert queue.claim().id == first
+
+    # A new process opens the same database
+    restarted = JobQueue(path)
+    assert restarted.requeue_running() == 1
+    assert [job.state for job in restarted.jobs("task")] == [QUEUED, QUEUED]
+    assert restarted.claim().id == first
+    assert restarted.claim().id == second
+
+
+def test_scheduler_runs_at_most_max_running_jobs(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    release = threading.Event()
+    state = {"running": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def run_job(job):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        release.wait(timeout=10)
+        with lock:
+            state["running"] -= 1
+
+    scheduler = Scheduler(queue, run_job, max_running=2)
+    scheduler.start()
+    _submit(queue, 6)
+    scheduler.notify()
+
+    assert _wait_for(lambda: queue.counts()[RUNNING] == 2)
+    # Give the scheduler the chance to claim more than it may
+    time.sleep(0.2)
+    assert queue.counts()[RUNNING] == 2
+    assert queue.counts()[QUEUED] == 4
+
+    release.set()
+    assert _wait_for(lambda: queue.counts()[DONE] == 6)
+    assert state["peak"] == 2
+
+
+def test_limited_dict_never_removes_kept_items():
+    items = LimitedDict(2, keep=lambda value: value == RUNNING)
+    items["a"] = RUNNING
+    items["b"] = DONE
+    items["c"] = RUNNING
+    # The oldest item that may go is removed, not the oldest one
+    assert list(items) == ["a", "c"]
+
+    # Stays over max_size while everything left is running
+    items["d"] = RUNNING
+    assert list(items) == ["a", "c", "d"]
+    items["e"] = DONE
+    assert list(items) == ["a", "c", "d"]
+
+    # A finished item goes once there is room to free
+    items["a"] = DONE
+    assert list(items) == ["c", "d"]
@@ -0,0 +1,76 @@
+import cantools
+import numpy as np
+import pandas as pd
+
+from known_to_influxdb.line_protocol import LineProtocolEncoder, iter_lineprotocol
+from unknown_to_known.clock_alignment import ClockMapping
+from unknown_to_known import known_file
+from unknown_to_known.decode_plan import build_plans, field_types, integer_fields
+
+# Temp is an integer on 0x200 and scaled by 0.1 on 0x201
+DBC = """
+VERSION ""
+
+BU_: ECU
+
+BO_ 512 Front: 8 ECU
+ SG_ Temp : 0|16@1+ (1,0) [0|65535] "degC" ECU
+ SG_ RPM : 16|16@1+ (1,0) [0|65535] "rpm" ECU
+
+BO_ 513 Rear: 8 ECU
+ SG_ Temp : 0|16@1+ (0.1,0) [0|6553.5] "degC" ECU
+
+BO_ 514 Odometer: 8 ECU
+ SG_ Distance : 0|64@1+ (1,0) [0|18446744073709551615] "m" ECU
+"""
+
+
+def _plans():
+    return build_plans(cantools.database.load_string(DBC, "dbc"))
+
+
+def test_shared_sensor_name_is_float_for_every_can_id():
+    assert integer_fields(_plans()) == [(512, "RPM")]
+
+
+def test_wide_file_keeps_integer_and_64_bit_values(tmp_path):
+    plans = _plans()
+    path = tmp_path / ("known" + known_file.WIDE_SUFFIX)
+    with known_file.WideKnownWriter(path, integer_fields(plans)) as writer:
+        writer.write_message(
+            plans[512],
+            np.array([0, 1]),
+            [np.array([20.0, 21.0]), np.array([1200.0, np.nan])],
+        )
+        # Past int64, too long for integer fields
+        writer.write_message(plans[514], np.array([2]), [np.array([2.0**63])])
+
+    lines = b"".join(iter_lineprotocol(path, clock=ClockMapping(offset=0)))
+    assert lines.decode().splitlines() == [
+        "Temp,can_id=512 value=20.0 0",
+        "Temp,can_id=512 value=21.0 1",
+        "RPM,can_id=512 value=1200i 0",
+        "Distance,can_id=514 value=9.223372036854776e+18 2",
+    ]
+
+
+def test_shared_sensor_name_keeps_scaled_values(tmp_path):
+    path = tmp_path / "known.parquet"
+    rows = pd.DataFrame(
+        {
+            "Timestamp": [0, 1, 2],
+            "CANID": [512, 513, 512],
+            "Sensor": pd.Categorical(["Temp", "Temp", "RPM"]),
+            "Value": [23.0, 23.5, 1200.0],
+            "Unit": pd.Categorical(["degC", "degC", "rpm"]),
+        }
+    )
+    with known_file.KnownWriter(path, field_types(_plans())) as writer:
+        writer.write(rows)
+
+    encoder = LineProtocolEncoder(integer_fields=known_file.integer_fields(path))
+    assert encoder.encode(rows).decode().splitlines() == [
+        "Temp,can_id=512 value=23.0 0",
+        "Temp,can_id=513 value=23.5 1",
+        "RPM,can_id=512 value=1200i 2",
+    ]
@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+
+import pytest
+
+from app import app as server
+from app.jobs import JobQueue
+from app.models import ChangeFeed, ConversionProgress, StageStatus
+
+
+def _event(chunk: bytes) -> tuple[str, dict]:
+    event, data = chunk.decode().strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def _waiters(feed: ChangeFeed) -> int:
+    return len(feed._condition._waiters)
+
+
+@pytest.fixture
+def task(tmp_path, monkeypatch):
+    """
+    One running job of the task "task", with its progress.
+    """
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    (job,) = queue.submit("task", [("job", "log.data", "/raw")], None)
+    queue.claim()
+    feed = ChangeFeed()
+    progress = ConversionProgress(name=job.id, on_change=lambda: feed.changed("task"))
+
+    monkeypatch.setattr(server, "job_queue", queue)
+    monkeypatch.setattr(server, "progress_changes", feed)
+    monkeypatch.setitem(server.app.config["progress"], job.id, progress)
+    return queue, feed, progress
+
+
+def test_progress_change_is_pushed(task):
+    queue, feed, progress = task
+    response = server.app.test_client().get(
+        "/progress/stream?name=task", buffered=False
+    )
+    assert response.mimetype == "text/event-stream"
+    stream = response.iter_encoded()
+    assert next(stream) == b"retry: 2000\n\n"
+    assert _event(next(stream))[0] == "progress"
+
+    waiting = []
+
+    def convert():
+        # The stream is waiting for a change by now
+        waiting.append(_waiters(feed))
+        progress.stages["decode"] = StageStatus(state=StageStatus.RUNNING)
+        progress.progress = 30
+        progress.changed()
+
+    threading.Timer(0.2, convert).start()
+    event, stage = _event(next(stream))
+    assert waiting == [1]
+    assert (event, stage["stage"], stage["state"]) == ("stage", "decode", "running")
+    event, current = _event(next(stream))
+    assert (event, current["progress"]) == ("progress", 30)
+
+    def finish():
+        queue.finish("job")
+        progress.finished = True
+        progress.changed()
+
+    threading.Timer(0.2, finish).start()
+    assert _event(next(stream))[0] == "progress"
+    assert _event(next(stream)) == (
+        "done",
+        {"progress": 30, "exception": {"present": False, "type": "None"}},
+    )
+    assert list(stream) == []
+    assert _waiters(feed) == 0
+
+
+def test_disconnected_client_stops_waiting(task, monkeypatch):
+    _, feed, _ = task
+    monkeypatch.setattr(server, "STREAM_HEARTBEAT", 0.5)
+    response = server.app.test_client().get(
+        "/progress/stream?name=task", buffered=False
+    )
+    stream = response.iter_encoded()
+    next(stream), next(stream)
+
+    # The server thread waits for a change that never comes
+    heartbeats = []
+    serving = threading.Thread(target=lambda: heartbeats.append(next(stream)))
+    serving.start()
+    time.sleep(0.1)
+    assert _waiters(feed) == 1
+
+    # The client is gone: the wait ends on its own, and writing the heartbeat
+    # fails, so the server closes the response
+    serving.join(timeout=5)
+    assert heartbeats == [b": keep-alive\n\n"]
+    assert _waiters(feed) == 0
+    response.close()
+
+    feed.changed("task")
+    assert _waiters(feed) == 0
+    assert list(stream) == []
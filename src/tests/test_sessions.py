@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from app import app as server
+from app.sessions import SessionIndex, summarize
+from benchmarks.synthetic_log import write_synthetic_log
+from raw_to_unknown import deserializer
+from unknown_to_known.decode import make_known
+
+
+@pytest.fixture
+def far_east(monkeypatch):
+    """
+    Runs the test at UTC+14, where a day starts 14 hours before the UTC day.
+    """
+    monkeypatch.setenv("TZ", "Pacific/Kiritimati")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def client(tmp_path, dbc_name, monkeypatch):
+    # 5 s of log from 2026-10-18 12:00:00 UTC, see synthetic_log
+    raw_path = tmp_path / "log.data"
+    write_synthetic_log(str(raw_path), 40000, dbc_name=dbc_name)
+    stats = make_known(
+        deserializer.iter_frames(str(raw_path)),
+        None,
+        dbc_name=dbc_name,
+        parquet_file_name=str(tmp_path / "known.parquet"),
+    )
+    summary = summarize(stats, dbc_name)
+
+    index = SessionIndex(tmp_path / "sessions.sqlite3")
+    index.add("gps", "log.data", summary)
+    # A log without a clock has no time span, only sensors
+    index.add(
+        "no_clock",
+        "bench.data",
+        {**summary, "clock": None, "sensors": {"RPM": summary["sensors"]["RPM"]}},
+    )
+    monkeypatch.setattr(server, "session_index", index)
+    return server.app.test_client()
+
+
+def _ids(client, query: str) -> set[str]:
+    response = client.get(f"/sessions?{query}")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["total"] == len(body["sessions"])
+    return {session["id"] for session in body["sessions"]}
+
+
+def test_sessions_filtered_by_time_and_sensor(client, far_east):
+    assert _ids(client, "") == {"gps", "no_clock"}
+
+    # Dates and times without an offset are UTC, whatever the server's zone
+    assert _ids(client, "date=2026-10-18") == {"gps"}
+    assert _ids(client, "date=2026-10-17") == set()
+    assert _ids(client, "start=2026-10-18T12:00:02&end=2026-10-18T12:00:03") == {"gps"}
+    assert _ids(client, "start=2026-10-18T12:00:06") == set()
+    assert _ids(client, "end=2026-10-18T13:59:59%2B02:00") == set()
+    assert _ids(client, "start=2026-10-18T13:59:59%2B02:00") == {"gps"}
+    assert _ids(client, "start=1792324801&end=1792324802") == {"gps"}
+
+    assert _ids(client, "sensor=RPM") == {"gps", "no_clock"}
+    assert _ids(client, "sensor=RPM&sensor=Pressure") == {"gps"}
+    assert _ids(client, "sensor=Pressure&date=2026-10-19") == set()
+    assert _ids(client, "sensor=Unknown") == set()
+
+    assert client.get("/sessions?date=yesterday").status_code == 400
+
+
+def test_session_and_sensor_lists(client):
+    session = client.get("/sessions/gps").get_json()
+    assert session["start_time"] == 1792324800.0
+    assert session["rerun_file"] == "log.data.rrd"
+    assert session["sensors"]["RPM"]["unit"] == "rpm"
+    assert client.get("/sessions/missing").status_code == 404
+
+    sensors = {entry["sensor"]: entry for entry in client.get("/sensors").get_json()}
+    assert sensors["RPM"] == {"sensor": "RPM", "unit": "rpm", "sessions": 2}
+    assert sensors["Pressure"]["sessions"] == 1
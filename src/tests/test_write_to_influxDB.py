@@ -0,0 +1,155 @@
+import gzip
+import threading
+import time
+
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from known_to_influxdb import write_to_influxDB
+from known_to_influxdb.write_to_influxDB import (
+    InfluxConfig,
+    InfluxWriteError,
+    InfluxWriter,
+)
+
+
+class StandIn:
+    """
+    Local stand-in for the InfluxDB write API. ``respond`` is called with every
+    request and returns the status, headers and body to answer with.
+    """
+
+    def __init__(self, respond=lambda request: (204, {}, b"")):
+        self.respond = respond
+        self.requests = []
+        self.lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                request = {
+                    "path": self.path,
+                    "headers": dict(self.headers),
+                    "lines": gzip.decompress(body),
+                }
+                with stand_in.lock:
+                    stand_in.requests.append(request)
+                status, headers, content = stand_in.respond(request)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def config(self) -> InfluxConfig:
+        host, port = self.server.server_address
+        return InfluxConfig(
+            url=f"http://{host}:{port}", org="mf", token="secret", bucket="raw"
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Records retry waits instead of sleeping.
+    """
+    delays = []
+    monkeypatch.setattr(write_to_influxDB.time, "sleep", delays.append)
+    return delays
+
+
+def test_batch_is_posted_gzipped_with_the_token():
+    with StandIn() as stand_in, InfluxWriter(stand_in.config) as writer:
+        writer.write_batch(b"Temp,can_id=512 value=23.5 0\n")
+
+    (request,) = stand_in.requests
+    assert request["path"] == "/api/v2/write?org=mf&bucket=raw&precision=ms"
+    assert request["headers"]["Authorization"] == "Token secret"
+    assert request["headers"]["Content-Encoding"] == "gzip"
+    assert request["lines"] == b"Temp,can_id=512 value=23.5 0\n"
+
+
+def test_busy_responses_are_retried_after_retry_after(sleeps):
+    answers = iter(
+        [
+            (429, {"Retry-After": "7"}, b"slow down"),
+            (503, {"Retry-After": formatdate(time.time() + 30, usegmt=True)}, b""),
+            (204, {}, b""),
+        ]
+    )
+    with StandIn(lambda request: next(answers)) as stand_in:
+        with InfluxWriter(stand_in.config, backoff=1000) as writer:
+            writer.write_batch(b"RPM,can_id=512 value=1200i 0\n")
+
+    assert len(stand_in.requests) == 3
+    assert sleeps[0] == 7
+    assert 28 < sleeps[1] <= 30
+
+
+def test_client_error_is_raised_without_retrying(sleeps):
+    with StandIn(lambda request: (400, {}, b"unable to parse")) as stand_in:
+        with InfluxWriter(stand_in.config) as writer:
+            with pytest.raises(InfluxWriteError) as error:
+                writer.write_batch(b"bad line\n")
+
+    assert error.value.status == 400
+    assert error.value.message == "unable to parse"
+    assert len(stand_in.requests) == 1
+    assert sleeps == []
+
+
+def test_batches_overlap_up_to_max_in_flight():
+    max_in_flight, count = 4, 12
+    # The first batches are answered together once all of them arrived
+    first = threading.Barrier(max_in_flight, timeout=5)
+    # The very first batch stays in flight until every later one was sent
+    rest_sent = threading.Event()
+    state = {"active": 0, "peak": 0, "seen": set()}
+    lock = threading.Lock()
+
+    def respond(request):
+        index = int(request["lines"])
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            state["seen"].add(index)
+            if state["seen"] >= set(range(max_in_flight, count)):
+                rest_sent.set()
+        if index < max_in_flight:
+            first.wait()
+        if index == 0:
+            state["released"] = rest_sent.wait(timeout=5)
+        with lock:
+            state["active"] -= 1
+        return 204, {}, b""
+
+    with StandIn(respond) as stand_in:
+        with InfluxWriter(stand_in.config, max_in_flight=max_in_flight) as writer:
+            writer.write_batches(b"%d\n" % i for i in range(count))
+
+    assert state["released"]
+    assert state["peak"] == max_in_flight
+    assert len(stand_in.requests) == count
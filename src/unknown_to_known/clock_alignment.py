@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+
+from dataclasses import asdict, dataclass
+
+"""
+Mapping from logger timestamps (ms since power on) to Unix time in ms, fitted from
+the clock sensors decoded from the log:
+
+    Date (DDMMYY) and Time (HHMMSSsss), UTC from the GPS
+    GPSWeek and GPSTimeOfWeek (ms), if the GPS sends them
+
+ClockSamples collects them while make_known decodes, keeping only the samples
+where a value changes: the logger timestamp of a new second is the closest to
+when that second started, and a long log only keeps a few samples per second.
+
+Clock values are noisy. Values that are not a valid date or time are tried again
+with their 4 bytes swapped, as some logs have them in the wrong byte order, and
+are dropped otherwise. Each sample gives an offset from logger time to Unix time.
+Offsets more than OUTLIER_MS from the median are dropped, and the rest are fitted
+with a line, so the drift of the logger's oscillator over a long session is
+corrected as well.
+"""
+
+DATE_SENSOR = "Date"
+TIME_SENSOR = "Time"
+GPS_WEEK_SENSOR = "GPSWeek"
+GPS_TIME_OF_WEEK_SENSOR = "GPSTimeOfWeek"
+CLOCK_SENSORS = (DATE_SENSOR, TIME_SENSOR, GPS_WEEK_SENSOR, GPS_TIME_OF_WEEK_SENSOR)
+
+# Samples further than this from the median offset are outliers
+OUTLIER_MS = 1000
+# Drift is only fitted over at least this much logger time
+MIN_DRIFT_SPAN_MS = 10 * 60 * 1000
+# A logger clock off by more than this (ms per ms) is a bad fit, not drift
+MAX_DRIFT = 1e-3
+
+MS_PER_WEEK = 7 * 24 * 3600 * 1000
+# 1980-01-06, start of GPS week 0
+GPS_EPOCH_MS = 315964800000
+# GPS time is ahead of UTC by the leap seconds since 1980
+GPS_LEAP_SECONDS = 18
+
+
+@dataclass(frozen=True)
+class ClockMapping:
+    # Unix time in ms at logger timestamp 0
+    offset: int
+    # Logger clock error in ms per ms
+    drift: float = 0.0
+    # Clock sensors the mapping was fitted from
+    source: str | None = None
+    samples: int = 0
+    inliers: int = 0
+    # Median distance in ms of the inliers to the mapping
+    residual: float | None = None
+
+    def to_unix(self, timestamps: np.ndarray) -> np.ndarray:
+        """
+        :param timestamps: Logger timestamps in ms
+        :returns: Unix times in ms, int64
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        unix = timestamps + self.offset
+        if self.drift:
+            unix += np.rint(timestamps * self.drift).astype(np.int64)
+        return unix
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, values: dict) -> "ClockMapping":
+        return cls(**values)
+
+
+# === PARSING ===
+
+
+def _swapped(values: np.ndarray) -> np.ndarray:
+    """
+    Values read with the wrong byte order, NaN where they don't fit in 4 bytes.
+    """
+    fits = (values >= 0) & (values <= 0xFFFFFFFF)
+    swapped = np.full(len(values), np.nan)
+    swapped[fits] = values[fits].astype(np.uint32).byteswap()
+    return swapped
+
+
+def _parse_dates(values: np.ndarray) -> np.ndarray:
+    """
+    :param values: DDMMYY
+    :returns: Unix ms of the start of each day, NaN when not a date
+    """
+    values = np.where(np.isfinite(values), np.floor(values), np.nan)
+    # Invalid days, months and days past the end of the month become NaT
+    dates = pd.to_datetime(
+        pd.DataFrame(
+            {
+                "year": 2000 + values % 100,
+                "month": values // 100 % 100,
+                "day": values // 10000,
+            }
+        ),
+        errors="coerce",
+    )
+    days = dates.to_numpy("datetime64[ms]").astype(np.int64).astype(np.float64)
+    days[dates.isna().to_numpy()] = np.nan
+    return days
+
+
+def _parse_times(values: np.ndarray) -> np.ndarray:
+    """
+    :param values: HHMMSSsss
+    :returns: ms since midnight, NaN when not a time of day
+    """
+    values = np.where(np.isfinite(values), np.floor(values), np.nan)
+    hours = values // 10_000_000
+    minutes = values // 100_000 % 100
+    seconds = values // 1000 % 100
+    ms = values % 1000
+    valid = (values >= 0) & (hours <= 23) & (minutes <= 59) & (seconds <= 59)
+    return np.where(valid, ((hours * 60 + minutes) * 60 + seconds) * 1000 + ms, np.nan)
+
+
+def _parse(parser, values: np.ndarray) -> np.ndarray:
+    """
+    Parses values, trying the byte swapped value of those that don't parse.
+    """
+    parsed = parser(values)
+    invalid = np.isnan(parsed)
+    if invalid.any():
+        parsed[invalid] = parser(_swapped(values[invalid]))
+    return parsed
+
+
+# === COLLECTING ===
+
+
+class ClockSamples:
+    """
+    Samples of the clock sensors of a log, where their value changes.
+    """
+
+    def __init__(self):
+        # Sensor -> (logger timestamps, values)
+        self.samples: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+    def add(self, sensor: str, timestamps: np.ndarray, values: np.ndarray) -> None:
+        """
+        :param timestamps: Logger timestamps of the values, in order
+        :param values: Values of one clock sensor, NaN for frames without it
+        """
+        present = ~np.isnan(values)
+        timestamps = np.asarray(timestamps, dtype=np.int64)[present]
+        values = values[present]
+        if len(values) == 0:
+            return
+
+        previous = self.samples.get(sensor)
+        last = previous[1][-1] if previous is not None else np.nan
+        changed = values != np.concatenate(([last], values[:-1]))
+        self._append(sensor, timestamps[changed], values[changed])
+
+    def _append(self, sensor: str, timestamps: np.ndarray, values: np.ndarray):
+        previous = self.samples.get(sensor)
+        if previous is not None:
+            timestamps = np.concatenate((previous[0], timestamps))
+            values = np.concatenate((previous[1], values))
+        self.samples[sensor] = (timestamps, values)
+
+    def merge(self, other: "ClockSamples") -> None:
+        """
+        Adds the samples of the part of the log that comes after this one.
+        """
+        for sensor, (timestamps, values) in other.samples.items():
+            previous = self.samples.get(sensor)
+            if previous is not None and len(values) and values[0] == previous[1][-1]:
+                # Not a change, the value was already there before the split
+                timestamps, values = timestamps[1:], values[1:]
+            self._append(sensor, timestamps, values)
+
+    def _offsets(self) -> tuple[np.ndarray, np.ndarray, list[str]]:
+        """
+        :returns: Logger timestamps, Unix offsets at them, and the sources used
+        """
+        timestamps, offsets, sources = [], [], []
+
+        if DATE_SENSOR in self.samples and TIME_SENSOR in self.samples:
+            date_timestamps, date_values = self.samples[DATE_SENSOR]
+            days = _parse(_parse_dates, date_values)
+            date_timestamps = date_timestamps[~np.isnan(days)]
+            days = days[~np.isnan(days)]
+
+            time_timestamps, time_values = self.samples[TIME_SENSOR]
+            times = _parse(_parse_times, time_values)
+            time_timestamps = time_timestamps[~np.isnan(times)]
+            times = times[~np.isnan(times)]
+
+            if len(days) and len(times):
+                # Latest date at or before each time, the first one for times before it
+                order = np.argsort(date_timestamps, kind="stable")
+                date_timestamps, days = date_timestamps[order], days[order]
+                latest = np.searchsorted(date_timestamps, time_timestamps, "right") - 1
+                unix = days[np.maximum(latest, 0)] + times
+                timestamps.append(time_timestamps)
+                offsets.append(unix - time_timestamps)
+                sources.append(f"{DATE_SENSOR}/{TIME_SENSOR}")
+
+        if GPS_WEEK_SENSOR in self.samples and GPS_TIME_OF_WEEK_SENSOR in self.samples:
+            week_timestamps, weeks = self.samples[GPS_WEEK_SENSOR]
+            tow_timestamps, tows = self.samples[GPS_TIME_OF_WEEK_SENSOR]
+            valid = (tows >= 0) & (tows < MS_PER_WEEK)
+            tow_timestamps, tows = tow_timestamps[valid], tows[valid]
+            order = np.argsort(week_timestamps, kind="stable")
+            week_timestamps, weeks = week_timestamps[order], weeks[order]
+            if len(weeks) and len(tows):
+                latest = np.searchsorted(week_timestamps, tow_timestamps, "right") - 1
+                unix = (
+                    GPS_EPOCH_MS
+                    + weeks[np.maximum(latest, 0)] * MS_PER_WEEK
+                    + tows
+                    - GPS_LEAP_SECONDS * 1000
+                )
+                timestamps.append(tow_timestamps)
+                offsets.append(unix - tow_timestamps)
+                sources.append(f"{GPS_WEEK_SENSOR}/{GPS_TIME_OF_WEEK_SENSOR}")
+
+        if not timestamps:
+            return np.zeros(0), np.zeros(0), sources
+        return np.concatenate(timestamps), np.concatenate(offsets), sources
+
+    def fit(self) -> ClockMapping | None:
+        """
+        :returns: The mapping to Unix time, None without usable clock samples
+        """
+        timestamps, offsets, sources = self._offsets()
+        if len(offsets) == 0:
+            return None
+
+        median = np.median(offsets)
+        inliers = np.abs(offsets - median) <= OUTLIER_MS
+        timestamps, offsets = timestamps[inliers], offsets[inliers]
+
+        drift = 0.0
+        offset = float(np.median(offsets))
+        if timestamps.max() - timestamps.min() >= MIN_DRIFT_SPAN_MS:
+            slope, intercept = np.polyfit(timestamps, offsets, 1)
+            if abs(slope) <= MAX_DRIFT:
+                drift, offset = float(slope), float(intercept)
+
+        mapping = ClockMapping(offset=int(round(offset)), drift=drift)
+        residual = np.median(np.abs(mapping.to_unix(timestamps) - timestamps - offsets))
+        return ClockMapping(
+            offset=mapping.offset,
+            drift=drift,
+            source=", ".join(sources),
+            samples=len(inliers),
+            inliers=int(inliers.sum()),
+            residual=float(residual),
+        )
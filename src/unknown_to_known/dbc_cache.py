@@ -0,0 +1,118 @@
+import cantools
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+from dataclasses import dataclass
+from pathlib import Path
+
+from constants import *
+from unknown_to_known.decode_plan import MessagePlan, build_plans
+
+"""
+Loads DBC files once per process and keeps a pickled copy of the parsed database
+and its decode plans under DBC_CACHE_DIR, keyed by the DBC's content hash. Updating
+the DBCFiles submodule changes the hash, so stale entries are never used.
+"""
+
+# Bump when MessagePlan changes so old pickles are ignored
+CACHE_VERSION = 1
+
+
+@dataclass
+class CompiledDBC:
+    name: str
+    digest: str
+    db: cantools.database.can.Database
+    plans: dict[int, MessagePlan]
+
+
+_loaded: dict[str, CompiledDBC] = {}
+_lock = threading.Lock()
+
+
+def available_dbcs() -> list[str]:
+    try:
+        return sorted(path.name for path in DBC_DIR.glob("*.dbc") if path.is_file())
+    except FileNotFoundError:
+        return []
+
+
+def resolve_dbc(name: str | None = None) -> Path:
+    """
+    Finds a DBC file in DBC_DIR by file name.
+
+    :param name: File name such as "MF13Beta.dbc", defaults to DEFAULT_DBC
+    """
+    if name is None:
+        name = DEFAULT_DBC
+
+    if Path(name).name != name or not name.lower().endswith(".dbc"):
+        raise ValueError(f"Invalid DBC name: {name}")
+
+    path = DBC_DIR / name
+    if not path.is_file():
+        raise FileNotFoundError(f"DBC file not found: {name}")
+
+    return path
+
+
+def _read_pickle(path: Path) -> CompiledDBC | None:
+    try:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable DBC cache {path}: {e}")
+        return None
+
+
+def _write_pickle(path: Path, compiled: CompiledDBC) -> None:
+    # Write to a temporary file first so other workers never see a partial pickle
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as file:
+            pickle.dump(compiled, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, path)
+    except OSError as e:
+        print(f"Could not write DBC cache {path}: {e}")
+
+
+def dbc_digest(name: str | None = None) -> str:
+    """
+    sha256 of a DBC file's contents.
+
+    :param name: File name of the DBC in DBC_DIR, defaults to DEFAULT_DBC
+    """
+    return hashlib.sha256(resolve_dbc(name).read_bytes()).hexdigest()
+
+
+def load_dbc(name: str | None = None) -> CompiledDBC:
+    """
+    Returns the parsed database and decode plans for a DBC file, parsing it only if
+    neither this process nor the on-disk cache has seen its current contents.
+
+    :param name: File name of the DBC in DBC_DIR, defaults to DEFAULT_DBC
+    """
+    path = resolve_dbc(name)
+    digest = dbc_digest(name)
+
+    with _lock:
+        compiled = _loaded.get(digest)
+        if compiled is not None:
+            return compiled
+
+        cache_path = DBC_CACHE_DIR / f"{digest}-v{CACHE_VERSION}.pickle"
+        compiled = _read_pickle(cache_path)
+        if compiled is None:
+            db = cantools.database.load_file(path)
+            compiled = CompiledDBC(
+                name=path.name, digest=digest, db=db, plans=build_plans(db)
+            )
+            _write_pickle(cache_path, compiled)
+
+        _loaded[digest] = compiled
+        return compiled
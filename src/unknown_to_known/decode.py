@@ -1,128 +1,485 @@
-import cantools
+import multiprocessing
+import numpy as np
 import pandas as pd
 import os
+import resource
+import shutil
+import tempfile
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from itertools import islice
 from pathlib import Path
+from typing import Callable, Iterable
 
 from constants import *
+from raw_to_unknown import deserializer
+from raw_to_unknown.deserializer import Frames
+from unknown_to_known import dbc_cache, known_file
+from unknown_to_known.decode_plan import MessagePlan, field_types, integer_fields
+from unknown_to_known.session_stats import SessionStats
 
 """
 @author Magnus Van Zyl
-Script to convert raw canbus data into readable data in a csv file in the format 'Timestamp,CANID,SENSOR,Value,Unit'.
+Script to convert raw canbus data into readable data in a csv file in the format 'Timestamp,CANID,SENSOR,Value,Unit',
+and/or the equivalent typed parquet file described in known_file.
 """
 
+BATCH_SIZE = 50000
+# Logs smaller than this are not worth starting worker processes for
+MIN_SHARD_SIZE = 32 * 1024 * 1024
+# Smaller shards than workers keep them all busy and let progress advance
+SHARDS_PER_WORKER = 4
+FIELDS = ["Timestamp", "CANID", "Sensor", "Value", "Unit"]
 
-def make_known(unknown_file_name: str, output_file_name: str):
+
+def read_unknown(unknown_file_name: str):
     """
-    Takes input file of unknown data and decodes it writing into a csv. Uses MF13Beta.dbc file.
+    Yields ``(timestamp, canID, dataBytes)`` from an unknown text file written by
+    ``deserializer.deserialize``.
 
     :param unknown_file_name: Name of the file with unknown/raw data
-    :param output_file_name: Name of the csv file decoded data will be written to
     """
-    # === LOAD DBC ===
-    db = cantools.database.load_file(DATA_DIR / Path("DBCFiles/MF13Beta.dbc"))
-
-    # === DEFINE HEADERS AND FILE PATHS ===
-    fields = ["Timestamp", "CANID", "Sensor", "Value", "Unit"]
-    data_file = unknown_file_name
-    output_file = output_file_name
-    file_name_base, ending = os.path.splitext(data_file)
-    log_file = f"{file_name_base}.log"
-
-    # === READS RAW DATA ===
-    with open(data_file, "r") as unknown:
+    with open(unknown_file_name, "r") as unknown:
         header = unknown.readline()
         header = unknown.readline()
-        data = []
         # print(header)  # This is just to get the header out of the way
 
-        # === ADDS DATA TO LIST, FORMATTED [timestamp,canID,dataBytes]
         for line in unknown:
-            dataLst = []
             lineLst = line.split(",")
             timestamp = int(lineLst[0])
-            dataLst.append(timestamp)
             canID = int(lineLst[1])
-            dataLst.append(canID)
-            dataDecimal = lineLst[2:]
-            for i in range(len(dataDecimal)):
-                dataDecimal[i] = int(dataDecimal[i].strip())
-            dataBytes = bytes(dataDecimal)
-            dataLst.append(dataBytes)
-            data.append(dataLst)
+            dataBytes = bytes(int(byte.strip()) for byte in lineLst[2:])
+            yield timestamp, canID, dataBytes
 
-    failed_lines = 0
-    skipped_ids = []  # List of CAN IDs that are found in data_file but not in the dbc
-    failed_lines_raw = []
-    # === DECODES dataBytes TO BE WRITTEN INTO CSV ===
-    writable_lines = []
-    for dataset in data:
-        write_this = []
-        values = []
-        units = []
-        sensors = []
-        try:
-            decoded = db.decode_message(dataset[1], dataset[2])
-            message = db.get_message_by_frame_id(dataset[1])
-            write_this.append(dataset[0])  # timestamp
-            write_this.append(dataset[1])  # CAN ID
-            for signal in message.signals:
-                sensor = signal.name
-                sensors.append(sensor)
-                value = decoded.get(sensor)
-                values.append(value)
-                unit = signal.unit
-                if unit == None:
-                    unit = (
-                        ""  # For sensors with undefined units in dbc, adds empty string
-                    )
-                units.append(unit)
-            write_this.append(sensors)  # write_this[2]
-            write_this.append(values)  # write_this[3]
-            write_this.append(units)  # write_this[4]
-            writable_lines.append(write_this)
-
-        except Exception as e:
-            failed_lines_raw.append(dataset)
-            if dataset[1] not in skipped_ids:
-                skipped_ids.append(dataset[1])
-            failed_lines += 1
+
+def _frame_batches(unknown, batch_size: int):
+    """
+    Yields Frames of at most ``batch_size`` CAN records.
+    """
+    if isinstance(unknown, str):
+        records = read_unknown(unknown)
+        while batch := list(islice(records, batch_size)):
+            yield Frames.from_records(batch)
+        return
+
+    if isinstance(unknown, Frames):
+        unknown = [unknown]
+    for frames in unknown:
+        for start in range(0, len(frames), batch_size):
+            yield frames.select(slice(start, start + batch_size))
+
+
+def _decode_batch(
+    frames: Frames,
+    plans: dict[int, MessagePlan],
+    text: bool,
+    stats: SessionStats | None = None,
+    wide: known_file.WideKnownWriter | None = None,
+    long_rows: bool = True,
+):
+    """
+    Decodes a batch message by message, then puts the rows back in frame order.
+
+    :param text: Also add a "Text" column with values formatted for the csv
+    :param stats: Adds the frames and the values of each signal to these stats
+    :param wide: Writes the values of each message to this wide known directory
+    :param long_rows: Build the rows, the returned rows are None otherwise
+    :returns: Rows as a DataFrame in the output column order, indices of frames that
+        failed to decode, and whether a Time value was seen
+    """
+    if stats is not None:
+        stats.add_frames(frames)
+
+    # === GROUPS FRAMES BY CAN ID ===
+    unique_ids, inverse = np.unique(frames.can_ids, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(unique_ids)))
+
+    failed = np.zeros(len(frames), dtype=bool)
+    saw_time = False
+    positions, signal_numbers, sensors, values, texts, units = [], [], [], [], [], []
+    for can_id, stop, start in zip(
+        unique_ids.tolist(), bounds, np.concatenate(([0], bounds[:-1]))
+    ):
+        indices = order[start:stop]
+        plan = plans.get(can_id)
+        if plan is None:
+            failed[indices] = True
+            continue
+
+        decoded_frames = plan.decode(frames.select(indices))
+        failed[indices[~decoded_frames.ok]] = True
+        decoded = indices[decoded_frames.ok]
+        signal_count = len(plan.signals)
+        if len(decoded) == 0 or signal_count == 0:
             continue
 
+        columns = plan.values(decoded_frames)
+        timestamps = frames.timestamps[decoded]
+        for signal, unit, column in zip(plan.signals, plan.units, columns):
+            if signal.name == "Time" and not np.isnan(column).all():
+                saw_time = True
+            if stats is not None:
+                stats.add_signal(signal.name, unit, column, timestamps)
+        if wide is not None:
+            wide.write_message(plan, timestamps, columns)
+        if not long_rows:
+            continue
+
+        # Rows are frame major: every signal of a frame, then the next frame
+        positions.append(np.repeat(decoded, signal_count))
+        signal_numbers.append(np.tile(np.arange(signal_count), len(decoded)))
+        sensors.append(np.tile(plan.names, len(decoded)))
+        units.append(np.tile(plan.units, len(decoded)))
+        values.append(np.column_stack(columns).ravel())
+        if text:
+            texts.append(np.array(plan.text(decoded_frames), dtype=object).T.ravel())
+
+    if not long_rows:
+        return None, np.flatnonzero(failed), saw_time
+    if not positions:
+        rows = pd.DataFrame({field: [] for field in FIELDS})
+        if text:
+            rows["Text"] = []
+        return rows, np.flatnonzero(failed), saw_time
+
+    positions = np.concatenate(positions)
+    row_order = np.lexsort((np.concatenate(signal_numbers), positions))
+    positions = positions[row_order]
+    rows = pd.DataFrame(
+        {
+            "Timestamp": frames.timestamps[positions].astype(np.int64),
+            "CANID": frames.can_ids[positions].astype(np.int32),
+            "Sensor": np.concatenate(sensors)[row_order],
+            "Value": np.concatenate(values)[row_order],
+            "Unit": np.concatenate(units)[row_order],
+        }
+    )
+    if text:
+        rows["Text"] = np.concatenate(texts)[row_order]
+    return rows, np.flatnonzero(failed), saw_time
+
+
+def decode_frames(frames: Frames, plans: dict[int, MessagePlan]) -> pd.DataFrame:
+    """
+    Decodes frames in memory, without writing any file.
+
+    :param plans: ``dbc_cache.load_dbc(...).plans``
+    :returns: Rows with the FIELDS columns in frame order, frames that failed to
+        decode are left out
+    """
+    rows, _, _ = _decode_batch(frames, plans, text=False)
+    return rows
+
+
+def _open_outputs(
+    stack: ExitStack,
+    plans: dict[int, MessagePlan],
+    output_file_name: str | None,
+    parquet_file_name: str | None,
+    log_file_name: str | None,
+    headers: bool = True,
+):
+    file = None
+    if output_file_name is not None:
+        file = stack.enter_context(open(output_file_name, "w"))
+        if headers:
+            file.write(f'{",".join(FIELDS)}\n')
+    known = None
+    if parquet_file_name is not None and known_file.is_wide(parquet_file_name):
+        known = stack.enter_context(
+            known_file.WideKnownWriter(parquet_file_name, integer_fields(plans))
+        )
+    elif parquet_file_name is not None:
+        known = stack.enter_context(
+            known_file.KnownWriter(parquet_file_name, field_types(plans))
+        )
+    log = None
+    if log_file_name is not None:
+        log = stack.enter_context(open(log_file_name, "w"))
+        if headers:
+            log.write("Timestamp,CANID,DataBytes\n")
+    return file, known, log
+
+
+def _write_batches(
+    batches, plans: dict[int, MessagePlan], file, known, log, stats: SessionStats
+):
+    """
+    Decodes batches of frames and writes them to the open outputs, adding them to
+    ``stats``.
+
+    :returns: Number of frames that failed to decode, their CAN IDs in order of
+        appearance, and whether a Time value was seen
+    """
+    failed_lines = 0
+    skipped_ids = {}
+    saw_any_time = False
+    wide = known if isinstance(known, known_file.WideKnownWriter) else None
+    long_known = None if wide is not None else known
+    for frames in batches:
+        # === DECODES dataBytes AND WRITES THEM OUT ===
+        rows, failed, saw_time = _decode_batch(
+            frames,
+            plans,
+            text=file is not None,
+            stats=stats,
+            wide=wide,
+            long_rows=file is not None or long_known is not None,
+        )
+        if file is not None:
+            rows[["Timestamp", "CANID", "Sensor", "Text", "Unit"]].to_csv(
+                file, header=False, index=False
+            )
+        if long_known is not None:
+            long_known.write(rows[FIELDS])
+
+        saw_any_time = saw_any_time or saw_time
+        skipped_ids.update(dict.fromkeys(frames.can_ids[failed].tolist()))
+        failed_lines += len(failed)
+        if log is not None:
+            for i in failed:
+                log.write(
+                    f"{frames.timestamps[i]},{frames.can_ids[i]},{frames.payload(i)}\n"
+                )
+    return failed_lines, skipped_ids, saw_any_time
+
+
+def _finish(
+    output_file_name: str | None,
+    parquet_file_name: str | None,
+    failed_lines: int,
+    skipped_ids,
+    saw_time: bool,
+) -> None:
     # === CHECK FOR TIME VALUES ===
-    no_time = True
-    for line in writable_lines:
-        for i in range(len(line[2])):
-            if line[2][i] == "Time" and line[3][i] != None:
-                no_time = False
-    if no_time:
+    if not saw_time:
+        for written_file in (output_file_name, parquet_file_name):
+            if written_file is not None and os.path.isdir(written_file):
+                shutil.rmtree(written_file)
+            elif written_file is not None:
+                os.remove(written_file)
         raise ValueError("Time sensor with no value")
 
-    # === WRITES FAILED LINES TO LOG FILE ===
-    for i in range(len(failed_lines_raw)):
-        for j in range(len(failed_lines_raw[i])):
-            failed_lines_raw[i][j] = str(failed_lines_raw[i][j])
-    with open(log_file, "w") as log:
-        log.write("Timestamp,CANID,DataBytes\n")
-        for failure in failed_lines_raw:
-            log.write(f'{",".join(failure)}\n')
-
-    # === WRITES DECODED DATA TO OUTPUT FILE ===
-    with open(output_file, "w") as file:
-        file.write(f'{",".join(fields)}\n')
-        for line in writable_lines:
-            time = line[0]
-            canbus_id = line[1]
-            for i in range(len(line[2])):
-                sense = line[2][i]
-                val = line[3][i]
-                unt = line[4][i]
-                data_entry = f"{time},{canbus_id},{sense},{val},{unt}\n"
-                file.write(data_entry)
-
-    print(f"DATA DECODED INTO FILE: {output_file}")
+    print(f"DATA DECODED INTO FILE: {output_file_name or parquet_file_name}")
     print(f"LINES SKIPPED: {failed_lines}")
-    print(f"SKIPPED IDS: {skipped_ids}")
+    print(f"SKIPPED IDS: {list(skipped_ids)}")
+
+
+def make_known(
+    unknown: Frames | Iterable[Frames] | str,
+    output_file_name: str | None,
+    log_file_name: str | None = None,
+    batch_size: int = BATCH_SIZE,
+    dbc_name: str | None = None,
+    parquet_file_name: str | None = None,
+) -> SessionStats:
+    """
+    Takes deserialized frames (or an unknown data file) and decodes them writing into a csv and/or a parquet file.
+    Uses MF13Beta.dbc file unless another DBC is given.
+
+    Frames are decoded and written in batches of ``batch_size``, so memory use does not grow with the size of the log
+    when ``unknown`` is a stream such as ``deserializer.iter_frames``.
+
+    :param unknown: Frames, an iterable of Frames from ``deserializer.iter_frames``, or name of the file with unknown/raw data
+    :param output_file_name: Name of the csv file decoded data will be written to, None to skip the csv
+    :param log_file_name: Name of the file undecodable frames are written to.
+        Defaults to the unknown file name with a .log suffix, frames are not logged if neither is given
+    :param batch_size: Number of frames decoded before rows are written out
+    :param dbc_name: File name of the DBC in DBC_DIR, defaults to DEFAULT_DBC
+    :param parquet_file_name: Name of the parquet file (see ``known_file``) decoded data will be written to,
+        or of the directory of the wide layout when it ends in .wide
+    :returns: Summary of the decoded log
+    """
+    if output_file_name is None and parquet_file_name is None:
+        raise ValueError("No output file given")
+
+    # === LOAD DBC ===
+    plans = dbc_cache.load_dbc(dbc_name).plans
+
+    # === DEFINE HEADERS AND FILE PATHS ===
+    log_file = log_file_name
+    if isinstance(unknown, str) and log_file is None:
+        file_name_base, ending = os.path.splitext(unknown)
+        log_file = f"{file_name_base}.log"
+
+    with ExitStack() as stack:
+        file, known, log = _open_outputs(
+            stack, plans, output_file_name, parquet_file_name, log_file
+        )
+        # skipped_ids are the CAN IDs that failed to decode (mostly ones not in the dbc)
+        stats = SessionStats()
+        failed_lines, skipped_ids, saw_time = _write_batches(
+            _frame_batches(unknown, batch_size), plans, file, known, log, stats
+        )
+
+    _finish(output_file_name, parquet_file_name, failed_lines, skipped_ids, saw_time)
+    return stats
+
+
+# === SHARDED DECODING ===
+
+
+def _decode_shard(
+    raw_file_name: str,
+    start: int,
+    end: int,
+    dbc_name: str | None,
+    batch_size: int,
+    output_file_name: str | None,
+    parquet_file_name: str | None,
+    log_file_name: str | None,
+):
+    """
+    Decodes one byte range of a raw .data file into partial outputs without headers.
+    Runs in a worker process, and also returns the peak resident memory of that
+    process so far.
+    """
+    plans = dbc_cache.load_dbc(dbc_name).plans
+    with ExitStack() as stack:
+        file, known, log = _open_outputs(
+            stack,
+            plans,
+            output_file_name,
+            parquet_file_name,
+            log_file_name,
+            headers=False,
+        )
+        stats = SessionStats()
+        failed_lines, skipped_ids, saw_time = _write_batches(
+            _frame_batches(
+                deserializer.iter_frames(raw_file_name, start=start, end=end),
+                batch_size,
+            ),
+            plans,
+            file,
+            known,
+            log,
+            stats,
+        )
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return failed_lines, list(skipped_ids), saw_time, stats, peak_memory
+
+
+def _append_text(destination, part_name: str) -> None:
+    with open(part_name, "r") as part:
+        shutil.copyfileobj(part, destination)
+
+
+def make_known_sharded(
+    raw_file_name: str,
+    output_file_name: str | None,
+    log_file_name: str | None = None,
+    batch_size: int = BATCH_SIZE,
+    dbc_name: str | None = None,
+    parquet_file_name: str | None = None,
+    workers: int = DECODE_WORKERS,
+    min_shard_size: int = MIN_SHARD_SIZE,
+    report: Callable[[int, int], None] | None = None,
+) -> SessionStats:
+    """
+    Decodes a raw .data file on several processes, producing the same outputs as
+    ``make_known(deserializer.iter_frames(raw_file_name), ...)``.
+
+    The file is split at record boundaries into contiguous shards, each decoded
+    into partial files by a worker process. The parts are then appended in shard
+    order, so rows keep the order of the log (which is timestamp order).
+    Files too small for more than one shard are decoded in this process. The
+    peak resident memory of the worker processes is kept in the returned stats'
+    worker_peak_memory.
+
+    :param raw_file_name: Path of the raw .data file
+    :param workers: Maximum number of worker processes
+    :param min_shard_size: Smallest number of bytes worth giving to a worker
+    :param report: Called with the bytes decoded so far and the size of the file
+    See make_known for the other parameters.
+    """
+    if output_file_name is None and parquet_file_name is None:
+        raise ValueError("No output file given")
+
+    size = os.path.getsize(raw_file_name)
+    shard_count = 1
+    if workers > 1:
+        shard_count = max(
+            1, min(workers * SHARDS_PER_WORKER, size // max(min_shard_size, 1))
+        )
+    offsets = deserializer.shard_offsets(raw_file_name, shard_count)
+    if len(offsets) <= 2:
+        return make_known(
+            deserializer.iter_frames(raw_file_name, report=report),
+            output_file_name,
+            log_file_name,
+            batch_size=batch_size,
+            dbc_name=dbc_name,
+            parquet_file_name=parquet_file_name,
+        )
+
+    plans = dbc_cache.load_dbc(dbc_name).plans
+    shards = list(zip(offsets[:-1], offsets[1:]))
+
+    # Parts go next to the output so appending them stays on one disk
+    parts_parent = Path(parquet_file_name or output_file_name).resolve().parent
+    with tempfile.TemporaryDirectory(dir=parts_parent) as parts_dir:
+
+        known_suffix = Path(parquet_file_name or "").suffix
+
+        def part(name: str | None, i: int, suffix: str) -> str | None:
+            return None if name is None else str(Path(parts_dir) / f"{i}{suffix}")
+
+        with ProcessPoolExecutor(
+            min(workers, len(shards)), mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _decode_shard,
+                    raw_file_name,
+                    start,
+                    end,
+                    dbc_name,
+                    batch_size,
+                    part(output_file_name, i, ".csv"),
+                    part(parquet_file_name, i, known_suffix),
+                    part(log_file_name, i, ".log"),
+                )
+                for i, (start, end) in enumerate(shards)
+            ]
+            decoded = 0
+            for future in as_completed(futures):
+                start, end = shards[futures.index(future)]
+                decoded += end - start
+                if report is not None:
+                    report(decoded, size)
+            results = [future.result() for future in futures]
+
+        # === ORDERED MERGE ===
+        with ExitStack() as stack:
+            file, known, log = _open_outputs(
+                stack, plans, output_file_name, parquet_file_name, log_file_name
+            )
+            for i in range(len(shards)):
+                if file is not None:
+                    _append_text(file, part(output_file_name, i, ".csv"))
+                if known is not None:
+                    known.append(part(parquet_file_name, i, known_suffix))
+                if log is not None:
+                    _append_text(log, part(log_file_name, i, ".log"))
+
+    skipped_ids = {}
+    stats = SessionStats()
+    for _, shard_skipped_ids, _, shard_stats, _ in results:
+        skipped_ids.update(dict.fromkeys(shard_skipped_ids))
+        stats.merge(shard_stats)
+    # The pool's processes are new, their peak is this decode's own
+    stats.worker_peak_memory = max(peak for *_, peak in results)
+    _finish(
+        output_file_name,
+        parquet_file_name,
+        sum(failed_lines for failed_lines, *_ in results),
+        skipped_ids,
+        any(saw_time for _, _, saw_time, *_ in results),
+    )
+    return stats
 
 
 # unknown_file = 'EnduranceDayData (2).data'
@@ -0,0 +1,302 @@
+import numpy as np
+
+from dataclasses import dataclass
+
+from cantools.database.conversion import (
+    BaseConversion,
+    IdentityConversion,
+    LinearIntegerConversion,
+)
+
+from raw_to_unknown.deserializer import Frames
+from unknown_to_known import known_file
+
+"""
+Precomputed per-message decoders, so every frame of a CAN ID is decoded in one
+NumPy pass instead of a cantools call per frame.
+"""
+
+# Frames are packed into one 64 bit word, longer messages use cantools
+MAX_VECTORIZED_LENGTH = 8
+FLOAT_TYPES = {
+    16: (np.uint16, np.float16),
+    32: (np.uint32, np.float32),
+    64: (np.uint64, np.float64),
+}
+# Integers past this lose precision as float64, which values are decoded to
+MAX_EXACT_INTEGER = 1 << 53
+
+
+class SignalPlan:
+    """
+    Bit position, sign, scaling and value table of a single signal.
+    """
+
+    def __init__(self, signal):
+        self.name: str = signal.name
+        # For sensors with undefined units in dbc, adds empty string
+        self.unit: str = "" if signal.unit is None else signal.unit
+        self.length: int = signal.length
+        self.is_signed: bool = signal.is_signed
+        self.is_float: bool = signal.is_float
+        self.choices = signal.choices
+        self.conversion = BaseConversion.factory(
+            scale=signal.scale, offset=signal.offset, is_float=signal.is_float
+        )
+
+        self.little_endian = signal.byte_order == "little_endian"
+        if self.little_endian:
+            self.shift = signal.start
+        else:
+            # Sawtooth start bit (MSB) to a shift from the least significant bit of the word
+            msb = 8 * (signal.start // 8) + (7 - signal.start % 8)
+            self.shift = 64 - msb - signal.length
+        self.mask = np.uint64((1 << signal.length) - 1)
+
+    @property
+    def is_integer(self) -> bool:
+        """
+        Whether cantools decodes this signal to ints rather than floats.
+        """
+        return not self.is_float and isinstance(
+            self.conversion, (IdentityConversion, LinearIntegerConversion)
+        )
+
+    @property
+    def largest(self) -> int:
+        """
+        Bound on the magnitude of the scaled values of an integer signal.
+        """
+        if isinstance(self.conversion, LinearIntegerConversion):
+            return (1 << self.length) * abs(self.conversion.scale) + abs(
+                self.conversion.offset
+            )
+        return 1 << self.length
+
+    def extract(self, little_words: np.ndarray, big_words: np.ndarray) -> np.ndarray:
+        """
+        Pulls the raw value of this signal out of every packed payload.
+        """
+        words = little_words if self.little_endian else big_words
+        raw = (words >> np.uint64(self.shift)) & self.mask
+
+        if self.is_float:
+            bits, dtype = FLOAT_TYPES[self.length]
+            return raw.astype(bits).view(dtype).astype(np.float64)
+        if self.is_signed:
+            if self.length == 64:
+                return raw.view(np.int64)
+            sign = (raw >> np.uint64(self.length - 1)).astype(np.int64)
+            return raw.astype(np.int64) - (sign << self.length)
+        if self.length == 64:
+            return raw
+        return raw.astype(np.int64)
+
+    def scale(self, raw: np.ndarray) -> np.ndarray:
+        if isinstance(self.conversion, IdentityConversion):
+            return raw
+        if isinstance(self.conversion, LinearIntegerConversion):
+            if self.largest >= 1 << 63:
+                # Would overflow int64, use python ints like cantools
+                raw = raw.astype(object)
+            return raw * self.conversion.scale + self.conversion.offset
+        return raw.astype(np.float64) * self.conversion.scale + self.conversion.offset
+
+    def format(self, raw: np.ndarray) -> list[str]:
+        """
+        Formats values the way ``str()`` prints what cantools would decode.
+        """
+        if self.choices:
+            # Value tables are small, so format each distinct raw value once
+            unique, inverse = np.unique(raw, return_inverse=True)
+            scaled = self.scale(unique).tolist()
+            text = np.array(
+                [
+                    str(self.choices.get(value, scaled_value))
+                    for value, scaled_value in zip(unique.tolist(), scaled)
+                ],
+                dtype=object,
+            )
+            return text[inverse].tolist()
+        return list(map(str, self.scale(raw).tolist()))
+
+    def values(self, raw: np.ndarray) -> np.ndarray:
+        """
+        Scaled values as float64. Value tables are not applied.
+        """
+        return self.scale(raw).astype(np.float64)
+
+    def raw_dtype(self):
+        if self.is_float:
+            return np.float64
+        if self.length == 64 and not self.is_signed:
+            return np.uint64
+        return np.int64
+
+
+@dataclass
+class DecodedFrames:
+    """
+    Raw signal values of the frames of one message.
+
+    ``raw`` holds one array per signal covering only the frames selected by
+    ``ok``. ``present`` is None for a signal carried by every frame, otherwise
+    a mask of the frames whose multiplexer selected it.
+    """
+
+    ok: np.ndarray
+    raw: list[np.ndarray]
+    present: list[np.ndarray | None]
+
+
+class MessagePlan:
+    """
+    Decoder for every frame of one CAN message.
+
+    Messages that fit in 8 bytes and are not multiplexed are decoded with bit
+    operations on packed 64 bit words. Anything else falls back to cantools
+    frame by frame.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.length: int = message.length
+        self.signals = [SignalPlan(signal) for signal in message.signals]
+        self.names = np.array([signal.name for signal in self.signals], dtype=object)
+        self.units = np.array([signal.unit for signal in self.signals], dtype=object)
+        self.vectorized = (
+            self.length <= MAX_VECTORIZED_LENGTH
+            and not message.is_multiplexed()
+            and all(
+                not signal.is_float or signal.length in FLOAT_TYPES
+                for signal in self.signals
+            )
+        )
+
+    def decode(self, frames: Frames) -> DecodedFrames:
+        """
+        Decodes frames of this message into raw signal values.
+
+        :param frames: Frames that all carry this message's CAN ID
+        """
+        if self.message.is_container:
+            # cantools refuses to decode container messages without decode_containers
+            return DecodedFrames(
+                ok=np.zeros(len(frames), dtype=bool),
+                raw=[np.zeros(0, dtype=signal.raw_dtype()) for signal in self.signals],
+                present=[None for _ in self.signals],
+            )
+        if not self.vectorized:
+            return self._decode_each(frames)
+
+        # Payloads shorter than the message are rejected, longer ones are truncated, like cantools
+        ok = frames.lengths >= self.length
+        payloads = frames.select(ok).payload_matrix(MAX_VECTORIZED_LENGTH)
+        payloads[:, self.length :] = 0
+        little_words = payloads.view("<u8").ravel()
+        big_words = payloads.view(">u8").ravel().astype(np.uint64)
+
+        # NaN and inf payloads of float signals are passed through like cantools
+        with np.errstate(invalid="ignore", over="ignore"):
+            raw = [signal.extract(little_words, big_words) for signal in self.signals]
+        return DecodedFrames(ok=ok, raw=raw, present=[None for _ in self.signals])
+
+    def _decode_each(self, frames: Frames) -> DecodedFrames:
+        ok = np.ones(len(frames), dtype=bool)
+        columns = [[] for _ in self.signals]
+        for i, (_, _, data_bytes) in enumerate(frames.records()):
+            try:
+                decoded = self.message.decode(
+                    data_bytes, decode_choices=False, scaling=False
+                )
+            except Exception:
+                ok[i] = False
+                continue
+            for column, signal in zip(columns, self.signals):
+                column.append(decoded.get(signal.name))
+
+        raw, present = [], []
+        for column, signal in zip(columns, self.signals):
+            mask = np.array([value is not None for value in column], dtype=bool)
+            raw.append(
+                np.array(
+                    [0 if value is None else value for value in column],
+                    dtype=signal.raw_dtype(),
+                )
+            )
+            present.append(None if mask.all() else mask)
+        return DecodedFrames(ok=ok, raw=raw, present=present)
+
+    def text(self, decoded: DecodedFrames) -> list[list[str]]:
+        """
+        One column of ``str()`` formatted values per signal, "None" where a
+        multiplexed signal is missing.
+        """
+        columns = []
+        with np.errstate(invalid="ignore", over="ignore"):
+            for signal, raw, present in zip(self.signals, decoded.raw, decoded.present):
+                if present is None:
+                    columns.append(signal.format(raw))
+                    continue
+                column = np.full(len(raw), "None", dtype=object)
+                column[present] = signal.format(raw[present])
+                columns.append(column.tolist())
+        return columns
+
+    def values(self, decoded: DecodedFrames) -> list[np.ndarray]:
+        """
+        One float64 column of scaled values per signal, NaN where a multiplexed
+        signal is missing.
+        """
+        columns = []
+        with np.errstate(invalid="ignore", over="ignore"):
+            for signal, raw, present in zip(self.signals, decoded.raw, decoded.present):
+                column = signal.values(raw)
+                if present is not None:
+                    column[~present] = np.nan
+                columns.append(column)
+        return columns
+
+
+def integer_fields(plans: dict[int, MessagePlan]) -> list[tuple[int, str]]:
+    """
+    (CAN ID, name) of the signals written as integers: those whose scaled values
+    are always integers small enough to stay exact as float64, when every signal
+    with the same name is. A sensor is one InfluxDB measurement whatever its CAN
+    ID, and its field can only have one type.
+    """
+    not_integer = {
+        signal.name
+        for plan in plans.values()
+        for signal in plan.signals
+        if not signal.is_integer or signal.largest > MAX_EXACT_INTEGER
+    }
+    return sorted(
+        (can_id, signal.name)
+        for can_id, plan in plans.items()
+        for signal in plan.signals
+        if signal.name not in not_integer
+    )
+
+
+def field_types(plans: dict[int, MessagePlan]) -> dict[tuple[int, str], str]:
+    """
+    :returns: known_file.INTEGER or known_file.FLOAT by (CAN ID, Sensor)
+    """
+    integer = set(integer_fields(plans))
+    return {
+        (can_id, name): (
+            known_file.INTEGER if (can_id, name) in integer else known_file.FLOAT
+        )
+        for can_id, plan in plans.items()
+        for name in plan.names
+    }
+
+
+def build_plans(db) -> dict[int, MessagePlan]:
+    """
+    Builds a MessagePlan for every message in the database, keyed by frame id.
+
+    :param db: cantools database
+    """
+    return {message.frame_id: MessagePlan(message) for message in db.messages}
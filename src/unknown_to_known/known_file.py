@@ -0,0 +1,460 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pathlib import Path
+from typing import Callable
+
+"""
+Reading and writing of known (decoded) data.
+
+Parquet is the canonical format: Timestamp int64, CANID int32, Sensor and Unit
+dictionary encoded strings, and Value float64 (NaN where a multiplexed signal is
+missing). The long format csv 'Timestamp,CANID,Sensor,Value,Unit' is an export and
+is still accepted by the readers.
+
+The wide layout is a directory (named *.wide) with one parquet file per CAN
+message: a Timestamp column and one column per signal, int64 for integer
+signals (see decode_plan.integer_fields) and float64 otherwise, null where a
+multiplexed signal is missing. The
+CAN ID and message name are kept in the file metadata and the unit of each
+signal in its field metadata, so nothing is repeated per row. iter_messages reads
+it as is, iter_known and read_known turn it into long rows for the other readers.
+"""
+
+KNOWN_SCHEMA = pa.schema(
+    [
+        ("Timestamp", pa.int64()),
+        ("CANID", pa.int32()),
+        ("Sensor", pa.dictionary(pa.int32(), pa.string())),
+        ("Value", pa.float64()),
+        ("Unit", pa.dictionary(pa.int32(), pa.string())),
+    ]
+)
+
+CSV_DTYPES = {
+    "Timestamp": "int64",
+    "CANID": "int32",
+    "Sensor": "category",
+    "Value": "float64",
+    "Unit": "category",
+}
+
+CHUNK_SIZE = 200000
+
+# (CAN ID, Sensor) -> "integer" or "float", see decode_plan.integer_fields
+FIELD_TYPES_KEY = "field_types"
+INTEGER = "integer"
+FLOAT = "float"
+
+WIDE_SUFFIX = ".wide"
+CAN_ID_KEY = "can_id"
+MESSAGE_KEY = "message"
+UNIT_KEY = "unit"
+
+
+def is_parquet(path) -> bool:
+    return Path(path).suffix.lower() == ".parquet"
+
+
+def is_wide(path) -> bool:
+    return Path(path).suffix.lower() == WIDE_SUFFIX
+
+
+class KnownWriter:
+    """
+    Appends decoded rows to a parquet file, one row group per batch.
+    """
+
+    def __init__(self, path, field_types: dict[tuple[int, str], str] | None = None):
+        """
+        :param path: Parquet file to write
+        :param field_types: INTEGER or FLOAT by (CAN ID, Sensor), kept in the file
+            metadata, see field_types
+        """
+        self.path = path
+        schema = KNOWN_SCHEMA
+        if field_types is not None:
+            schema = schema.with_metadata(
+                {
+                    FIELD_TYPES_KEY: json.dumps(
+                        [
+                            [can_id, sensor, field_type]
+                            for (can_id, sensor), field_type in field_types.items()
+                        ]
+                    )
+                }
+            )
+        self._schema = schema
+        self._writer = pq.ParquetWriter(path, schema, compression="zstd")
+
+    def write(self, rows: pd.DataFrame) -> None:
+        """
+        :param rows: DataFrame with the known columns, Value as float64
+        """
+        if len(rows) == 0:
+            return
+
+        table = pa.Table.from_pandas(rows, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def append(self, path) -> None:
+        """
+        Copies the row groups of a parquet file written by another KnownWriter.
+        """
+        parquet_file = pq.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            self._writer.write_table(parquet_file.read_row_group(i))
+
+    def close(self) -> None:
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# === WIDE LAYOUT ===
+
+
+def wide_schema(plan, integer_fields) -> pa.Schema:
+    """
+    :param plan: decode_plan.MessagePlan of the message
+    :param integer_fields: (CAN ID, Sensor) of the integer signals
+    """
+    can_id = plan.message.frame_id
+    fields = [pa.field("Timestamp", pa.int64())]
+    for name, unit in zip(plan.names, plan.units):
+        fields.append(
+            pa.field(
+                name,
+                pa.int64() if (can_id, name) in integer_fields else pa.float64(),
+                metadata={UNIT_KEY: unit or ""},
+            )
+        )
+    return pa.schema(
+        fields,
+        metadata={
+            CAN_ID_KEY: str(can_id),
+            MESSAGE_KEY: plan.message.name,
+        },
+    )
+
+
+class WideKnownWriter:
+    """
+    Writes decoded messages to a wide known directory. Rows of each message are
+    buffered up to CHUNK_SIZE per row group.
+    """
+
+    def __init__(self, path, integer_fields=()):
+        """
+        :param path: Directory to write, created if needed
+        :param integer_fields: (CAN ID, Sensor) of the signals stored as int64
+        """
+        self.path = Path(path)
+        self.integer_fields = set(integer_fields)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._writers: dict[str, pq.ParquetWriter] = {}
+        self._schemas: dict[int, pa.Schema] = {}
+        self._buffers: dict[str, list[pa.Table]] = {}
+
+    def _writer(self, name: str, schema: pa.Schema) -> pq.ParquetWriter:
+        writer = self._writers.get(name)
+        if writer is None:
+            writer = pq.ParquetWriter(self.path / name, schema, compression="zstd")
+            self._writers[name] = writer
+        return writer
+
+    def _flush(self, name: str) -> None:
+        tables = self._buffers.pop(name, [])
+        if tables:
+            table = pa.concat_tables(tables)
+            self._writer(name, table.schema).write_table(table)
+
+    def write_message(self, plan, timestamps: np.ndarray, columns) -> None:
+        """
+        :param plan: decode_plan.MessagePlan of the message
+        :param timestamps: Timestamps of the decoded frames
+        :param columns: One float64 array of values per signal, NaN where missing
+        """
+        if len(timestamps) == 0:
+            return
+
+        schema = self._schemas.get(plan.message.frame_id)
+        if schema is None:
+            schema = self._schemas[plan.message.frame_id] = wide_schema(
+                plan, self.integer_fields
+            )
+        arrays = [pa.array(timestamps, pa.int64())] + [
+            pa.array(column, type=field.type, from_pandas=True)
+            for column, field in zip(columns, list(schema)[1:])
+        ]
+
+        name = f"{plan.message.name}.parquet"
+        buffer = self._buffers.setdefault(name, [])
+        buffer.append(pa.Table.from_arrays(arrays, schema=schema))
+        if sum(table.num_rows for table in buffer) >= CHUNK_SIZE:
+            self._flush(name)
+
+    def append(self, path) -> None:
+        """
+        Copies the messages of a directory written by another WideKnownWriter.
+        """
+        for file_path in sorted(Path(path).glob("*.parquet")):
+            self._flush(file_path.name)
+            parquet_file = pq.ParquetFile(file_path)
+            writer = self._writer(file_path.name, parquet_file.schema_arrow)
+            for i in range(parquet_file.num_row_groups):
+                writer.write_table(parquet_file.read_row_group(i))
+
+    def close(self) -> None:
+        for name in list(self._buffers):
+            self._flush(name)
+        for writer in self._writers.values():
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _message_files(path) -> list[pq.ParquetFile]:
+    return [pq.ParquetFile(file) for file in sorted(Path(path).glob("*.parquet"))]
+
+
+def _signal_fields(schema: pa.Schema) -> list[pa.Field]:
+    return [field for field in schema if field.name != "Timestamp"]
+
+
+def iter_messages(
+    path,
+    chunk_size: int = CHUNK_SIZE,
+    report: Callable[[int, int], None] | None = None,
+    sensors=None,
+    exact_integers: bool = False,
+):
+    """
+    Yields the messages of a wide known directory one after the other, each in
+    chunks of at most ``chunk_size`` frames in timestamp order.
+
+    :param sensors: Only read these signals, messages without any are skipped
+    :param report: Called after each chunk with the frames read and the total
+    :param exact_integers: Read integer signals as nullable pandas integers, instead
+        of floats wherever a frame misses them
+    :returns: Tuples of the CAN ID, the unit of each signal, and a DataFrame with
+        Timestamp and a column per signal, NaN where missing
+    """
+    types_mapper = None
+    if exact_integers:
+        types_mapper = {
+            pa.int64(): pd.Int64Dtype(),
+            pa.uint64(): pd.UInt64Dtype(),
+        }.get
+    files = _message_files(path)
+    total, done = sum(file.metadata.num_rows for file in files), 0
+    for file in files:
+        schema = file.schema_arrow
+        fields = [
+            field
+            for field in _signal_fields(schema)
+            if sensors is None or field.name in sensors
+        ]
+        if not fields:
+            done += file.metadata.num_rows
+            continue
+
+        can_id = int(schema.metadata[CAN_ID_KEY.encode()])
+        units = {
+            field.name: (field.metadata or {}).get(UNIT_KEY.encode(), b"").decode()
+            for field in fields
+        }
+        for batch in file.iter_batches(
+            batch_size=chunk_size,
+            columns=["Timestamp", *(field.name for field in fields)],
+        ):
+            done += batch.num_rows
+            if report is not None:
+                report(done, total)
+            yield can_id, units, batch.to_pandas(types_mapper=types_mapper)
+
+
+def _long_rows(can_id: int, units: dict[str, str], chunk: pd.DataFrame):
+    """
+    Rows of a message chunk in the long layout, every signal of a frame then the
+    next frame, as make_known writes them.
+    """
+    sensors = list(units)
+    count = len(chunk)
+    unit_names, unit_codes = np.unique(list(units.values()), return_inverse=True)
+    return pd.DataFrame(
+        {
+            "Timestamp": np.repeat(
+                chunk["Timestamp"].to_numpy(dtype=np.int64), len(sensors)
+            ),
+            "CANID": np.full(count * len(sensors), can_id, dtype=np.int32),
+            "Sensor": pd.Categorical.from_codes(
+                np.tile(np.arange(len(sensors)), count), sensors
+            ),
+            "Value": np.column_stack(
+                [
+                    chunk[sensor].to_numpy(dtype=np.float64, na_value=np.nan)
+                    for sensor in sensors
+                ]
+            ).ravel(),
+            "Unit": pd.Categorical.from_codes(
+                np.tile(unit_codes, count), unit_names.tolist()
+            ),
+        }
+    )
+
+
+def _iter_wide_known(path, columns, chunk_size, report, sensors=None):
+    signal_count = max(
+        [len(_signal_fields(file.schema_arrow)) for file in _message_files(path)] or [1]
+    )
+    for can_id, units, chunk in iter_messages(
+        path, max(1, chunk_size // signal_count), report, sensors
+    ):
+        rows = _long_rows(can_id, units, chunk)
+        if sensors is not None:
+            rows = rows[rows["Sensor"].isin(sensors)]
+        yield rows if columns is None else rows[columns]
+
+
+# === READING ===
+
+
+def integer_fields(path) -> set[tuple[int, str]]:
+    """
+    (CAN ID, Sensor) of the signals recorded as integer valued when the known file
+    was written. Empty for csv files and parquet files written without the
+    metadata, whose values are all written as floats.
+    """
+    if is_wide(path):
+        return {
+            (int(file.schema_arrow.metadata[CAN_ID_KEY.encode()]), field.name)
+            for file in _message_files(path)
+            for field in _signal_fields(file.schema_arrow)
+            if pa.types.is_integer(field.type)
+        }
+    if not is_parquet(path):
+        return set()
+
+    metadata = pq.read_schema(path).metadata or {}
+    return {
+        (can_id, sensor)
+        for can_id, sensor, field_type in json.loads(
+            metadata.get(FIELD_TYPES_KEY.encode(), b"[]")
+        )
+        if field_type == INTEGER
+    }
+
+
+def _csv_dtypes(columns):
+    return {column: CSV_DTYPES[column] for column in columns or CSV_DTYPES}
+
+
+def _from_csv(chunk: pd.DataFrame) -> pd.DataFrame:
+    # Old csv files carry "None" and value table names in Value
+    if "Value" in chunk:
+        chunk["Value"] = pd.to_numeric(chunk["Value"], errors="coerce")
+    return chunk
+
+
+def read_known(path, columns: list[str] | None = None, filters=None) -> pd.DataFrame:
+    """
+    Reads a known file into a DataFrame.
+
+    :param path: .parquet or .csv known file
+    :param columns: Columns to read, defaults to all of them
+    :param filters: pyarrow row filters such as [("Sensor", "in", ["Date", "Time"])]
+    """
+    if is_parquet(path):
+        return pd.read_parquet(path, columns=columns, filters=filters)
+
+    if is_wide(path):
+        sensors = None
+        for column, op, value in filters or []:
+            if (column, op) != ("Sensor", "in"):
+                raise ValueError(f"Unsupported wide filter: {column} {op}")
+            sensors = set(value)
+        chunks = list(_iter_wide_known(path, columns, CHUNK_SIZE, None, sensors))
+        if not chunks:
+            return pd.DataFrame(
+                {column: [] for column in columns or KNOWN_SCHEMA.names}
+            )
+        return pd.concat(chunks, ignore_index=True)
+
+    dtypes = _csv_dtypes(columns)
+    dtypes.pop("Value", None)
+    df = _from_csv(pd.read_csv(path, usecols=columns, dtype=dtypes))
+    if filters:
+        for column, op, value in filters:
+            if op != "in":
+                raise ValueError(f"Unsupported csv filter operation: {op}")
+            df = df[df[column].isin(value)]
+    return df
+
+
+def row_count(path) -> int | None:
+    """
+    :returns: Number of rows of a parquet known file (long rows of a wide one),
+        None for a csv
+    """
+    if is_wide(path):
+        return sum(
+            file.metadata.num_rows * len(_signal_fields(file.schema_arrow))
+            for file in _message_files(path)
+        )
+    if not is_parquet(path):
+        return None
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def iter_known(
+    path,
+    columns: list[str] | None = None,
+    chunk_size: int = CHUNK_SIZE,
+    report: Callable[[int, int], None] | None = None,
+):
+    """
+    Yields DataFrames of at most ``chunk_size`` rows from a known file.
+
+    :param path: .parquet, .wide or .csv known file
+    :param columns: Columns to read, defaults to all of them
+    :param report: Called after each chunk with the rows read and the total rows
+        of a parquet file, the frames of a wide directory, or the bytes read and
+        the file size of a csv
+    """
+    if is_wide(path):
+        yield from _iter_wide_known(path, columns, chunk_size, report)
+        return
+
+    if is_parquet(path):
+        parquet_file = pq.ParquetFile(path)
+        total, done = parquet_file.metadata.num_rows, 0
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            done += batch.num_rows
+            if report is not None:
+                report(done, total)
+            yield batch.to_pandas()
+        return
+
+    dtypes = _csv_dtypes(columns)
+    dtypes.pop("Value", None)
+    total = os.path.getsize(path)
+    with open(path, "rb") as file:
+        for chunk in pd.read_csv(
+            file, usecols=columns, dtype=dtypes, chunksize=chunk_size
+        ):
+            if report is not None:
+                report(min(file.tell(), total), total)
+            yield _from_csv(chunk)
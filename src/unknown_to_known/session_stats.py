@@ -0,0 +1,101 @@
+import numpy as np
+
+from raw_to_unknown.deserializer import Frames
+from unknown_to_known.clock_alignment import CLOCK_SENSORS, ClockSamples
+
+"""
+Summary of a decoded log, gathered batch by batch while make_known decodes it:
+frame and row counts, the span of the logger timestamps, the CAN IDs seen and
+count/min/max of every sensor, and the mapping of its timestamps to Unix time
+(see clock_alignment). It is what the session index stores, so logs can be
+searched without reading them again, and what later stages take the Unix time from.
+"""
+
+
+class SessionStats:
+    def __init__(self):
+        self.frames = 0
+        self.rows = 0
+        # Logger timestamps in ms of the first and last CAN record
+        self.start: int | None = None
+        self.end: int | None = None
+        self.can_ids: set[int] = set()
+        # Sensor name -> [unit, count, min, max], count and min/max ignore NaN
+        self.sensors: dict[str, list] = {}
+        self.clock = ClockSamples()
+        # Peak resident memory in bytes of the processes the log was decoded on
+        # when it was split over several, see decode.make_known_sharded. Not part
+        # of the summary.
+        self.worker_peak_memory: int | None = None
+
+    def add_frames(self, frames: Frames) -> None:
+        """
+        :param frames: A batch of CAN records
+        """
+        self.frames += len(frames)
+        if len(frames):
+            self._span(int(frames.timestamps.min()), int(frames.timestamps.max()))
+            self.can_ids.update(np.unique(frames.can_ids).tolist())
+
+    def add_signal(
+        self, sensor: str, unit: str, values: np.ndarray, timestamps: np.ndarray
+    ) -> None:
+        """
+        :param values: Values of one signal decoded from a batch, in frame order
+        :param timestamps: Logger timestamps of the values
+        """
+        self.rows += len(values)
+        valid = values[~np.isnan(values)]
+        if len(valid) == 0:
+            self._sensor(sensor, unit, 0, None, None)
+            return
+
+        self._sensor(sensor, unit, len(valid), valid.min(), valid.max())
+        if sensor in CLOCK_SENSORS:
+            self.clock.add(sensor, timestamps, values)
+
+    def merge(self, other: "SessionStats") -> None:
+        """
+        Adds the stats of the part of the log that comes after this one.
+        """
+        self.frames += other.frames
+        self.rows += other.rows
+        if other.start is not None:
+            self._span(other.start, other.end)
+        self.can_ids |= other.can_ids
+        for sensor, (unit, count, low, high) in other.sensors.items():
+            self._sensor(sensor, unit, count, low, high)
+        self.clock.merge(other.clock)
+
+    def _span(self, start: int, end: int) -> None:
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+
+    def _sensor(self, sensor: str, unit: str, count: int, low, high) -> None:
+        low = None if low is None else float(low)
+        high = None if high is None else float(high)
+        current = self.sensors.get(sensor)
+        if current is None:
+            self.sensors[sensor] = [unit, count, low, high]
+            return
+
+        current[1] += count
+        if low is not None:
+            current[2] = low if current[2] is None else min(current[2], low)
+        if high is not None:
+            current[3] = high if current[3] is None else max(current[3], high)
+
+    def to_dict(self) -> dict:
+        clock = self.clock.fit()
+        return {
+            "frames": self.frames,
+            "rows": self.rows,
+            "start": self.start,
+            "end": self.end,
+            "can_ids": sorted(self.can_ids),
+            "sensors": {
+                sensor: {"unit": unit, "count": count, "min": low, "max": high}
+                for sensor, (unit, count, low, high) in self.sensors.items()
+            },
+            "clock": None if clock is None else clock.to_dict(),
+        }